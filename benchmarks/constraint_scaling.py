@@ -0,0 +1,84 @@
+"""
+Solve time of the portfolio optimizer against the number of benchmark constraints.
+
+Usage(from the project root):
+    python -m benchmarks.constraint_scaling --stocks 300 --start 2011-01-01 --end 2013-12-31 --factors 6
+
+Runs steps 1-3 of PortfolioOptimizer once on a synthetic market, then solves the optimal portfolios(step 4) under
+growing sets of constraints: none, industry neutrality, style exposure bounds and a tracking error limit. The
+benchmark constraints are expressed on the K factor exposures, so the solve time should grow with the number of
+factors rather than the number of stocks.
+"""
+import os
+import sys
+import time
+import argparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from benchmarks.run_benchmarks import prepare_synthetic_market
+
+CONFIGS = [
+    ('long only', {}),
+    ('+ industry neutral', {'industry_neutral': True}),
+    ('+ style bounds', {'industry_neutral': True, 'style_bounds': 0.5}),
+    ('+ tracking error', {'industry_neutral': True, 'style_bounds': 0.5, 'max_tracking_error': 0.05}),
+]
+
+def time_configs(style_factor_dict: dict, hist_periods=12, gamma=1.) -> list:
+    """
+    Returns:
+        list: (name, number of constraint rows, number of stocks, solve time in seconds) of each configuration
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import src.dataloader as dl
+    from src import preprocess
+    from src.profiler import PROFILER
+    from src.portfolio_optimizer import PortfolioOptimizer
+
+    PROFILER.verbose = False
+    df_backtest = preprocess.TimeAndStockFilter(dl.load_basic_info()).run()
+    base = PortfolioOptimizer(df_backtest, style_factor_dict=style_factor_dict, hist_periods=hist_periods, gamma=gamma)
+    base.preprocess()
+    base.get_regression_results()
+    base.predict()
+
+    results = []
+    for name, kwargs in CONFIGS:
+        optimizer = PortfolioOptimizer(df_backtest, style_factor_dict=style_factor_dict, hist_periods=hist_periods,
+                                       gamma=gamma, **kwargs)
+        # reuse the inputs of step 4 computed above
+        for attr in ['df_backtest', 'stock_industry_codes', 'industry_factors', 'all_factors', 'dense_factors',
+                     'benchmark_weight_col', 'df_pred_factor_cov', 'df_pred_idio_return', 'df_pred_specific_risk',
+                     'df_pred_stock_returns']:
+            setattr(optimizer, attr, getattr(base, attr))
+        start = time.perf_counter()
+        optimizer.solve_opt_weights()
+        elapsed = time.perf_counter() - start
+        num_rows = sum(constraint.size for constraint in optimizer.opt_problem.constraints)
+        results.append((name, num_rows, sum(variable.size for variable in optimizer.opt_problem.variables()), elapsed))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the portfolio optimizer under growing sets of constraints.')
+    parser.add_argument('--stocks', type=int, default=300)
+    parser.add_argument('--start', default='2011-01-01')
+    parser.add_argument('--end', default='2013-12-31')
+    parser.add_argument('--factors', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=os.path.join(REPO_ROOT, 'benchmarks', 'synthetic_data'))
+    args = parser.parse_args(argv)
+
+    _, data_root, style_factor_dict = prepare_synthetic_market(args.workdir, args.stocks, args.start, args.end,
+                                                               args.factors, args.seed)
+    os.chdir(data_root)
+    results = time_configs(style_factor_dict)
+    print(f"\n{'constraints':<25}{'rows':>8}{'variables':>11}{'solve(s)':>10}")
+    for name, num_rows, num_variables, elapsed in results:
+        print(f"{name:<25}{num_rows:>8}{num_variables:>11}{elapsed:>10.3f}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Offline check of the factor download scheduler(src/downloader.py) against a local stub of the rqdatac API.
+
+Usage(from the project root):
+    python -m benchmarks.downloader_check
+
+The stub serves deterministic factor values and (dates x stocks) flags, fails a given number of times on each chunk and
+can be made to break down for good after a number of calls, like a dropped connection. The check covers:
+    - chunking: the assembled factor and the concurrent flag queries equal a single call over all stocks and dates
+    - retries: transient failures of every chunk are retried and the download still completes
+    - resume: after an interruption only the remaining chunks are requested, also when the download is resumed with
+      other chunk sizes, and left over checkpoints are not reused with overwrite=True
+Exits with code 1 if any of them fails.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import threading
+import collections
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from benchmarks.run_benchmarks import prepare_synthetic_market
+
+class StubRicequant:
+    """
+    Mimics rqdatac.get_factor/is_st_stock/is_suspended on made up data.
+
+    Args:
+        failures_per_chunk (int, optional): number of times each distinct request fails before it succeeds. Defaults to 0.
+        calls_before_breakdown (int, optional): number of successful calls after which every call fails. Defaults to None.
+        offset (float, optional): added to the factor values, to tell the data of two stubs apart. Defaults to 0.
+    """
+    def __init__(self, failures_per_chunk=0, calls_before_breakdown=None, offset=0.):
+        self.failures_per_chunk = failures_per_chunk
+        self.calls_before_breakdown = calls_before_breakdown
+        self.offset = offset
+        self.failures = collections.Counter()
+        self.successful_calls = []
+        self.lock = threading.Lock()
+
+    def _check(self, request):
+        with self.lock:
+            if self.calls_before_breakdown is not None and len(self.successful_calls) >= self.calls_before_breakdown:
+                raise ConnectionError('connection lost')
+            if self.failures[request] < self.failures_per_chunk:
+                self.failures[request] += 1
+                raise ConnectionError('quota exceeded')
+            self.successful_calls.append(request)
+
+    @staticmethod
+    def _dates(start_date, end_date):
+        return pd.bdate_range(start_date, end_date, name='date')
+
+    def get_factor(self, order_book_ids, factor, start_date, end_date):
+        self._check(('get_factor', factor, tuple(order_book_ids), start_date, end_date))
+        dates = self._dates(start_date, end_date)
+        if len(dates) == 0:
+            return None
+        index = pd.MultiIndex.from_product([order_book_ids, dates], names=['order_book_id', 'date'])
+        # a value that only depends on the stock and the date
+        values = [int(stock[:6]) + date.dayofyear / 1000. + self.offset for stock, date in index]
+        return pd.DataFrame({factor: values}, index=index)
+
+    def _flags(self, name, order_book_ids, start_date, end_date):
+        self._check((name, tuple(order_book_ids), start_date, end_date))
+        dates = self._dates(start_date, end_date)
+        codes = np.array([int(stock[:6]) for stock in order_book_ids])
+        return pd.DataFrame((codes[np.newaxis, :] + dates.dayofyear.values[:, np.newaxis]) % 7 == 0, index=dates,
+                            columns=order_book_ids)
+
+    def is_st_stock(self, order_book_ids, start_date, end_date):
+        return self._flags('is_st_stock', order_book_ids, start_date, end_date)
+
+    def is_suspended(self, order_book_ids, start_date, end_date):
+        return self._flags('is_suspended', order_book_ids, start_date, end_date)
+
+def run_checks(data_path: str) -> list:
+    """Returns a list of (check name, passed) tuples"""
+    from src.downloader import FactorDownloadScheduler
+    stocks = [f'{code:06d}.XSHE' for code in range(1, 24)]
+    start_date, end_date = '2015-01-01', '2016-06-30'
+    factor = 'pe_ratio_ttm'
+    expected = StubRicequant().get_factor(stocks, factor, start_date, end_date).sort_index()
+    results = []
+
+    def scheduler(api, **kwargs):
+        params = dict(stock_chunk_size=5, date_chunk_days=90, max_workers=4, max_calls_per_second=None, max_retries=3,
+                      retry_wait=0., data_path=data_path)
+        params.update(kwargs)
+        return FactorDownloadScheduler(api=api, **params)
+
+    def read_factor():
+        return pd.read_hdf(scheduler(StubRicequant()).factor_store_path(factor, 'value'))
+
+    def clean():
+        shutil.rmtree(os.path.join(data_path, 'factor'), ignore_errors=True)
+
+    # chunking and retries: every request fails twice before it succeeds
+    clean()
+    api = StubRicequant(failures_per_chunk=2)
+    num_tasks = len(scheduler(api).make_tasks(factor, stocks, start_date, end_date))
+    scheduler(api).download_factor(factor, stocks, start_date, end_date, factor_type='value')
+    results.append(('factor chunks assemble to a single call', read_factor().equals(expected)))
+    results.append(('every chunk is retried and requested once', len(api.successful_calls) == num_tasks
+                    and all(count == 2 for count in api.failures.values())))
+    flags = scheduler(StubRicequant(failures_per_chunk=1)).download_flags('is_st_stock', stocks, start_date, end_date)
+    results.append(('flag chunks stitch to a single call', flags.equals(StubRicequant().is_st_stock(stocks, start_date, end_date))))
+
+    # resume after an interruption, with the same chunks
+    clean()
+    broken = StubRicequant(calls_before_breakdown=num_tasks // 2)
+    try:
+        scheduler(broken, max_retries=1).download_factor(factor, stocks, start_date, end_date, factor_type='value')
+        interrupted = False
+    except ConnectionError:
+        interrupted = True
+    api = StubRicequant()
+    scheduler(api).download_factor(factor, stocks, start_date, end_date, factor_type='value')
+    results.append(('an interrupted download raises', interrupted))
+    results.append(('resuming only requests the remaining chunks',
+                    len(api.successful_calls) == num_tasks - len(broken.successful_calls)
+                    and not set(api.successful_calls) & set(broken.successful_calls)))
+    results.append(('resumed factor equals a single call', read_factor().equals(expected)))
+
+    # resume with other chunk sizes: the checkpoints of the old chunks must not be reused
+    clean()
+    try:
+        scheduler(StubRicequant(offset=1., calls_before_breakdown=num_tasks // 2), max_retries=0).download_factor(
+            factor, stocks, start_date, end_date, factor_type='value')
+    except ConnectionError:
+        pass
+    scheduler(StubRicequant(), stock_chunk_size=7, date_chunk_days=120).download_factor(factor, stocks, start_date,
+                                                                                          end_date, factor_type='value')
+    results.append(('resuming with other chunk sizes ignores the old checkpoints', read_factor().equals(expected)))
+
+    # overwrite with checkpoints left over by an interrupted download
+    try:
+        scheduler(StubRicequant(offset=1., calls_before_breakdown=num_tasks // 2), max_retries=0).download_factor(
+            factor, stocks, start_date, end_date, factor_type='value', overwrite=True)
+    except ConnectionError:
+        pass
+    scheduler(StubRicequant()).download_factor(factor, stocks, start_date, end_date, factor_type='value', overwrite=True)
+    results.append(('overwrite ignores left over checkpoints', read_factor().equals(expected)))
+    results.append(('checkpoints are deleted once assembled',
+                    not os.path.exists(os.path.join(data_path, 'factor', '_partial', factor))))
+    clean()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the factor download scheduler against a stub of rqdatac.')
+    parser.add_argument('--workdir', default=os.path.join(REPO_ROOT, 'benchmarks', 'synthetic_data'))
+    args = parser.parse_args(argv)
+
+    # src.constants reads the rebalancing dates of a data folder on import, the smallest synthetic market will do
+    _, data_root, _ = prepare_synthetic_market(args.workdir, 50, '2015-01-01', '2015-12-31', 1, 0)
+    os.chdir(data_root)
+    with tempfile.TemporaryDirectory() as data_path:
+        results = run_checks(data_path)
+    for name, passed in results:
+        print(f"{'OK  ' if passed else 'FAIL'} {name}")
+    if not all(passed for _, passed in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
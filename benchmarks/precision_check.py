@@ -0,0 +1,102 @@
+"""
+Tolerance check of the float32 precision policy against the float64 path.
+
+Usage(from the project root):
+    python -m benchmarks.precision_check --stocks 300 --start 2011-01-01 --end 2013-12-31 --factors 6
+
+Runs the pipeline on a synthetic market once under each precision policy(see src/precision.py), then compares
+standardized factors, t-values, factor returns, IC series, combined factor weights and optimal portfolio weights.
+Exits with code 1 if any of them differs by more than its tolerance.
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from benchmarks.run_benchmarks import prepare_synthetic_market
+
+# maximum absolute difference allowed between the float32 and float64 results
+TOLERANCES = {
+    'standardized factors': 1e-4,
+    't-values': 1e-2,
+    'factor returns': 1e-5,
+    'IC series': 1e-2,
+    'combined factor weights': 1e-2,
+    'optimal portfolio weights': 1e-3,
+}
+
+def run_pipeline(style_factor_dict: dict, hist_periods=12, gamma=1.) -> dict:
+    """Run the pipeline under the current precision policy and collect the outputs compared by this check"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import src.dataloader as dl
+    from src import preprocess
+    from src.single_factor import TTester, ICTester
+    from src.factor_combinator import FactorCombinator_Max_IC_or_ICIR
+    from src.portfolio_optimizer import PortfolioOptimizer
+
+    factor_type, factors = list(style_factor_dict.items())[0]
+    outputs = {}
+    df_backtest = preprocess.TimeAndStockFilter(dl.load_basic_info()).run()
+    df_factor = preprocess.standardize_factors(preprocess.add_factors(df_backtest, style_factor_dict), factors)
+    outputs['standardized factors'] = df_factor[factors]
+    outputs['panel memory'] = df_factor.memory_usage(deep=False).sum()
+    t_tester, ic_tester = TTester(), ICTester()
+    t_values, ic_series = {}, {}
+    for factor in factors:
+        t_tester.run(df_factor, factor)
+        t_values[factor] = t_tester.tval_coef['t_value']
+        ic_series[factor] = ic_tester.run(df_factor, factor)
+    outputs['t-values'] = pd.DataFrame(t_values)
+    outputs['IC series'] = pd.DataFrame(ic_series)
+    combinator = FactorCombinator_Max_IC_or_ICIR(factors=factors, factor_type=factor_type, df_backtest=df_backtest,
+                                                 standardize_factors=True, hist_periods=hist_periods)
+    combinator.run()
+    outputs['combined factor weights'] = combinator.df_opt_factor_weights[combinator.weight_cols]
+    optimizer = PortfolioOptimizer(df_backtest, style_factor_dict=style_factor_dict, hist_periods=hist_periods, gamma=gamma)
+    optimizer.run()
+    outputs['factor returns'] = optimizer.df_hist_factor_return
+    outputs['optimal portfolio weights'] = optimizer.opt_weights
+    return outputs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the float32 precision policy with the float64 one.')
+    parser.add_argument('--stocks', type=int, default=300)
+    parser.add_argument('--start', default='2011-01-01')
+    parser.add_argument('--end', default='2013-12-31')
+    parser.add_argument('--factors', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=os.path.join(REPO_ROOT, 'benchmarks', 'synthetic_data'))
+    args = parser.parse_args(argv)
+
+    _, data_root, style_factor_dict = prepare_synthetic_market(args.workdir, args.stocks, args.start, args.end,
+                                                               args.factors, args.seed)
+    os.chdir(data_root)
+    from src.profiler import PROFILER
+    from src.precision import precision_policy
+    PROFILER.verbose = False
+    results = {}
+    for precision in ['float64', 'float32']:
+        with precision_policy(precision):
+            results[precision] = run_pipeline(style_factor_dict)
+
+    print(f"panel memory: float64 {results['float64']['panel memory'] / 2 ** 20:.1f}MB, "
+          f"float32 {results['float32']['panel memory'] / 2 ** 20:.1f}MB\n")
+    print(f"{'output':<30}{'max abs diff':>15}{'tolerance':>12}")
+    num_failures = 0
+    for name, tol in TOLERANCES.items():
+        diff = (results['float32'][name].astype(np.float64) - results['float64'][name]).abs()
+        max_diff = np.nanmax(diff.values)
+        # a value missing in one path only is a failure too
+        missing_mismatch = (results['float32'][name].isnull() != results['float64'][name].isnull()).values.any()
+        failed = max_diff > tol or missing_mismatch
+        num_failures += failed
+        print(f"{name:<30}{max_diff:>15.2e}{tol:>12.0e}{'  FAILED' if failed else ''}")
+    return 1 if num_failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Benchmark suite covering every pipeline stage on a synthetic market.
+
+Usage(from the project root):
+    python -m benchmarks.run_benchmarks --stocks 300 --start 2011-01-01 --end 2013-12-31 --factors 6
+
+The synthetic data is generated once per scale under --workdir and reused afterwards. Each run is saved as
+benchmarks/results/<commit>_<scale>.json and compared with the latest run of the same scale on another commit;
+stages whose wall time grew by more than --threshold are flagged as regressions.
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import datetime
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from benchmarks.synthetic_market import generate_synthetic_market
+
+RESULT_KEYS = ['wall', 'cpu', 'children_cpu', 'task_cpu', 'peak_rss', 'peak_rss_growth', 'rows', 'cols']
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def prepare_synthetic_market(workdir: str, num_stocks: int, start_date: str, end_date: str, num_factors: int, seed: int):
+    """
+    Generate the synthetic market of the given scale under 'workdir', unless it already exists.
+
+    Returns:
+        tuple: (name of the scale, synthetic project root, style factor dict)
+    """
+    scale = f'{num_stocks}stocks_{start_date}_{end_date}_{num_factors}factors_seed{seed}'
+    data_root = os.path.join(workdir, scale)
+    if not os.path.exists(os.path.join(data_root, 'rq_credential.json')):
+        print(f'Generating the synthetic market {scale}...')
+        style_factor_dict = generate_synthetic_market(data_root, num_stocks=num_stocks, start_date=start_date,
+                                                      end_date=end_date, num_factors=num_factors, seed=seed)
+    else:
+        style_factor_dict = {'synthetic': [f'factor_{i}' for i in range(num_factors)]}
+    return scale, data_root, style_factor_dict
+
+def run_stages(style_factor_dict: dict, gamma=1., hist_periods=12) -> dict:
+    """
+    Run every pipeline stage once on the data in the current working directory, each in its own profiler stage.
+    src must only be imported after changing into the synthetic project root since src.constants reads from it on import.
+
+    Returns:
+        dict: stage name -> profiler record
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import src.dataloader as dl
+    from src import preprocess
+    from src.profiler import PROFILER
+    from src.single_factor import TTester, ICTester
+    from src.factor_combinator import FactorCombinator_Max_IC_or_ICIR
+    from src.portfolio_optimizer import PortfolioOptimizer
+
+    PROFILER.enabled = True
+    PROFILER.verbose = False
+    PROFILER.reset()
+    factor_type, factors = list(style_factor_dict.items())[0]
+    stage = PROFILER.stage
+
+    with stage('load_basic_info'):
+        df_basic_info = dl.load_basic_info()
+    with stage('TimeAndStockFilter.run') as record:
+        df_backtest = preprocess.TimeAndStockFilter(df_basic_info).run()
+        record.update(rows=df_backtest.shape[0], cols=df_backtest.shape[1])
+    with stage('add_factors') as record:
+        df_factor = preprocess.add_factors(df_backtest, style_factor_dict)
+        record.update(rows=df_factor.shape[0], cols=df_factor.shape[1])
+    with stage('standardize_factors') as record:
+        df_factor = preprocess.standardize_factors(df_factor, factors)
+        record.update(rows=df_factor.shape[0], cols=df_factor.shape[1])
+    with stage('TTester.run'):
+        t_tester = TTester()
+        for factor in factors:
+            t_tester.run(df_factor, factor)
+    with stage('ICTester.run'):
+        ic_tester = ICTester()
+        for factor in factors:
+            ic_tester.run(df_factor, factor)
+    for max_what in ['IC', 'ICIR']:
+        with stage(f'FactorCombinator_Max_IC_or_ICIR.run[{max_what}]'):
+            FactorCombinator_Max_IC_or_ICIR(factors=factors, factor_type=factor_type, df_backtest=df_backtest,
+                                            standardize_factors=True, hist_periods=hist_periods, max_what=max_what).run()
+    with stage('PortfolioOptimizer.run'):
+        PortfolioOptimizer(df_backtest, style_factor_dict=style_factor_dict, hist_periods=hist_periods, gamma=gamma).run()
+
+    # the decorated functions inside each benchmark stage are recorded too, as nested stages
+    return {record['name']: {key: record[key] for key in RESULT_KEYS if key in record}
+            for record in PROFILER.records if record['kind'] == 'stage' and record['depth'] == 0}
+
+def find_baseline(results_dir: str, scale: str, commit: str):
+    """the latest saved run of the same scale on a different commit"""
+    candidates = []
+    for path in glob.glob(os.path.join(results_dir, f'*_{scale}.json')):
+        with open(path) as file:
+            result = json.load(file)
+        if result['commit'] != commit:
+            candidates.append(result)
+    return max(candidates, key=lambda result: result['timestamp']) if candidates else None
+
+def compare(result: dict, baseline: dict, threshold=0.2, min_seconds=0.05) -> list:
+    """
+    Flag stages whose wall time grew by more than 'threshold'(relative) compared with the baseline.
+    Stages faster than 'min_seconds' in both runs are ignored since they are dominated by noise.
+    """
+    regressions = []
+    for name, stage in result['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        old, new = baseline['stages'][name]['wall'], stage['wall']
+        if max(old, new) >= min_seconds and new > old * (1 + threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every pipeline stage on a synthetic market.')
+    parser.add_argument('--stocks', type=int, default=300)
+    parser.add_argument('--start', default='2011-01-01')
+    parser.add_argument('--end', default='2013-12-31')
+    parser.add_argument('--factors', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gamma', type=float, default=1.)
+    parser.add_argument('--workdir', default=os.path.join(REPO_ROOT, 'benchmarks', 'synthetic_data'))
+    parser.add_argument('--results-dir', default=os.path.join(REPO_ROOT, 'benchmarks', 'results'))
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown flagged as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with code 1 if any regression is found')
+    args = parser.parse_args(argv)
+
+    scale, data_root, style_factor_dict = prepare_synthetic_market(args.workdir, args.stocks, args.start, args.end,
+                                                                   args.factors, args.seed)
+
+    results_dir = os.path.abspath(args.results_dir)
+    os.chdir(data_root)
+    stages = run_stages(style_factor_dict, gamma=args.gamma)
+
+    commit = get_commit()
+    result = {'commit': commit, 'timestamp': datetime.datetime.now().isoformat(), 'scale': scale, 'stages': stages}
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, f'{commit}_{scale}.json'), 'w') as file:
+        json.dump(result, file, indent=2)
+
+    print(f"\n{'stage':<45}{'wall(s)':>10}{'cpu(s)':>10}{'peak rss(GB)':>14}")
+    for name, stage in stages.items():
+        cpu = stage['cpu'] + stage['children_cpu'] + stage['task_cpu']
+        print(f"{name:<45}{stage['wall']:>10.3f}{cpu:>10.3f}{stage['peak_rss'] / 2 ** 30:>14.2f}")
+
+    baseline = find_baseline(results_dir, scale, commit)
+    if baseline is None:
+        print('\nNo baseline from another commit to compare with.')
+        return 0
+    regressions = compare(result, baseline, args.threshold)
+    print(f"\nCompared with commit {baseline['commit']}: {len(regressions)} regression(s)")
+    for name, old, new in regressions:
+        print(f'  {name}: {old:.3f}s -> {new:.3f}s ({new / old - 1:+.0%})')
+    return 1 if regressions and args.fail_on_regression else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
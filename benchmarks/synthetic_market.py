@@ -0,0 +1,149 @@
+"""
+Synthetic market generator for the benchmark suite.
+
+Writes a complete ./Data tree(stock bars, df_basic_info, rebalancing dates, industries, ST/suspension flags, listed dates,
+index data and factor files) with the same file names, keys and formats as the real one, so that every module in src
+runs on it without the proprietary data or a Ricequant login.
+
+Factor exposures are persistent over time and a few of them carry a small return premium, so that the single factor
+tests, factor combination and portfolio optimization produce non-trivial results.
+"""
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDUSTRY_NAMES_FILE = os.path.join(REPO_ROOT, 'Data', 'raw_data', 'industry_code_to_names.xlsx')
+
+def get_stock_codes(num_stocks: int) -> list:
+    """csv-style stock codes, half of them listed in Shanghai and half in Shenzhen, e.g. sh600000 and sz000001"""
+    num_sh = num_stocks // 2
+    return [f'sh{600000 + i}' for i in range(num_sh)] + [f'sz{1 + i:06d}' for i in range(num_stocks - num_sh)]
+
+def normalize_code(code: str) -> str:
+    # same result as src.dataloader.normalize_code for the codes generated above, without importing src
+    return code[2:] + ('.XSHG' if code.startswith('sh') else '.XSHE')
+
+def get_factor_names(num_factors: int) -> list:
+    return [f'factor_{i}' for i in range(num_factors)]
+
+def generate_synthetic_market(root: str, num_stocks=300, start_date='2011-01-01', end_date='2013-12-31', num_factors=6,
+                              factor_type='synthetic', flag_frequency='daily', seed=0) -> dict:
+    """
+    Generate a synthetic market under root/Data.
+
+    Args:
+        root (str): the folder playing the role of the project root(the working directory of src)
+        num_stocks (int, optional): number of stocks. Defaults to 300.
+        start_date (str, optional): start of the backtest, the bars start one year earlier. Defaults to '2011-01-01'.
+        end_date (str, optional): last trading date. Defaults to '2013-12-31'.
+        num_factors (int, optional): number of factors, saved under ./Data/factor/<factor_type>/. Defaults to 6.
+        factor_type (str, optional): the factor type folder. Defaults to 'synthetic'.
+        flag_frequency (str, optional): 'daily' saves the ST/suspension flags on every trading day like Ricequant does,
+                                        'rebalancing' only on rebalancing dates. Defaults to 'daily'.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: the style factor dict of the generated factors, e.g. {'synthetic': ['factor_0', 'factor_1']}
+    """
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(root, 'Data')
+    for folder in ['stock_data', 'raw_data', 'index_data', os.path.join('factor', factor_type)]:
+        os.makedirs(os.path.join(data_path, folder), exist_ok=True)
+    # src uses both './Data/' and './data/', which only works on case-insensitive file systems
+    if not os.path.exists(os.path.join(root, 'data')):
+        os.symlink('Data', os.path.join(root, 'data'))
+    with open(os.path.join(root, 'rq_credential.json'), 'w') as file:
+        json.dump({'user': 'synthetic', 'password': 'synthetic'}, file)
+    shutil.copy(INDUSTRY_NAMES_FILE, os.path.join(data_path, 'raw_data'))
+
+    codes = get_stock_codes(num_stocks)
+    stocks = [normalize_code(code) for code in codes]
+    # the bars start one year before the backtest so that stocks listed before it pass the listing age filter
+    dates = pd.bdate_range(pd.Timestamp(start_date) - pd.DateOffset(years=1), end_date)
+    num_dates = len(dates)
+    df_dates = pd.Series(dates)
+    rebalancing_dates = df_dates.groupby([df_dates.dt.year, df_dates.dt.month]).max().values
+    rebalancing_dates = rebalancing_dates[rebalancing_dates >= np.datetime64(pd.Timestamp(start_date))]
+    is_rebalancing = dates.isin(rebalancing_dates)
+    # period number of each trading day; exposures only change on rebalancing dates
+    period = np.concatenate([[0], np.cumsum(is_rebalancing)[:-1]])
+    num_periods = period[-1] + 1
+
+    # factor exposures follow an AR(1) process across periods
+    exposures = np.empty((num_periods, num_stocks, num_factors))
+    exposures[0] = rng.standard_normal((num_stocks, num_factors))
+    for t in range(1, num_periods):
+        exposures[t] = 0.9 * exposures[t - 1] + np.sqrt(1 - 0.9 ** 2) * rng.standard_normal((num_stocks, num_factors))
+    # a few factors carry a daily return premium, the others are noise
+    premia = np.where(np.arange(num_factors) % 2 == 0, 2e-4, 0.) * rng.choice([-1, 1], num_factors)
+
+    # daily returns = market + industry + factor premia + idiosyncratic noise
+    industry_codes = pd.read_excel(INDUSTRY_NAMES_FILE, 'Secondary Industries')['secon_indus_code'].values
+    stock_industry = rng.choice(industry_codes, num_stocks)
+    industry_id = pd.factorize(stock_industry)[0]
+    market_return = 2e-4 + 0.012 * rng.standard_normal(num_dates)
+    industry_return = 0.006 * rng.standard_normal((num_dates, industry_id.max() + 1))
+    daily_returns = (market_return[:, np.newaxis] + industry_return[:, industry_id]
+                     + exposures[period] @ premia + 0.02 * rng.standard_normal((num_dates, num_stocks)))
+    close = 10 * np.exp(rng.normal(0, 0.5, num_stocks)) * np.exp(np.cumsum(np.clip(daily_returns, -0.1, 0.1), axis=0))
+    open_ = close / (1 + np.clip(0.005 * rng.standard_normal((num_dates, num_stocks)), -0.1, 0.1))
+    shares = np.exp(rng.normal(20, 1., num_stocks))
+    market_value = close * shares
+
+    # a third of the stocks are listed during the sample period
+    listed_idx = np.where(rng.random(num_stocks) < 1 / 3, rng.integers(0, num_dates, num_stocks), 0)
+    listed = np.arange(num_dates)[:, np.newaxis] >= listed_idx[np.newaxis, :]
+
+    # stock bars: one csv per stock, and the concatenated df_basic_info
+    df_list = []
+    for j, code in enumerate(codes):
+        rows = slice(listed_idx[j], num_dates)
+        df_stock = pd.DataFrame({'date': dates[rows].strftime('%Y-%m-%d'), 'code': code, 'open': open_[rows, j],
+                                 'close': close[rows, j], 'market_value': market_value[rows, j]})
+        df_stock.to_csv(os.path.join(data_path, 'stock_data', code + '.csv'), index=False)
+        df_list.append(df_stock)
+    df_basic_info = pd.concat(df_list, axis=0).rename(columns={'code': 'stock'})
+    df_basic_info.to_hdf(os.path.join(data_path, 'raw_data', 'df_basic_info.h5'), key='df_basic_info.h5')
+    pd.Series(rebalancing_dates).to_hdf(os.path.join(data_path, 'raw_data', 'rebalancing_dates.h5'), key='rebalancing_dates')
+    df_listed_dates = pd.DataFrame({'listed_date': dates[listed_idx]}, index=stocks).sort_index()
+    df_listed_dates.to_hdf(os.path.join(data_path, 'raw_data', 'listed_dates.h5'), key='listed_dates.h5')
+
+    # industries
+    df_indus_mapping = pd.DataFrame({'secon_indus_code': stock_industry}, index=stocks)
+    df_indus_mapping['pri_indus_code'] = df_indus_mapping['secon_indus_code'].str[0]
+    df_indus_mapping.to_hdf(os.path.join(data_path, 'raw_data', 'industry_mapping.h5'), key='industry_mapping')
+
+    # ST spells last a few months, suspensions a few days
+    is_st = np.zeros((num_dates, num_stocks), dtype=bool)
+    for j in np.flatnonzero(rng.random(num_stocks) < 0.05):
+        start = rng.integers(0, num_dates)
+        is_st[start: start + rng.integers(60, 250), j] = True
+    is_suspended = rng.random((num_dates, num_stocks)) < 0.01
+    flag_rows = slice(None) if flag_frequency == 'daily' else is_rebalancing
+    for name, flags in [('is_st', is_st), ('is_suspended', is_suspended)]:
+        df_flags = pd.DataFrame(flags[flag_rows], index=dates[flag_rows], columns=stocks)
+        df_flags.stack().to_hdf(os.path.join(data_path, 'raw_data', f'{name}.h5'), key=name)
+
+    # factor files, in the (order_book_id, date) format returned by rqdatac.get_factor, only on the rebalancing dates
+    noise_ratio = 0.1
+    for k, factor in enumerate(get_factor_names(num_factors)):
+        values = exposures[period[is_rebalancing], :, k] + noise_ratio * rng.standard_normal((is_rebalancing.sum(), num_stocks))
+        # factor values are missing before listing, and a few are randomly missing or extreme like in the real data
+        values = np.where(listed[is_rebalancing], values, np.nan)
+        values[rng.random(values.shape) < 0.02] = np.nan
+        values[rng.random(values.shape) < 0.002] *= 50
+        df_factor = pd.DataFrame(values, index=dates[is_rebalancing], columns=stocks).stack().rename(factor).to_frame()
+        df_factor.index.names = ['date', 'order_book_id']
+        df_factor = df_factor.swaplevel().sort_index()
+        df_factor.to_hdf(os.path.join(data_path, 'factor', factor_type, factor + '.h5'), key='factor')
+
+    # CSI 300 proxy: market cap weighted index of all stocks
+    index_return = (np.nan_to_num(daily_returns) * market_value).sum(axis=1) / market_value.sum(axis=1)
+    index_close = 3000 * np.cumprod(1 + index_return)
+    pd.DataFrame({'date': dates.strftime('%Y-%m-%d'), 'open': index_close / (1 + index_return), 'close': index_close,
+                  'change': index_return}).to_csv(os.path.join(data_path, 'index_data', 'sh000300.csv'), index=False)
+
+    return {factor_type: get_factor_names(num_factors)}
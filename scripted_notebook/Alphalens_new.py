@@ -55,3 +55,24 @@ al.tears.create_information_tear_sheet(factor_data=pb_cleaned)
 
 # %%
 al.tears.create_turnover_tear_sheet(factor_data=pb_cleaned,turnover_periods=['21D','45D','96D'])
+
+# %% [markdown]
+# the same statistics with the native tear sheet engine(src/tear_sheet.py), for all the factors at once and without get_clean_factor_and_forward_returns
+
+# %%
+from src.tear_sheet import TearSheet, price_matrix
+tear_sheet = TearSheet(price_matrix(df, 'close'), periods=(21, 45, 96), quantiles=5, group_col='pri_indus_code')
+tear_sheet.run(df, ['PE_TTM', 'PS_TTM', 'PC_TTM', 'PB'])
+tear_sheet.get_summary()
+
+# %%
+tear_sheet.get_returns_table('PB')
+
+# %%
+tear_sheet.get_ic_table('PB')
+
+# %%
+tear_sheet.get_turnover_table('PB')
+
+# %%
+tear_sheet.get_graph('PB')
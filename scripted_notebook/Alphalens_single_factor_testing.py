@@ -129,3 +129,24 @@ al.tears.create_turnover_tear_sheet(factor_data=pb_factor_data,turnover_periods=
 
 # %% [markdown]
 #
+# #### Native tear sheets
+# src/tear_sheet.py computes the same statistics for all the factors at once from the price matrix, without get_clean_factor_and_forward_returns
+
+# %%
+from src.tear_sheet import TearSheet
+df_factors = pd.concat([roe, pb, mkt_cap, vol3], axis=1)
+df_factors.columns = ['roe', 'pb', 'mkt_cap', 'vol3']
+df_factors['sector'] = df_factors.index.get_level_values(1).map(ticker_sector)
+df_factors = df_factors.sort_index()
+tear_sheet = TearSheet(backtest_price_data, periods=(1, 5, 10), group_col='sector')
+tear_sheet.run(df_factors, ['roe', 'pb', 'mkt_cap', 'vol3'])
+tear_sheet.get_summary()
+
+# %%
+tear_sheet.get_ic_table('pb')
+
+# %%
+tear_sheet.get_turnover_table('pb')
+
+# %%
+tear_sheet.get_graph('pb')
@@ -0,0 +1,214 @@
+"""
+Performance analytics of a backtested portfolio.
+
+BacktestResult takes the portfolio weights and the next period's returns of every stock on every rebalancing date as
+(dates x stocks) matrices, and computes the period returns, turnover, transaction costs, net asset value, drawdowns
+and benchmark-relative returns with whole-matrix numpy operations, without regrouping the panel.
+
+Plotting is kept in get_graph, which imports matplotlib only when it is called, so batch runs can compute and store
+the statistics without loading it.
+"""
+import numpy as np
+import pandas as pd
+from src.panel import get_segment_index
+from src.precision import accumulate
+
+def infer_periods_per_year(dates) -> float:
+    """number of rebalancing periods per year, e.g. about 12 for monthly rebalancing"""
+    dates = pd.DatetimeIndex(dates)
+    if len(dates) < 2:
+        return np.nan
+    return (len(dates) - 1) / ((dates[-1] - dates[0]) / pd.Timedelta('365.25d'))
+
+def panel_to_matrix(df: pd.DataFrame, col: str, fill_value=np.nan) -> tuple:
+    """
+    Reshape a column of the (date, stock) panel into a (dates x stocks) matrix.
+
+    Returns:
+        tuple: (matrix, dates, stocks)
+    """
+    segment_index = get_segment_index(df)
+    stock_codes, stocks = pd.factorize(df.index.get_level_values(1))
+    date_codes = segment_index.broadcast(np.arange(len(segment_index)))
+    matrix = np.full((len(segment_index), len(stocks)), fill_value, dtype=np.float64)
+    matrix[date_codes, stock_codes] = accumulate(df[col])
+    return matrix, segment_index.dates, pd.Index(stocks)
+
+class BacktestResult:
+    """
+    Returns, turnover, costs, net asset value and drawdowns of a portfolio rebalanced on each date.
+
+    On each date t the portfolio is rebalanced to weights[t] and held over the next period, earning returns[t].
+    Between two rebalancing dates the weights drift with the returns of the stocks, so the turnover of date t is
+    sum(|weights[t] - drifted weights[t - 1]|), the value traded as a fraction of the net asset value(the first
+    rebalance buys the whole portfolio). Transaction costs are 'cost_rate' times the turnover, paid out of the net asset
+    value at the rebalance.
+
+    A stock with a non-zero weight and a missing return makes the return of its period missing; such periods leave the
+    net asset value unchanged and are skipped in the statistics.
+    """
+    def __init__(self, weights, returns, dates, stocks=None, benchmark_returns=None, cost_rate=0., periods_per_year=None):
+        """
+        Args:
+            weights (np.ndarray): T x N portfolio weights, missing values mean the stock is not held
+            returns (np.ndarray): T x N next period's returns of the stocks
+            dates (Iterable): the T rebalancing dates
+            stocks (Iterable, optional): the N stock codes. Defaults to None.
+            benchmark_returns (optional): T returns of the benchmark over the same periods. Defaults to None.
+            cost_rate (float, optional): transaction cost per unit of traded value, e.g. 0.002. Defaults to 0.
+            periods_per_year (float, optional): inferred from the dates if not given. Defaults to None.
+        """
+        self.dates = pd.DatetimeIndex(dates)
+        self.weights = np.nan_to_num(accumulate(weights))
+        self.stock_returns = accumulate(returns)
+        assert(self.weights.shape == self.stock_returns.shape == (len(self.dates), self.weights.shape[1]))
+        self.stocks = stocks
+        self.cost_rate = cost_rate
+        self.periods_per_year = infer_periods_per_year(self.dates) if periods_per_year is None else periods_per_year
+
+        held = self.weights != 0
+        stock_returns = np.where(held, np.nan_to_num(self.stock_returns), 0.)
+        period_returns = (self.weights * stock_returns).sum(axis=1)
+        period_returns[(held & np.isnan(self.stock_returns)).any(axis=1)] = np.nan
+        self.returns = pd.Series(period_returns, index=self.dates, name='return')
+
+        # weights right before each rebalance: last period's weights after drifting with the returns
+        with np.errstate(divide='ignore', invalid='ignore'):
+            drifted = self.weights * (1 + stock_returns) / (1 + np.nan_to_num(period_returns))[:, np.newaxis]
+        previous = np.vstack([np.zeros((1, self.weights.shape[1])), np.nan_to_num(drifted[:-1])])
+        self.turnover = pd.Series(np.abs(self.weights - previous).sum(axis=1), index=self.dates, name='turnover')
+        self.costs = (self.cost_rate * self.turnover).rename('cost')
+        self.net_returns = ((1 - self.costs) * (1 + self.returns) - 1).rename('net_return')
+        self.nav = (1 + self.net_returns.fillna(0)).cumprod().rename('nav')
+        self.drawdown = self.get_drawdown(self.nav)
+
+        self.benchmark_returns = None
+        self.excess_returns = None
+        if benchmark_returns is not None:
+            self.benchmark_returns = pd.Series(accumulate(benchmark_returns), index=self.dates, name='benchmark_return')
+            self.benchmark_nav = (1 + self.benchmark_returns.fillna(0)).cumprod().rename('benchmark_nav')
+            self.excess_returns = (self.net_returns - self.benchmark_returns).rename('excess_return')
+            # value of the portfolio relative to the benchmark, e.g. for a long-portfolio short-benchmark hedge
+            self.relative_nav = (self.nav / self.benchmark_nav).rename('relative_nav')
+
+    @classmethod
+    def from_panel(cls, df: pd.DataFrame, weight_col: str, return_col='next_period_return', benchmark_weight_col=None,
+                   cost_rate=0., periods_per_year=None) -> 'BacktestResult':
+        """
+        Build the result from columns of the (date, stock) panel. Dates on which no weight is given are left out,
+        e.g. the first 'hist_periods' dates of the portfolio optimizer.
+
+        Args:
+            df (pd.DataFrame): the backtesting panel, sorted by date
+            weight_col (str): the portfolio weights
+            return_col (str, optional): the next period's returns. Defaults to 'next_period_return'.
+            benchmark_weight_col (str, optional): weights of the benchmark portfolio, scaled to add up to 1 on each date.
+                Defaults to None.
+        """
+        weights, dates, stocks = panel_to_matrix(df, weight_col)
+        returns, _, _ = panel_to_matrix(df, return_col)
+        active = ~np.isnan(weights).all(axis=1)
+        benchmark_returns = None
+        if benchmark_weight_col is not None:
+            benchmark_weights, _, _ = panel_to_matrix(df, benchmark_weight_col, fill_value=0.)
+            benchmark_weights = np.nan_to_num(benchmark_weights)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                benchmark_weights /= benchmark_weights.sum(axis=1, keepdims=True)
+            benchmark_returns = np.nansum(benchmark_weights * returns, axis=1)[active]
+        return cls(weights[active], returns[active], dates[active], stocks=stocks, benchmark_returns=benchmark_returns,
+                   cost_rate=cost_rate, periods_per_year=periods_per_year)
+
+    @staticmethod
+    def get_drawdown(nav: pd.Series) -> pd.Series:
+        """relative loss from the highest net asset value so far, starting from 1"""
+        peak = np.maximum.accumulate(np.concatenate([[1.], nav.values]))[1:]
+        return (nav / peak - 1).rename('drawdown')
+
+    def max_drawdown_duration(self) -> int:
+        """the longest number of periods spent below a previous peak"""
+        below_peak = self.drawdown.values < 0
+        position = np.arange(1, len(below_peak) + 1)
+        # position of the last period at a peak, for every period
+        last_peak = np.maximum.accumulate(np.where(below_peak, 0, position))
+        return int((position - last_peak).max()) if len(position) else 0
+
+    def annualize_return(self, returns: pd.Series) -> float:
+        returns = returns.dropna()
+        return (1 + returns).prod() ** (self.periods_per_year / len(returns)) - 1 if len(returns) else np.nan
+
+    def annualize_volatility(self, returns: pd.Series) -> float:
+        return returns.std() * self.periods_per_year ** 0.5
+
+    def rolling_sharpe(self, window=12) -> pd.Series:
+        """annualized Sharpe ratio of the net returns over a rolling window, from cumulative sums of returns and their squares"""
+        returns = self.net_returns.values
+        valid = ~np.isnan(returns)
+        values = np.where(valid, returns, 0.)
+        def rolling_sum(x):
+            cumsum = np.concatenate([[0.], np.cumsum(x)])
+            return cumsum[window:] - cumsum[:-window]
+        count, total, total_squares = rolling_sum(valid.astype(np.float64)), rolling_sum(values), rolling_sum(values ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(total_squares - count * mean ** 2, 0.) / (count - 1))
+            sharpe = np.where(count > 1, mean / std * self.periods_per_year ** 0.5, np.nan)
+        return pd.Series(np.concatenate([np.full(min(window - 1, len(returns)), np.nan), sharpe]), index=self.dates,
+                         name='rolling_sharpe')
+
+    def get_summary(self, verbose=True) -> pd.Series:
+        """
+        Performance statistics of the net returns, plus the benchmark-relative ones if a benchmark is given:
+        年化收益率(annualized return), 年化波动率(annualized volatility), 夏普比率(Sharpe ratio, with a zero risk-free rate),
+        最大回撤(maximum drawdown), 最长回撤期数(longest drawdown in periods), 胜率(proportion of positive periods),
+        平均换手率(average turnover), 年化交易成本(annual transaction costs), 年化超额收益率(annualized excess return),
+        跟踪误差(annualized tracking error), 信息比率(information ratio), 超额胜率(proportion of periods beating the benchmark)
+        and beta.
+        """
+        net_returns = self.net_returns.dropna()
+        annual_return = self.annualize_return(net_returns)
+        annual_volatility = self.annualize_volatility(net_returns)
+        summary = {
+            '年化收益率': annual_return,
+            '年化波动率': annual_volatility,
+            '夏普比率': net_returns.mean() / net_returns.std() * self.periods_per_year ** 0.5,
+            '最大回撤': -self.drawdown.min(),
+            '最长回撤期数': self.max_drawdown_duration(),
+            '胜率': (net_returns > 0).mean(),
+            '平均换手率': self.turnover.mean(),
+            '年化交易成本': self.costs.mean() * self.periods_per_year,
+        }
+        if self.benchmark_returns is not None:
+            excess_returns = self.excess_returns.dropna()
+            tracking_error = self.annualize_volatility(excess_returns)
+            summary.update({
+                '年化超额收益率': self.relative_nav.iloc[-1] ** (self.periods_per_year / len(self.dates)) - 1,
+                '跟踪误差': tracking_error,
+                '信息比率': excess_returns.mean() * self.periods_per_year / tracking_error,
+                '超额胜率': (excess_returns > 0).mean(),
+                'beta': self.net_returns.cov(self.benchmark_returns) / self.benchmark_returns.var(),
+            })
+        summary = pd.Series(summary, name='backtest')
+        if verbose:
+            print(summary.to_string(float_format='{:0.4f}'.format))
+            print()
+        return summary
+
+    def to_frame(self) -> pd.DataFrame:
+        """all the per-period series in one dataframe, indexed by rebalancing date"""
+        series = [self.returns, self.turnover, self.costs, self.net_returns, self.nav, self.drawdown]
+        if self.benchmark_returns is not None:
+            series += [self.benchmark_returns, self.benchmark_nav, self.excess_returns, self.relative_nav]
+        return pd.concat(series, axis=1)
+
+    def get_graph(self, title='Backtest'):
+        """net asset value(with the benchmark's if given) above the drawdown"""
+        import matplotlib.pyplot as plt
+        fig, (ax_nav, ax_drawdown) = plt.subplots(2, 1, sharex=True, figsize=(10, 6), gridspec_kw={'height_ratios': [3, 1]})
+        self.nav.plot(ax=ax_nav, label='portfolio', title=title)
+        if self.benchmark_returns is not None:
+            self.benchmark_nav.plot(ax=ax_nav, label='benchmark')
+            self.relative_nav.plot(ax=ax_nav, label='relative')
+        ax_nav.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        self.drawdown.plot(ax=ax_drawdown, kind='area', color='tab:red', alpha=0.4, label='drawdown')
+        ax_drawdown.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        return fig
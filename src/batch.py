@@ -0,0 +1,229 @@
+"""
+Headless batch runner of single factor studies.
+
+Usage(from the project root, or with --data-root pointing at it):
+    python -m src.batch study.json --backend process --workers 8
+
+A study spec is a JSON file(or a dict) such as
+    {
+        "name": "nightly_screen",
+        "style_factor_dict": {"value": ["pe_ratio_ttm", "pb_ratio_ttm"], "growth": ["inc_revenue_ttm"]},
+        "tests": ["ic", "t", "hier"],
+        "universe": ["not_st", "not_suspended", ["min_listing_days", {"days": 365.2425}]],
+        "start_date": "2015-01-01",
+        "end_date": "2020-12-31",
+        "num_groups": 5
+    }
+where only "style_factor_dict" is required. Tests are "ic"(ICTester), "t"(TTester) and "hier"(HierBackTester), all of
+them by default. The universe and the calendar default to the ones of TimeAndStockFilter.
+
+The study is split into one task per factor. The backtesting panel is built once and cached by src/pipeline.py before
+the tasks start, so each task only loads it, loads its factor and runs the tests; the factor and test outputs are
+cached too, so a nightly run only recomputes factors whose data changed. Tasks run on one of the backends
+    serial:   in this process
+    process:  on a local process pool
+    dask:     on a dask.distributed cluster. --scheduler local starts a local cluster, otherwise pass the address of a
+              running scheduler, e.g. tcp://10.0.0.1:8786. The workers need this repo on their python path and the data
+              folder and pipeline cache under the same paths, e.g. on a shared file system.
+All results are collected into one HDF5 file, with a JSON manifest of the run next to it.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import pandas as pd
+
+ALL_TESTS = ['ic', 't', 'hier']
+
+def load_study_spec(spec) -> dict:
+    """read a study spec from a JSON file(or copy a dict), filling in the defaults"""
+    if isinstance(spec, str):
+        with open(spec) as file:
+            spec = json.load(file)
+    spec = dict(spec)
+    if 'style_factor_dict' not in spec:
+        raise Exception("The study spec must have a 'style_factor_dict'!")
+    spec.setdefault('name', 'study')
+    spec.setdefault('tests', ALL_TESTS)
+    invalid_tests = [test for test in spec['tests'] if test not in ALL_TESTS]
+    if invalid_tests:
+        raise Exception(f"{invalid_tests} are not valid tests! Choose from {ALL_TESTS}")
+    for key in ['universe', 'start_date', 'end_date']:
+        spec.setdefault(key, None)
+    spec.setdefault('num_groups', 5)
+    return spec
+
+def universe_definition(spec: dict):
+    """the universe of a spec as the tuple expected by src/universe.py, JSON has lists instead of tuples"""
+    if spec['universe'] is None:
+        return None
+    return tuple(condition if isinstance(condition, str) else (condition[0], dict(condition[1])) for condition in spec['universe'])
+
+def study_pipeline(spec: dict, style_factor_dict: dict, cache_dir: str):
+    from src.pipeline import build_pipeline
+    pipeline = build_pipeline(style_factor_dict, universe_definition=universe_definition(spec), start_date=spec['start_date'],
+                              end_date=spec['end_date'], num_groups=spec['num_groups'], cache_dir=cache_dir)
+    pipeline.verbose = False
+    return pipeline
+
+def split_tasks(spec: dict, data_root: str, cache_dir: str) -> list:
+    """one task per factor of the study"""
+    return [{'spec': spec, 'factor_type': factor_type, 'factor': factor, 'data_root': data_root, 'cache_dir': cache_dir}
+            for factor_type, factors in spec['style_factor_dict'].items() for factor in factors]
+
+def summarize(test: str, factor: str, output, num_groups: int) -> pd.Series:
+    """the summary statistics of a test output, computed by the tester that produced it"""
+    from src.single_factor import TTester, ICTester, HierBackTester
+    if test == 'ic':
+        tester = ICTester()
+        tester.ic_series = output
+    elif test == 't':
+        tester = TTester()
+        tester.tval_coef = output
+    else:
+        tester = HierBackTester(num_groups=num_groups)
+        tester.group_returns = output
+    tester.curr_tested_factor = factor
+    summary = tester.get_summary(verbose=False)
+    if test == 't':
+        # (metrics x factor) of the t-test as one row
+        summary = summary[factor]
+    elif isinstance(summary, pd.DataFrame):
+        # (metrics x groups) of the hierarchical backtest as one row
+        summary = summary.unstack()
+        summary.index = [f'{group}/{metric}' for group, metric in summary.index]
+    return summary.rename(factor)
+
+def run_factor_task(task: dict) -> dict:
+    """
+    Run the tests of one factor. It runs in the worker processes, so it takes and returns plain picklable values and
+    catches its own errors, which are reported in the manifest instead of stopping the other tasks.
+    """
+    # src.constants reads the data folder relative to the working directory on import
+    os.chdir(task['data_root'])
+    from src.profiler import PROFILER
+    PROFILER.verbose = False
+    spec, factor = task['spec'], task['factor']
+    result = {'factor': factor, 'factor_type': task['factor_type'], 'outputs': {}, 'summaries': {}, 'error': None}
+    start = time.perf_counter()
+    try:
+        pipeline = study_pipeline(spec, {task['factor_type']: [factor]}, task['cache_dir'])
+        for test in spec['tests']:
+            output = pipeline.get(f'{test}:{factor}')
+            result['outputs'][test] = output
+            result['summaries'][test] = summarize(test, factor, output, spec['num_groups'])
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_tasks(tasks: list, backend='process', num_workers=None, scheduler=None) -> list:
+    """
+    Args:
+        tasks (list): the tasks of split_tasks
+        backend (str, optional): 'serial', 'process' or 'dask'. Defaults to 'process'.
+        num_workers (int, optional): number of worker processes, all cores by default. Defaults to None.
+        scheduler (str, optional): for the dask backend, 'local' or the address of a running scheduler. Defaults to None.
+    """
+    if backend == 'serial':
+        return [run_factor_task(task) for task in tasks]
+    if backend == 'process':
+        # unlike the pathos pools, the workers of concurrent.futures are not daemonic(python 3.9+), so the stages
+        # they run may start process pools of their own
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(num_workers) as executor:
+            return list(executor.map(run_factor_task, tasks))
+    if backend == 'dask':
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError:
+            raise Exception("The dask backend needs dask.distributed, install it with `pip install \"dask[distributed]\"`")
+        cluster = None
+        if scheduler in (None, 'local'):
+            cluster = LocalCluster(n_workers=num_workers, threads_per_worker=1, processes=True)
+            client = Client(cluster)
+        else:
+            client = Client(scheduler)
+        try:
+            return client.gather(client.map(run_factor_task, tasks, pure=False))
+        finally:
+            client.close()
+            if cluster is not None:
+                cluster.close()
+    raise Exception(f"'{backend}' is not a valid backend! Choose from ['serial', 'process', 'dask']")
+
+def save_results(results: list, path: str) -> dict:
+    """
+    Collect the task results into one HDF5 file:
+        summary/<test>: one row per factor
+        ic: IC series, one column per factor
+        t_value, factor_return: from the t-tests, one column per factor
+        hier/<factor>: group returns of the hierarchical backtest
+    Returns:
+        dict: the failed factors and their tracebacks
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    succeeded = [result for result in results if result['error'] is None]
+    failures = {result['factor']: result['error'] for result in results if result['error'] is not None}
+    tests = sorted({test for result in succeeded for test in result['outputs']})
+    with pd.HDFStore(path, mode='w') as store:
+        for test in tests:
+            store.put(f'summary/{test}', pd.DataFrame([result['summaries'][test] for result in succeeded if test in result['summaries']]))
+        if 'ic' in tests:
+            store.put('ic', pd.concat({result['factor']: result['outputs']['ic'] for result in succeeded}, axis=1))
+        if 't' in tests:
+            store.put('t_value', pd.concat({result['factor']: result['outputs']['t']['t_value'] for result in succeeded}, axis=1))
+            store.put('factor_return', pd.concat({result['factor']: result['outputs']['t']['coef'] for result in succeeded}, axis=1))
+        if 'hier' in tests:
+            for result in succeeded:
+                store.put(f"hier/{result['factor']}", result['outputs']['hier'])
+    return failures
+
+def run_study(spec, backend='process', num_workers=None, scheduler=None, data_root='.', cache_dir=None, out=None) -> dict:
+    """
+    Run a study and save its results, see the module docstring.
+
+    Returns:
+        dict: the manifest of the run, also saved next to the results
+    """
+    spec = load_study_spec(spec)
+    data_root = os.path.abspath(data_root)
+    cache_dir = os.path.abspath(cache_dir or os.path.join(data_root, 'data', 'pipeline_cache'))
+    out = os.path.abspath(out or os.path.join(data_root, 'data', 'batch_results', f"{spec['name']}.h5"))
+    os.chdir(data_root)
+    start = time.perf_counter()
+    # build(or check) the cached panel once, instead of in every task
+    study_pipeline(spec, spec['style_factor_dict'], cache_dir).version('panel')
+    tasks = split_tasks(spec, data_root, cache_dir)
+    results = run_tasks(tasks, backend=backend, num_workers=num_workers, scheduler=scheduler)
+    failures = save_results(results, out)
+    manifest = {'spec': spec, 'backend': backend, 'results': out, 'seconds': time.perf_counter() - start,
+                'task_seconds': {result['factor']: result['seconds'] for result in results}, 'failures': failures}
+    with open(os.path.splitext(out)[0] + '.json', 'w') as file:
+        json.dump(manifest, file, indent=2, ensure_ascii=False)
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a single factor study on a process pool or a dask cluster.')
+    parser.add_argument('spec', help='path of the JSON study spec')
+    parser.add_argument('--backend', default='process', choices=['serial', 'process', 'dask'])
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, all cores by default')
+    parser.add_argument('--scheduler', default=None, help="dask backend only: 'local' or the address of a running scheduler")
+    parser.add_argument('--data-root', default='.', help='project root containing the data folders')
+    parser.add_argument('--cache-dir', default=None, help='pipeline cache, <data-root>/data/pipeline_cache by default')
+    parser.add_argument('--out', default=None, help='results file, <data-root>/data/batch_results/<name>.h5 by default')
+    args = parser.parse_args(argv)
+
+    spec_path = os.path.abspath(args.spec)
+    manifest = run_study(spec_path, backend=args.backend, num_workers=args.workers, scheduler=args.scheduler,
+                         data_root=args.data_root, cache_dir=args.cache_dir, out=args.out)
+    num_tasks = len(manifest['task_seconds'])
+    print(f"{num_tasks - len(manifest['failures'])}/{num_tasks} factors done in {manifest['seconds']:.1f}s, results saved to {manifest['results']}")
+    for factor, error in manifest['failures'].items():
+        print(f'\n{factor} failed:\n{error}')
+    return 1 if manifest['failures'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,7 @@ import pathos
 from src.constants import *
 from concurrent.futures import ThreadPoolExecutor
 from src.utils import *
+from src.downloader import FactorDownloadScheduler
 
 # Use rq_crendential.json to fill out Ricequant credentials
 # WARNING: MAKE SURE rq_crendential.json ARE NOT COMMITTED TO GITHUB
@@ -144,7 +145,7 @@ def load_industry_mapping():
         # Extract industry mapping data from ricequant if it's not on the local computer.
         # Extracting from ricequant is quite time consuming. Alternaively, you can download the data from the 
         # cloud folder
-        indus_to_stock = {industry: rq.industry(industry) for industry in industry_codes}
+        indus_to_stock = dict(zip(industry_codes, FactorDownloadScheduler(api=rq).map_calls('industry', industry_codes)))
         stock_to_indus = {}
         for indus, stock_names in indus_to_stock.items():
             for stock in stock_names:
@@ -188,11 +189,11 @@ def load_st_data(stock_names, dates) -> pd.DataFrame:
     name = 'is_st'
     #if the dataframe is not stored in the local folder then we fetch it first
     if not os.path.exists('./Data/raw_data/is_st.h5'):
-        df_is_st = rq.is_st_stock(stock_names, START_DATE, END_DATE).stack()
+        df_is_st = FactorDownloadScheduler(api=rq).download_flags('is_st_stock', stock_names, START_DATE, END_DATE).stack()
         df_is_st.to_hdf('./Data/raw_data/is_st.h5', key=name)
     #load the dataframe
     df_is_st = pd.read_hdf('./Data/raw_data/is_st.h5', key=name).rename(name)
-    # df_is_st = df_is_st[df_is_st.index.get_level_values(1).isin(stock_names) & df_is_st.index.get_level_values(0).isin(dates)]
+    df_is_st = df_is_st[df_is_st.index.get_level_values(1).isin(stock_names) & df_is_st.index.get_level_values(0).isin(dates)]
     return df_is_st
 
 def load_suspended_data(stock_names, dates):
@@ -203,7 +204,7 @@ def load_suspended_data(stock_names, dates):
     name = 'is_suspended'
     #if the dataframe is not stored in the local folder then we fetch it first
     if not os.path.exists('./Data/raw_data/is_suspended.h5'):
-        df_is_suspended = rq.is_suspended(stock_names, START_DATE, END_DATE).stack()
+        df_is_suspended = FactorDownloadScheduler(api=rq).download_flags('is_suspended', stock_names, START_DATE, END_DATE).stack()
         df_is_suspended.to_hdf('./Data/raw_data/is_suspended.h5', key=name)
     #load the dataframe
     df_is_suspended = pd.read_hdf('./Data/raw_data/is_suspended.h5', key=name).rename(name)
@@ -242,10 +243,13 @@ def load_index_data(index_code='sh000300'):
     ((df_index['CSI_300_change'] + 1).cumprod() - 1).plot()
     return df_index
 
-def download_factor_data(stock_names: np.array, factor_name: str, startdate: str, enddate: str) -> None:
-    for stock in stock_names:
-        if not os.path.exists(f"./Data/factor/{factor_name}.h5"):
-            factor_frame = rq.get_factor(stock_names, factor_name, startdate, enddate)
-            factor_frame.to_hdf(DATAPATH + f'factor/{factor_name}.h5', key='factor')
-
-
+def download_factor_data(stock_names: np.array, factor_name: str, startdate: str, enddate: str, factor_type: str = None,
+                         scheduler: FactorDownloadScheduler = None) -> None:
+    """
+    Download a factor into the factor store, i.e. ./Data/factor/<factor_type>/<factor_name>.h5
+    The request is split into (stock chunk, date chunk) tasks that run concurrently and resume from their checkpoints
+    if the download is interrupted. Pass a scheduler to change the chunk sizes, concurrency or rate limit.
+    """
+    if scheduler is None:
+        scheduler = FactorDownloadScheduler(api=rq)
+    scheduler.download_factor(factor_name, stock_names, startdate, enddate, factor_type=factor_type)
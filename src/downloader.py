@@ -0,0 +1,188 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+import threading
+import collections
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from src.constants import *
+
+class RateLimiter:
+    """
+    A thread-safe rate limiter shared by all download threads.
+    Calls are spaced at least 1 / max_calls_per_second seconds apart, which is what Ricequant's quota cares about,
+    while the threads still overlap their waiting time on the network.
+    """
+    def __init__(self, max_calls_per_second=5.):
+        self.interval = 1. / max_calls_per_second if max_calls_per_second else 0.
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        # sleep outside the lock so that other threads can book their own slots
+        if wait > 0:
+            time.sleep(wait)
+
+# one unit of work: one factor for a chunk of stocks over a chunk of dates. chunk_id is a hash of the stocks and dates,
+# so a checkpoint is only reused by a task asking for exactly the same chunk
+DownloadTask = collections.namedtuple('DownloadTask', ['factor', 'chunk_id', 'stocks', 'start_date', 'end_date'])
+
+class FactorDownloadScheduler:
+    """
+    Downloads factor data from Ricequant by splitting each request into (factor, stock chunk, date chunk) tasks and running
+    them concurrently under a rate limit.
+
+    Every finished task is checkpointed under ./Data/factor/_partial/<factor>/<chunk_id>.pkl, so an interrupted download
+    resumes from the remaining tasks only, even if it is resumed with other stocks, dates or chunk sizes: chunks that
+    are not part of the new request are never read. Once all tasks of a factor are done, they are assembled and written
+    to the factor store, i.e. ./Data/factor/<factor type>/<factor>.h5, where add_factors reads them, and all the
+    checkpoints of the factor are deleted.
+
+    The Ricequant API is passed in as 'api' and only needs get_factor/industry/is_st_stock/is_suspended with
+    rqdatac's signatures, so any local object mimicking them can stand in for rqdatac.
+    """
+    def __init__(self, api=None, stock_chunk_size=500, date_chunk_days=366, max_workers=8, max_calls_per_second=5.,
+                 max_retries=3, retry_wait=1., data_path=DATAPATH):
+        """
+        Args:
+            api (optional): the rqdatac module or a stub of it. Defaults to rqdatac.
+            stock_chunk_size (int, optional): number of stocks per request. Defaults to 500.
+            date_chunk_days (int, optional): number of calendar days per request. Defaults to 366.
+            max_workers (int, optional): number of concurrent requests. Defaults to 8.
+            max_calls_per_second (float, optional): rate limit over all threads. Defaults to 5.
+            max_retries (int, optional): number of retries of a failed request, with exponential backoff. Defaults to 3.
+            retry_wait (float, optional): seconds to wait before the first retry. Defaults to 1.
+            data_path (str, optional): root of the data folder. Defaults to DATAPATH.
+        """
+        if api is None:
+            import rqdatac as api
+        self.api = api
+        self.stock_chunk_size = stock_chunk_size
+        self.date_chunk_days = date_chunk_days
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(max_calls_per_second)
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.data_path = data_path
+
+    def factor_store_path(self, factor: str, factor_type: str = None) -> str:
+        return os.path.join(self.data_path, 'factor', factor_type or '', factor + '.h5')
+
+    def partial_folder(self, factor: str) -> str:
+        return os.path.join(self.data_path, 'factor', '_partial', factor)
+
+    def make_chunks(self, stock_names, start_date, end_date) -> list:
+        """Split the request into a list of (stock chunk, start date, end date) tuples"""
+        stock_names = list(stock_names)
+        stock_chunks = [stock_names[i: i + self.stock_chunk_size] for i in range(0, len(stock_names), self.stock_chunk_size)]
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        date_starts = pd.date_range(start_date, end_date, freq=f'{self.date_chunk_days}D')
+        date_chunks = [(start, min(start + pd.Timedelta(days=self.date_chunk_days - 1), end_date)) for start in date_starts]
+        return [(stocks, start, end) for stocks in stock_chunks for start, end in date_chunks]
+
+    @staticmethod
+    def chunk_id(stocks, start_date: str, end_date: str) -> str:
+        key = json.dumps([list(stocks), start_date, end_date])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def make_tasks(self, factor: str, stock_names, start_date, end_date) -> list:
+        tasks = []
+        for stocks, start, end in self.make_chunks(stock_names, start_date, end_date):
+            start, end = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+            tasks.append(DownloadTask(factor, self.chunk_id(stocks, start, end), stocks, start, end))
+        return tasks
+
+    def call(self, func_name: str, *args, **kwargs):
+        """Call the api under the rate limit, retrying with exponential backoff"""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                return getattr(self.api, func_name)(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"{func_name} failed with '{e}', retrying ({attempt + 1}/{self.max_retries})")
+                time.sleep(self.retry_wait * 2 ** attempt)
+
+    def _checkpoint_path(self, task: DownloadTask) -> str:
+        return os.path.join(self.partial_folder(task.factor), f'{task.chunk_id}.pkl')
+
+    def _run_task(self, task: DownloadTask):
+        df_chunk = self.call('get_factor', task.stocks, task.factor, task.start_date, task.end_date)
+        # rqdatac returns None when there is no data for the chunk
+        if df_chunk is None:
+            df_chunk = pd.DataFrame()
+        # write to a temporary file first so that a half-written checkpoint is never mistaken for a finished one
+        path = self._checkpoint_path(task)
+        df_chunk.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def download_factors(self, factor_names, stock_names, start_date=START_DATE, end_date=END_DATE, factor_type: str = None,
+                         overwrite=False) -> list:
+        """
+        Download several factors at once. Tasks of all factors share the same thread pool and rate limit.
+
+        Returns:
+            list: the paths of the factor files in the factor store
+        """
+        factor_names = [factor for factor in factor_names
+                        if overwrite or not os.path.exists(self.factor_store_path(factor, factor_type))]
+        tasks = []
+        for factor in factor_names:
+            # checkpoints left over by an earlier download are not reused when overwriting
+            if overwrite and os.path.exists(self.partial_folder(factor)):
+                shutil.rmtree(self.partial_folder(factor))
+            os.makedirs(self.partial_folder(factor), exist_ok=True)
+            # resume: tasks with an existing checkpoint are already done
+            tasks += [task for task in self.make_tasks(factor, stock_names, start_date, end_date)
+                      if not os.path.exists(self._checkpoint_path(task))]
+        print(f"{len(tasks)} download tasks remaining for {len(factor_names)} factors")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # list() re-raises the first exception of any task, after the other tasks have been checkpointed
+            list(executor.map(self._run_task, tasks))
+        return [self.assemble(factor, stock_names, start_date, end_date, factor_type) for factor in factor_names]
+
+    def download_factor(self, factor_name: str, stock_names, start_date=START_DATE, end_date=END_DATE, factor_type: str = None,
+                        overwrite=False) -> str:
+        self.download_factors([factor_name], stock_names, start_date, end_date, factor_type, overwrite)
+        return self.factor_store_path(factor_name, factor_type)
+
+    def assemble(self, factor: str, stock_names, start_date, end_date, factor_type: str = None) -> str:
+        """Concatenate the checkpointed chunks of a factor, write them to the factor store and delete the checkpoints"""
+        tasks = self.make_tasks(factor, stock_names, start_date, end_date)
+        df_factor = pd.concat([pd.read_pickle(self._checkpoint_path(task)) for task in tasks], axis=0).sort_index()
+        path = self.factor_store_path(factor, factor_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df_factor.to_hdf(path + '.tmp', key='factor')
+        os.replace(path + '.tmp', path)
+        shutil.rmtree(self.partial_folder(factor))
+        return path
+
+    def download_flags(self, func_name: str, stock_names, start_date=START_DATE, end_date=END_DATE) -> pd.DataFrame:
+        """
+        Concurrent version of the (dates x stocks) flag queries, e.g. api.is_st_stock and api.is_suspended.
+        Returns the same wide dataframe as a single call over all stocks and dates.
+        """
+        chunks = self.make_chunks(stock_names, start_date, end_date)
+        def get_chunk(chunk):
+            stocks, start, end = chunk
+            return self.call(func_name, stocks, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(get_chunk, chunks))
+        # stitch the stock chunks side by side within each date chunk, then stack the date chunks
+        df_by_dates = collections.defaultdict(list)
+        for (stocks, start, end), df_chunk in zip(chunks, results):
+            if df_chunk is not None:
+                df_by_dates[start].append(df_chunk)
+        return pd.concat([pd.concat(df_by_dates[start], axis=1) for start in sorted(df_by_dates)], axis=0)
+
+    def map_calls(self, func_name: str, args: list) -> list:
+        """Concurrently call api.<func_name>(arg) for each arg, e.g. api.industry for every industry code"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda arg: self.call(func_name, arg), args))
@@ -7,21 +7,155 @@ import src.dataloader as dl
 from src.constants import *
 from src.utils import *
 from src.preprocess import *
+from src.panel import date_segments, assign_columns, panel_fingerprint, get_segment_index
+from src.precision import accumulate, to_storage
+from src.single_factor import TTester, ICTester
+from src.neutralization import neutralize
+import src.kernels as kernels
 
 import statsmodels as sm
 import numpy as np
 import scipy
-import seaborn as sns
 from tqdm.notebook import tqdm
 import multiprocessing
 import pickle
-import matplotlib.pyplot as plt
+import hashlib
 from collections import Iterable
 
+def get_segment_gram(X: np.ndarray, offsets: np.ndarray, Y: np.ndarray=None) -> np.ndarray:
+    """
+    Gram matrices X_t.T @ X_t(or X_t.T @ Y_t) of the factor exposures on each rebalancing date, computed segment by segment
+    on the date-sorted exposure matrix without building any per-date dataframe.
+
+    Args:
+        X (np.ndarray): N x K exposure matrix of the whole panel, sorted by date
+        offsets (np.ndarray): the rows of date t are X[offsets[t]: offsets[t + 1]], see src.panel.date_segments
+        Y (np.ndarray, optional): N x K matrix aligned with X. Defaults to X.
+
+    Returns:
+        np.ndarray: T x K x K tensor
+    """
+    Y = X if Y is None else Y
+    return np.stack([X[start: end].T @ Y[start: end] for start, end in zip(offsets[:-1], offsets[1:])])
+
+def get_segment_corr(X: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation matrices of the factor exposures on each rebalancing date, with missing values handled pairwise
+    like pd.DataFrame.corr, i.e. the correlation of factors i and j uses the stocks where both are available.
+
+    All the pairwise sums(counts, sums, sums of squares and cross products over the common stocks) are Gram matrices
+    of the exposures and of their missing value mask, so the whole tensor takes four segmented Gram passes.
+
+    Returns:
+        np.ndarray: T x K x K tensor, NaN where fewer than 2 stocks have both factors
+    """
+    X = X.copy()
+    # center each segment first to limit the cancellation in sum of squares - squared sum
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        if end > start:
+            X[start: end] -= np.nanmean(X[start: end], axis=0)
+    mask = (~np.isnan(X)).astype(np.float64)
+    X = np.nan_to_num(X)
+    count = get_segment_gram(mask, offsets)
+    # sums[t, i, j]: the sum of factor i over the stocks of date t where both factors i and j are available
+    sums = get_segment_gram(X, offsets, mask)
+    squares = get_segment_gram(X ** 2, offsets, mask)
+    products = get_segment_gram(X, offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = products - sums * sums.transpose(0, 2, 1) / count
+        var = squares - sums ** 2 / count
+        corr = cov / np.sqrt(var * var.transpose(0, 2, 1))
+    corr[count < 2] = np.nan
+    return np.clip(corr, -1., 1.)
+
+# correlation tensors of previous runs, keyed by the version of the panel they were computed on
+_CORR_TENSOR_CACHE = {}
+_CORR_TENSOR_CACHE_SIZE = 8
+
+def get_factor_corr_tensor(df_backtest: pd.DataFrame, factors) -> tuple:
+    """
+    Cached version of get_segment_corr on the given factors of the backtesting dataframe. Combinations run on the same
+    panel(e.g. with different hist_periods) reuse the tensor as long as the factor values and the rows are unchanged.
+
+    Returns:
+        tuple: (dates, T x K x K correlation tensor)
+    """
+    key = panel_fingerprint(df_backtest, factors)
+    if key not in _CORR_TENSOR_CACHE:
+        dates, offsets = date_segments(df_backtest)
+        if len(_CORR_TENSOR_CACHE) >= _CORR_TENSOR_CACHE_SIZE:
+            _CORR_TENSOR_CACHE.pop(next(iter(_CORR_TENSOR_CACHE)))
+        _CORR_TENSOR_CACHE[key] = (dates, get_segment_corr(accumulate(df_backtest[list(factors)]), offsets))
+    return _CORR_TENSOR_CACHE[key]
+
+def rolling_mean_cov(values: np.ndarray, window: int, min_periods=1) -> tuple:
+    """
+    Means and covariance matrices over the last 'window' rows(fewer on the first rows), from cumulative sums of the values
+    and of their cross products. Missing values are handled like df.rolling(window, min_periods).mean() and .cov(),
+    i.e. the covariance of columns i and j uses the rows where both are available.
+    The sums are recomputed on each call, which is O(T x K^2) and negligible next to the weight optimization, but the
+    result of a row only depends on the rows up to it: appending a row leaves the statistics of the earlier rows
+    unchanged to the bit, so the weights optimized on them can be read back from a StatStore.
+
+    Args:
+        values (np.ndarray): T x K, e.g. the IC series of K factors
+        window (int): number of rows in the window
+        min_periods (int, optional): minimum number of available rows, otherwise the statistics are NaN. Defaults to 1.
+
+    Returns:
+        tuple: (T x K means, T x K x K covariance matrices), NaN where fewer than min_periods(and for covariances, 2)
+               rows are available
+    """
+    valid = ~np.isnan(values)
+    # center the values first to limit the cancellation in sum of squares - squared sum. The center is the first available
+    # value of each column rather than the mean, which would change with every appended row
+    first = np.argmax(valid, axis=0)
+    center = np.where(valid.any(axis=0), values[first, np.arange(values.shape[1])], 0.)
+    X = np.where(valid, values - center, 0.)
+    mask = valid.astype(np.float64)
+
+    def window_sums(a):
+        cumsum = np.concatenate([np.zeros((1, ) + a.shape[1:]), np.cumsum(a, axis=0)])
+        end = np.arange(1, a.shape[0] + 1)
+        return cumsum[end] - cumsum[np.maximum(end - window, 0)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means_count = window_sums(mask)
+        means = np.where(means_count >= min_periods, window_sums(X) / means_count + center, np.nan)
+        count = window_sums(mask[:, :, np.newaxis] * mask[:, np.newaxis, :])
+        # sums[t, i, j]: the sum of column i over the rows of the window where both columns i and j are available
+        sums = window_sums(X[:, :, np.newaxis] * mask[:, np.newaxis, :])
+        products = window_sums(X[:, :, np.newaxis] * X[:, np.newaxis, :])
+        cov = (products - sums * sums.transpose(0, 2, 1) / count) / (count - 1)
+    cov[count < max(min_periods, 2)] = np.nan
+    return means, cov
+
+def combine_by_segments(X: np.ndarray, offsets: np.ndarray, W: np.ndarray) -> np.ndarray:
+    """
+    Combined factors of one or several weightings: the rows of date t are multiplied by the weight vectors of date t,
+    without repeating the weights on every stock row.
+
+    Args:
+        X (np.ndarray): N x K exposure matrix of the whole panel, sorted by date
+        offsets (np.ndarray): the rows of date t are X[offsets[t]: offsets[t + 1]], see src.panel.date_segments
+        W (np.ndarray): T x K x M weights of M weightings on each date. NaN weights give NaN combined factors.
+
+    Returns:
+        np.ndarray: N x M matrix of combined factors, NaN wherever one of the factors is missing
+    """
+    combined = np.empty((X.shape[0], W.shape[2]))
+    for t, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        combined[start: end] = X[start: end] @ W[t]
+    return combined
+
 class FactorCombinator:
     """
     A superclass for all factor combination methods
     """
+    # combination methods whose weights can be negative(e.g. PCA loadings) set this to True. Their weights are then
+    # normalized so that their absolute values add up to 1
+    allow_negative_weights = False
+
     def __init__(self, factors: Iterable, factor_type:str,  df_backtest:pd.DataFrame, standardize_factors=False,):
         """_summary_
 
@@ -49,7 +183,7 @@ class FactorCombinator:
         """
         self.df_backtest = add_factors(self.df_backtest, {self.factor_type: self.factors} )
         if self.standardize_factors:
-            self.df_backtest = standardize_factors(self.df_backtest, self.factors)
+            self.df_backtest = standardize_factors(self.df_backtest, self.factors, inplace=True)
 
     def get_factor_weights(self, ):
         """
@@ -57,26 +191,49 @@ class FactorCombinator:
         """
         pass
 
+    def check_factor_weights(self, df_factor_weights: pd.DataFrame):
+        if self.allow_negative_weights:
+            #the absolute values of the factor weights must add up to 1
+            assert( (df_factor_weights.loc[:, self.weight_cols].abs().sum(axis=1) - 1.).abs() < 1e-6 ).all()
+        else:
+            #the factor weights must be non-negative
+            assert( (df_factor_weights.loc[:, self.weight_cols] >= 0).all().all() )
+            #the factor weights must add up to 1
+            assert( (df_factor_weights.loc[:, self.weight_cols].sum(axis=1) - 1.).abs() < 1e-6 ).all()
+
     @timer
-    def combine_factors(self, df_factor_weights: pd.DataFrame):
+    def combine_factors(self, df_factor_weights, combined_col='combined_factor') -> pd.DataFrame:
         """
         Combine the factors according to given factor weights
 
+        The weight vector of each rebalancing date is applied to the block of rows of that date, so the weights are never
+        merged onto the backtesting dataframe. Several candidate weightings can be combined in one call for comparison, e.g.
+            combinator.combine_factors({'combined_ic': df_ic_weights, 'combined_pca': df_pca_weights})
+
         Args:
-            df_factor_weights (pd.DataFrame): This dataframe gives the factor weights
+            df_factor_weights (pd.DataFrame or dict): This dataframe gives the factor weights, or a dict of such dataframes
+                                              keyed by the name of their combined factor column.
                                               Its index should be a subset of the rebalancing dates in self.df_backtest
                                               It must contain all columns in self.weight_cols
-                                              The factor weights in each row should be non-negative and add up to 1.
+                                              The factor weights in each row should be non-negative and add up to 1,
+                                              or have absolute values adding up to 1 if self.allow_negative_weights.
+                                              Combined factors are NaN on dates without weights.
+            combined_col (str, optional): the name of the combined factor column when a single dataframe is given.
+                                          Defaults to 'combined_factor'.
+
+        Returns:
+            pd.DataFrame: the combined factor column(s), which are also added to self.df_backtest
         """
-        #the factor weights must be non-negative
-        assert( (df_factor_weights.loc[:, self.weight_cols] >= 0).all().all() )
-        #the factor weights must add up to 1
-        assert( (df_factor_weights.loc[:, self.weight_cols].sum(axis=1) - 1.).abs() < 1e-6 ).all()
-        #merge the weights to the backtesting dataframe
-        self.df_backtest = self.df_backtest.merge(df_factor_weights.loc[:, self.weight_cols], how='left', left_on='date', right_index=True)
-        #vectorized multiplication
-        self.df_backtest['combined_factor'] = (self.df_backtest[self.factors].values * self.df_backtest[self.weight_cols].values).sum(axis=1)
-        
+        weightings = df_factor_weights if isinstance(df_factor_weights, dict) else {combined_col: df_factor_weights}
+        dates, offsets = date_segments(self.df_backtest)
+        W = np.empty((len(dates), self.num_factors, len(weightings)))
+        for m, df_weights in enumerate(weightings.values()):
+            self.check_factor_weights(df_weights)
+            W[:, :, m] = accumulate(df_weights.loc[:, self.weight_cols].reindex(dates))
+        combined = combine_by_segments(accumulate(self.df_backtest[self.factors]), offsets, W)
+        assign_columns(self.df_backtest, list(weightings), to_storage(combined))
+        return self.df_backtest[list(weightings)]
+
     def run(self, ) -> pd.DataFrame:
         """
         the main function in this class with the following steps:
@@ -91,7 +248,7 @@ class FactorCombinator:
         self.preprocess_dataset()
         df_factor_weights = self.get_factor_weights()
         self.combine_factors(df_factor_weights)
-        return self.df_backtest.drop(columns=self.weight_cols)
+        return self.df_backtest
 
 class FactorCombinatorUniform(FactorCombinator):
     """
@@ -109,63 +266,55 @@ class FactorCombinator_Max_IC_or_ICIR(FactorCombinator):
 
     For detailed calculation formulas， see Huatai MultiFactor Report #10 华泰金工多因子系列之十：因子合成方法实证分析 
     """
-    def __init__(self, hist_periods:int=12, max_what='ICIR', *args, **kwargs):
+    def __init__(self, hist_periods:int=12, max_what='ICIR', *args, stat_store=None, **kwargs):
+        """
+        Args:
+            stat_store (StatStore, optional): if given, the ICs of the dates computed before are read back from it and
+                only new or changed dates are computed, see src/stat_store.py. Defaults to None.
+        """
         super().__init__(*args, **kwargs)
         # choose 12 months as the historical periods
         self.hist_periods = hist_periods
         self.max_what = max_what
+        self.stat_store = stat_store
 
     @timer 
     def get_ic_series(self, ):
         """
         Sets and returns a dataframe of ic values for each factor. The dataframe uses rebalancing dates as index
         and factor names as columns.
-        Computes the IC values with multiprocessing.
+
+        IC value is calculated as the rank correlation between the factor residual and next period's return,
+        where factor residuals are defined as the residuals of linearly regressing the factor against market cap and industry factor,
+        weighted by the square root of market cap.
+
+        Factor residualization is a form of factor purification; the aim is to remove the factor's linear dependency on market factor and 
+        industry factor, exposing the factor's very original state. 
+
+        The residuals of all factors on all dates are computed in one pass with the industry projector of src/neutralization.py,
+        which replaces the smf.wls(f"{factor} ~ 0 + market_value + C({PRIMARY_INDUSTRY_COL})") fit per (date, factor) pair.
+
+        With a stat_store, each factor is only computed on the dates it has not been computed on before.
         """
-        def set_ic_value(df_sub: pd.DataFrame) -> float:
-            """
-            IC value is calculated as the rank correlation between the factor residual and next period's return,
-            where factor residuals are defined as the residuals of linearly regressing next period's return against market cap and industry factor.
-
-            Factor residualization is a form of factor purification; the aim is to remove the factor's linear dependency on market factor and 
-            industry factor, exposing the factor's very original state. 
-
-            Args:
-                df_sub (pd.DataFrame): a sub dataframe corresponding to a given factor and rebalancing date
-
-            Returns:
-                float: IC value
-            """
-            #The multiprocessing used takes forever, not sure why. I had to use for loop.
-            # 2022.02.27 Update by Polo:
-            # This was because I used nested processes -- I tried to parallelize both calls to 'get_ic_series'(factor level) and calls inside 'get_ic_series'(date level)
-            # Currently, the best solution I know is to flatten 'get_ic_series' into one level 
-            # i.e. make a new function 'get_ic_series' that takes both factor and date as inputs,
-            # then parallelize calls to this function. 
-            #TODO: use the shared_memory functionality developed in python 3.8 for multiple processes
-            #      otherwise each subprocess will make copies of original dataframe causing lots of unnecessary extra memory/overhead
-
-            factor = df_sub.columns[-1]
-            import statsmodels.formula.api as smf
-            # get factor residuals
-            factor_resid = smf.wls(formula = f"{factor} ~ 0 + market_value + C({PRIMARY_INDUSTRY_COL})", 
-                            data=df_sub, weights = df_sub['market_value'] ** 0.5).fit().resid
-            # get RankIC
-            ic_val = pd.concat([df_sub['next_period_return'], factor_resid], axis=1).corr(method='spearman').iloc[0, 1]
-            return ic_val
-
-        def get_df_sub(date, factor):
-            """
-            Return a sub-dataframe with columns of market_value, primary_industry, next_period_return, and the factor.
-            """
-            return self.df_backtest.loc[date, ['market_value', PRIMARY_INDUSTRY_COL, 'next_period_return'] + [factor]]
-
-        inputs = [(date, factor) for date in self.df_backtest.index.get_level_values(0).unique() for factor in self.factors]
-        with pathos.multiprocessing.Pool(pathos.helpers.cpu_count()) as pool:
-            results = pool.map(set_ic_value, [get_df_sub(date, factor) for date, factor in inputs])
-        self.df_ic_series = pd.Series(results, index=pd.MultiIndex.from_tuples(inputs), ).unstack(level=1)
+        if self.stat_store is not None:
+            # 'wls_ic': these residuals are weighted, unlike the ones of ICTester
+            self.df_ic_series = pd.concat([
+                self.stat_store.update('wls_ic', factor, self.df_backtest,
+                                       [factor, 'next_period_return', 'market_value', PRIMARY_INDUSTRY_COL],
+                                       lambda df, factor=factor: self.compute_ic_series(df, [factor]))[factor]
+                for factor in self.factors], axis=1)
+        else:
+            self.df_ic_series = self.compute_ic_series(self.df_backtest, self.factors)
         return self.df_ic_series
 
+    def compute_ic_series(self, df: pd.DataFrame, factors) -> pd.DataFrame:
+        """RankIC of the residuals of the given factors on each date of the panel, see get_ic_series"""
+        df_resid = neutralize(df, factors, PRIMARY_INDUSTRY_COL, regressors=['market_value'], weights=df['market_value'] ** 0.5)
+        # get RankIC of each factor on each date
+        segment_index = get_segment_index(df_resid)
+        return pd.DataFrame(kernels.segment_rank_corr(df_resid.values, accumulate(df['next_period_return']), segment_index.offsets),
+                            index=segment_index.dates, columns=factors)
+
     @timer
     def get_factor_weights(self,) -> pd.DataFrame:
         """
@@ -189,35 +338,46 @@ class FactorCombinator_Max_IC_or_ICIR(FactorCombinator):
         #get IC dataframe of all factors at all rebalancing dates
         self.get_ic_series()
 
-        #mean IC of all factors within the historical time window
-        df_ic_hist_mean = self.df_ic_series.rolling(self.hist_periods, min_periods=1).mean().iloc[self.hist_periods:]
-        
-        if self.max_what == 'ICIR':
+        #mean IC of all factors within the historical time window, and their covariance matrix i.e. Sigma in the paper
+        #both from cumulative sums over the IC series, see rolling_mean_cov
+        ic_hist_mean, ic_hist_cov = rolling_mean_cov(accumulate(self.df_ic_series), self.hist_periods)
+        dates = self.df_ic_series.index[self.hist_periods:]
+        ic_means = ic_hist_mean[self.hist_periods:]
 
-            #covariance matrix of ICs of all factors i.e. Sigma in the paper
-            df_cov_mat_series = self.df_ic_series.rolling(self.hist_periods, min_periods=1).cov().iloc[self.hist_periods * self.num_factors:]
-            
-            #create an empty container for the optimized weights w, uniform IC values and 
-            self.df_opt_factor_weights = pd.DataFrame([], columns=self.weight_cols + ['uniform_ICIR', 'max_ICIR'])
+        if self.max_what == 'ICIR':
+            cov_mats = ic_hist_cov[self.hist_periods:]
 
         if self.max_what == 'IC':
-            #covariance/correlation matrix of factor values
-            
-            def corr(df):
-                return df.corr(method='pearson')
-
-            factor_df = self.df_backtest[self.factors]
-            dates = self.df_backtest.index.get_level_values(0).unique().tolist()
-
-            with pathos.multiprocessing.Pool(pathos.helpers.cpu_count()) as pool:
-                df_cov_mat_series = pd.concat(pool.map(corr, [factor_df.xs(date,level='date') for date in dates]), keys=dates)
-            
-            #create an empty container for the optimized weights w, uniform IC values and 
-            self.df_opt_factor_weights = pd.DataFrame([], columns=self.weight_cols + ['uniform_IC', 'max_IC'])
-        
-        for date in df_ic_hist_mean.index:
-            df_ic = df_ic_hist_mean.loc[date, :]
-            df_cov_mat = df_cov_mat_series[df_cov_mat_series.index.get_level_values(0) == date]
+            #covariance/correlation matrix of factor values on each date, computed once per panel version
+            cov_mat_dates, cov_mats = get_factor_corr_tensor(self.df_backtest, self.factors)
+            positions = cov_mat_dates.get_indexer(dates)
+            assert((positions >= 0).all())
+            cov_mats = cov_mats[positions]
+
+        if self.stat_store is not None:
+            # the weights of a date only depend on its IC means and covariance matrix, so only the dates whose inputs
+            # are new or changed are optimized, and the weights of the other dates are read back
+            hashes = [hashlib.sha1(ic_means[t].tobytes() + cov_mats[t].tobytes()).hexdigest()[:16] for t in range(len(dates))]
+            combination = hashlib.sha1(repr(list(self.factors)).encode()).hexdigest()[:16]
+            self.df_opt_factor_weights = self.stat_store.update_by_hash(
+                f'max_{self.max_what}_weights', combination, dates, hashes,
+                lambda dirty: self.optimize_weights(dates[dirty], ic_means[dirty], cov_mats[dirty]))
+        else:
+            self.df_opt_factor_weights = self.optimize_weights(dates, ic_means, cov_mats)
+        return self.df_opt_factor_weights[self.weight_cols]
+
+    def optimize_weights(self, dates: pd.Index, ic_means: np.ndarray, cov_mats: np.ndarray) -> pd.DataFrame:
+        """
+        Helper function for self.get_factor_weights
+        Solves the weights of each date from its mean ICs and covariance matrix
+
+        Returns:
+            pd.DataFrame: the optimized weights, and the objective with uniform and with optimized weights
+        """
+        #create an empty container for the optimized weights w, uniform IC values and 
+        df_opt_factor_weights = pd.DataFrame([], columns=self.weight_cols + [f'uniform_{self.max_what}', f'max_{self.max_what}'])
+
+        for date, ic_mean_values, cov_mat in zip(dates, ic_means, cov_mats):
             #print(f"ICIR with uniform weights: {get_ic_ir(uniform_weights)}")
 
             def get_ic_ir(factor_weights):
@@ -225,9 +385,9 @@ class FactorCombinator_Max_IC_or_ICIR(FactorCombinator):
                 return the objective function for optimization
                 """
                 # w.T * IC
-                ic_mean = factor_weights.transpose() @ df_ic.values.flatten()
+                ic_mean = factor_weights.transpose() @ ic_mean_values
                 # w.T * Sigma * w
-                ic_var = factor_weights @ df_cov_mat.values @ factor_weights.transpose()
+                ic_var = factor_weights @ cov_mat @ factor_weights.transpose()
                 return ic_mean / (ic_var ** 0.5)
 
             #optimization step with a constraint that all weights are non-negative
@@ -238,14 +398,56 @@ class FactorCombinator_Max_IC_or_ICIR(FactorCombinator):
                             constraints=({"type": "eq", "fun": lambda weight: np.sum(weight) - 1})
                         )
             #fill the optimized weight values into the container, by row
-            self.df_opt_factor_weights.loc[date, :] = list(opt_result.x) + [get_ic_ir(self.uniform_weights), get_ic_ir(opt_result.x)]
+            df_opt_factor_weights.loc[date, :] = list(opt_result.x) + [get_ic_ir(self.uniform_weights), get_ic_ir(opt_result.x)]
             #print(f"ICIR with optimal weights: {get_ic_ir(opt_factor_weight)}")
 
         #change all values as type float64    
-        self.df_opt_factor_weights = self.df_opt_factor_weights.astype('float64')
-        return self.df_opt_factor_weights[self.weight_cols]
+        return df_opt_factor_weights.astype('float64')
     
-class FactorCombinationWeightedByReturn(FactorCombinator):
+class FactorCombinationWeightedByHalfLife(FactorCombinator):
+    """
+    A superclass for combination methods whose factor weights are half-life weighted averages of a per-period factor
+    metric(factor returns, IC values, ...).
+
+    Subclasses implement 'get_metric_series', which returns the (rebalancing dates x factors) matrix of the metric.
+    The metric of date t involves next_period_return, which is only known on the next rebalancing date, so the weights
+    of date t only use the metric up to date t-1. Dates without any history get uniform weights.
+
+    The weights keep the sign of the averaged metric, e.g. a factor with a negative IC gets a negative weight, and are
+    normalized so that their absolute values add up to 1.
+    """
+    allow_negative_weights = True
+
+    def __init__(self, halflife:float=6, tester=None, *args, **kwargs):
+        """
+        Args:
+            halflife (float, optional): number of rebalancing periods for the weight of a past period to halve. Defaults to 6.
+            tester (optional): a TTester/ICTester that already tested some of the factors on the same backtesting dataframe.
+                               Their results are reused and only the untested factors are tested. Defaults to None.
+        """
+        super().__init__(*args, **kwargs)
+        self.halflife = halflife
+        self.tester = tester
+
+    def get_metric_series(self, ) -> pd.DataFrame:
+        """
+        Polymorphism for child classes of different metrics(factor returns, IC values, etc.)
+        """
+        pass
+
+    @timer
+    def get_factor_weights(self, ) -> pd.DataFrame:
+        self.df_metric_series = self.get_metric_series().reindex(columns=self.factors)
+        # the average known on date t only uses the metric up to date t-1
+        df_metric_ewma = ewma(self.df_metric_series, self.halflife).shift(1)
+        weights = df_metric_ewma.values
+        abs_sum = np.nansum(np.abs(weights), axis=1, keepdims=True)
+        has_history = (abs_sum > 0).flatten()
+        weights = np.where(has_history[:, np.newaxis], np.nan_to_num(weights) / np.where(abs_sum > 0, abs_sum, 1.), 
+                           self.uniform_weights)
+        return pd.DataFrame(weights, index=df_metric_ewma.index, columns=self.weight_cols)
+
+class FactorCombinationWeightedByReturn(FactorCombinationWeightedByHalfLife):
     """
     Combines factor exposures according to the weights whose values equal to (half-life) weighted averages of factor returns
     Here, factor returns are referred as the 'coef_series_mean' in class TTester in single_factor.py
@@ -253,19 +455,116 @@ class FactorCombinationWeightedByReturn(FactorCombinator):
 
     For detailed calculation formulas， see Huatai MultiFactor Report #10 华泰金工多因子系列之十：因子合成方法实证分析
     """
-    pass
-
-class FactorCombinationWeightedByIC(FactorCombinator):
+    def get_metric_series(self, ) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: factor returns, with rebalancing dates as index and factor names as columns
+        """
+        if self.tester is None:
+            self.tester = TTester()
+        for factor in self.factors:
+            if factor not in self.tester.tval_coef_by_factor:
+                self.tester.run(self.df_backtest, factor)
+        return pd.DataFrame({factor: self.tester.tval_coef_by_factor[factor]['coef'] for factor in self.factors})
+
+class FactorCombinationWeightedByIC(FactorCombinationWeightedByHalfLife):
     """
     Combines factor exposures according to the weights whose values equal to (half-life) weighted averages of factors' RankIC values
     Here, factors' RankIC values are referred as the 'ic_series_mean' in class ICTester in single_factor.py
 
     For detailed calculation formulas， see Huatai MultiFactor Report #10 华泰金工多因子系列之十：因子合成方法实证分析   
     """
-    pass
+    def get_metric_series(self, ) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: RankIC values, with rebalancing dates as index and factor names as columns
+        """
+        if self.tester is None:
+            self.tester = ICTester()
+        for factor in self.factors:
+            if factor not in self.tester.ic_series_by_factor:
+                self.tester.run(self.df_backtest, factor)
+        return pd.DataFrame({factor: self.tester.ic_series_by_factor[factor] for factor in self.factors})
 
 class FactorCombinationPCA(FactorCombinator):
     """
     Combines factor exposures according to Principle Component Analysis(PCA) and choose the first component as the combinated factor.
+
+    On each rebalancing date, the factor weights are the loadings of the first principal component of the standardized
+    factor exposures over the past 'hist_periods' rebalancing dates(including the current one, since exposures are known
+    on the rebalancing date). Instead of decomposing a new correlation matrix from scratch on every date:
+        1. the per-date Gram matrices are computed in one segmented pass over the exposure matrix,
+        2. the window's correlation matrix is updated with running sums, adding the newest date and removing the oldest,
+        3. the first eigenvector is found with power iterations warm-started from the previous date's loadings.
+           The window moves by one date at a time, so a handful of iterations is usually enough. A full eigen
+           decomposition is only used when the iterations do not converge, e.g. when the first two eigenvalues are too close.
+    The loadings' sign is chosen to agree with the previous date's, and on the first date so that they add up to a positive
+    number, so the combined factor does not flip sign through time.
+
+    Note: the factors should be standardized, which is why standardize_factors defaults to True here.
     """
-    pass
\ No newline at end of file
+    allow_negative_weights = True
+
+    def __init__(self, hist_periods:int=12, max_iter=100, tol=1e-10, *args, **kwargs):
+        kwargs.setdefault('standardize_factors', True)
+        super().__init__(*args, **kwargs)
+        self.hist_periods = hist_periods
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def get_leading_eigenvector(self, cov_mat: np.ndarray, v0: np.ndarray) -> np.ndarray:
+        """
+        Power iterations on a symmetric positive semi-definite matrix, starting from v0
+        """
+        v = v0 / np.linalg.norm(v0)
+        for _ in range(self.max_iter):
+            v_new = cov_mat @ v
+            norm = np.linalg.norm(v_new)
+            if norm == 0:
+                break
+            v_new /= norm
+            if np.linalg.norm(v_new - v) < self.tol ** 0.5:
+                return v_new
+            v = v_new
+        # did not converge: fall back to the full decomposition
+        eigenvalues, eigenvectors = np.linalg.eigh(cov_mat)
+        return eigenvectors[:, -1]
+
+    @timer
+    def get_factor_weights(self, ) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: the normalized first principal component loadings on each rebalancing date, whose absolute
+                          values add up to 1. The full loadings and the share of variance explained by the first component
+                          are kept in self.df_pca_loadings and self.explained_variance_ratio.
+        """
+        dates, offsets = date_segments(self.df_backtest)
+        X = accumulate(self.df_backtest[self.factors])
+        # standardize each factor on each date(missing exposures are set to the mean) so that the gram matrices are
+        # (n_t - 1) times the correlation matrices
+        Z = np.empty_like(X)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            X_t = X[start: end]
+            mean, std = np.nanmean(X_t, axis=0), np.nanstd(X_t, axis=0, ddof=1)
+            Z[start: end] = np.nan_to_num((X_t - mean) / np.where(std > 0, std, 1.))
+        corr_mats = get_segment_gram(Z, offsets) / np.maximum(np.diff(offsets) - 1, 1)[:, np.newaxis, np.newaxis]
+
+        loadings = np.empty((len(dates), self.num_factors))
+        explained_variance_ratio = np.empty(len(dates))
+        window_sum = np.zeros((self.num_factors, self.num_factors))
+        v = np.ones(self.num_factors)
+        for t in range(len(dates)):
+            window_sum += corr_mats[t]
+            if t >= self.hist_periods:
+                window_sum -= corr_mats[t - self.hist_periods]
+            v_new = self.get_leading_eigenvector(window_sum, v)
+            # keep the sign consistent through time
+            if (t > 0 and v_new @ v < 0) or (t == 0 and v_new.sum() < 0):
+                v_new = -v_new
+            v = v_new
+            loadings[t] = v
+            explained_variance_ratio[t] = v @ window_sum @ v / np.trace(window_sum)
+
+        self.df_pca_loadings = pd.DataFrame(loadings, index=dates, columns=self.factors)
+        self.explained_variance_ratio = pd.Series(explained_variance_ratio, index=dates, name='explained_variance_ratio')
+        return pd.DataFrame(loadings / np.abs(loadings).sum(axis=1, keepdims=True), index=dates, columns=self.weight_cols)
\ No newline at end of file
@@ -0,0 +1,257 @@
+"""
+Segmented kernels for the per-cross-section operations of the pipeline: ranks, quantile buckets, median/MAD clipping,
+weighted sums and the fractional group weights of the hierarchical backtest.
+
+Every kernel works on a float array of rows sorted by date(N values, or an N x K matrix) and the row offsets of its
+segments, e.g. SegmentIndex.offsets from src/panel.py: the rows of segment t are offsets[t]: offsets[t + 1].
+Missing values are skipped and stay missing, like in pandas.
+
+numba is optional. When it is installed the kernels are compiled loops over the segments; otherwise the same results
+are computed with numpy, looping over the segments in python. USE_NUMBA tells which one is used. Ranks are the
+exception: they are computed with one np.lexsort per column either way.
+"""
+import warnings
+import numpy as np
+
+try:
+    import numba
+    USE_NUMBA = True
+except ImportError:
+    numba = None
+    USE_NUMBA = False
+
+def _jit(func):
+    # compile with numba if available; the python version is kept as 'py_func' either way
+    if USE_NUMBA:
+        return numba.njit(cache=True)(func)
+    func.py_func = func
+    return func
+
+def _as_2d(values) -> tuple:
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    return (values, False) if values.ndim == 2 else (values.reshape(-1, 1), True)
+
+def _restore(result, was_1d):
+    return result[:, 0] if was_1d else result
+
+def segment_rank(values, offsets) -> np.ndarray:
+    """
+    Ranks within each segment(1 for the smallest value, ties get their average rank), same as
+    df.groupby(level=0).rank(method='average')
+
+    Each column is sorted once for all segments by (segment, value) with np.lexsort, which is faster than sorting the
+    segments one by one, compiled or not. Ties are then runs of equal values in the sorted order.
+    """
+    values, was_1d = _as_2d(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_rows = values.shape[0]
+    segment_id = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    result = np.full(values.shape, np.nan)
+    for k in range(values.shape[1]):
+        # missing values are sorted last within their segment, so the other values get their positions right
+        order = np.lexsort((values[:, k], segment_id))
+        sorted_values, sorted_segments = values[order, k], segment_id[order]
+        position = np.arange(num_rows) - offsets[sorted_segments]
+        is_run_start = np.ones(num_rows, dtype=bool)
+        is_run_start[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_segments[1:] != sorted_segments[:-1])
+        run_starts = np.flatnonzero(is_run_start)
+        run_ends = np.append(run_starts[1:], num_rows) - 1
+        average_rank = (position[run_starts] + position[run_ends]) / 2 + 1
+        result[order, k] = np.where(np.isnan(sorted_values), np.nan, average_rank[np.cumsum(is_run_start) - 1])
+    return _restore(result, was_1d)
+
+def segment_rank_corr(x, y, offsets) -> np.ndarray:
+    """
+    Spearman rank correlation between each column of x and y within each segment, using the rows where both are available.
+    Same as df.corr(method='spearman') on each date.
+
+    Args:
+        x: N values or an N x K matrix, e.g. factor residuals
+        y: N values, e.g. next period's returns, or an N x K matrix whose columns go with the columns of x
+
+    Returns:
+        np.ndarray: T values or a T x K matrix
+    """
+    x, was_1d = _as_2d(x)
+    y = np.asarray(y, dtype=np.float64)
+    y = y.reshape(-1, 1) if y.ndim == 1 else y
+    offsets = np.asarray(offsets, dtype=np.int64)
+    both = ~np.isnan(x) & ~np.isnan(y)
+    rank_x = segment_rank(np.where(both, x, np.nan), offsets)
+    rank_y = segment_rank(np.where(both, y, np.nan), offsets)
+    # pearson correlation of the ranks
+    count = segment_sum(both.astype(np.float64), offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = segment_sum(rank_x, offsets) / count
+        mean_y = segment_sum(rank_y, offsets) / count
+        dx = rank_x - np.repeat(mean_x, np.diff(offsets), axis=0)
+        dy = rank_y - np.repeat(mean_y, np.diff(offsets), axis=0)
+        corr = segment_sum(dx * dy, offsets) / np.sqrt(segment_sum(dx ** 2, offsets) * segment_sum(dy ** 2, offsets))
+    corr[count < 2] = np.nan
+    return _restore(corr, was_1d)
+
+@_jit
+def _sum_numba(values, weights, offsets):
+    result = np.zeros((offsets.shape[0] - 1, values.shape[1]))
+    for t in range(offsets.shape[0] - 1):
+        for i in range(offsets[t], offsets[t + 1]):
+            for k in range(values.shape[1]):
+                if not np.isnan(values[i, k]):
+                    result[t, k] += values[i, k] * weights[i]
+    return result
+
+def segment_sum(values, offsets, weights=None) -> np.ndarray:
+    """(weighted) sum of the non-missing values of each segment, 0 for segments without any"""
+    values, was_1d = _as_2d(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    weights = np.ones(values.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+    if USE_NUMBA:
+        return _restore(_sum_numba(values, weights, offsets), was_1d)
+    weighted = np.where(np.isnan(values), 0., values * weights[:, np.newaxis])
+    # reduceat does not handle empty segments, their sums are 0
+    result = np.zeros((offsets.shape[0] - 1, values.shape[1]))
+    non_empty = offsets[1:] > offsets[:-1]
+    if non_empty.any():
+        result[non_empty] = np.add.reduceat(weighted, offsets[:-1][non_empty], axis=0)
+    return _restore(result, was_1d)
+
+def segment_weighted_sum(values, weights, offsets) -> np.ndarray:
+    """
+    Sum of weights[:, j] * values over each segment, e.g. the returns of portfolios given their stock weights.
+    Unlike segment_sum, a missing value with a non-zero weight makes the sum missing.
+
+    Args:
+        values: N values
+        weights: N values or an N x M matrix of weights
+
+    Returns:
+        np.ndarray: T values or a T x M matrix
+    """
+    weights, was_1d = _as_2d(weights)
+    values = np.asarray(values, dtype=np.float64)
+    products = np.where(weights != 0, weights * values[:, np.newaxis], 0.)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    result = np.zeros((offsets.shape[0] - 1, weights.shape[1]))
+    non_empty = offsets[1:] > offsets[:-1]
+    if non_empty.any():
+        # plain reduceat so that missing values propagate
+        result[non_empty] = np.add.reduceat(products, offsets[:-1][non_empty], axis=0)
+    return _restore(result, was_1d)
+
+@_jit
+def _median_numba(values, offsets):
+    result = np.full((offsets.shape[0] - 1, values.shape[1]), np.nan)
+    for t in range(offsets.shape[0] - 1):
+        for k in range(values.shape[1]):
+            column = values[offsets[t]: offsets[t + 1], k]
+            column = column[~np.isnan(column)]
+            if column.shape[0]:
+                result[t, k] = np.median(column)
+    return result
+
+def segment_median(values, offsets) -> np.ndarray:
+    """median of the non-missing values of each segment, NaN for segments without any"""
+    values, was_1d = _as_2d(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if USE_NUMBA:
+        return _restore(_median_numba(values, offsets), was_1d)
+    result = np.full((offsets.shape[0] - 1, values.shape[1]), np.nan)
+    with warnings.catch_warnings():
+        # columns without any value on a segment have NaN medians
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for t, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            if end > start:
+                result[t] = np.nanmedian(values[start: end], axis=0)
+    return _restore(result, was_1d)
+
+def segment_clip(values, offsets, lower, upper) -> np.ndarray:
+    """clip the values of segment t to [lower[t], upper[t]], missing values and missing bounds are left as they are"""
+    values, was_1d = _as_2d(values)
+    counts = np.diff(np.asarray(offsets, dtype=np.int64))
+    lower = np.repeat(np.asarray(lower, dtype=np.float64).reshape(len(counts), -1), counts, axis=0)
+    upper = np.repeat(np.asarray(upper, dtype=np.float64).reshape(len(counts), -1), counts, axis=0)
+    result = np.where(values > upper, upper, values)
+    result = np.where(result < lower, lower, result)
+    return _restore(result, was_1d)
+
+def segment_mad_clip(values, offsets, n=3) -> np.ndarray:
+    """
+    Median/MAD outlier clipping of each segment, same as utils.remove_outlier on each date:
+    values more than n times MAD away from the median are reset to median +/- n * MAD
+    """
+    values, was_1d = _as_2d(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    med = segment_median(values, offsets)
+    MAD = segment_median(np.abs(values - np.repeat(med, np.diff(offsets), axis=0)), offsets)
+    return _restore(segment_clip(values, offsets, med - n * MAD, med + n * MAD), was_1d)
+
+def segment_quantile_bucket(values, offsets, num_groups: int) -> np.ndarray:
+    """
+    Quantile bucket(0 to num_groups - 1) of each value within its segment, same as pd.qcut(q=num_groups, labels=False)
+    on each segment, except that repeated bin edges are allowed: values equal to a repeated edge go to the lowest bucket.
+    Missing values get -1.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    result = np.full(values.shape[0], -1, dtype=np.int64)
+    probabilities = np.linspace(0, 1, num_groups + 1)[1:-1]
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        block = values[start: end]
+        valid = ~np.isnan(block)
+        if valid.any():
+            # bins are right-closed like pd.cut: a value equal to an inner edge belongs to the bucket below it
+            inner_edges = np.quantile(block[valid], probabilities)
+            result[start: end][valid] = np.searchsorted(inner_edges, block[valid], side='left')
+    return result
+
+@_jit
+def _group_weights_numba(offsets, num_groups):
+    result = np.zeros((offsets[-1], num_groups))
+    for t in range(offsets.shape[0] - 1):
+        n = offsets[t + 1] - offsets[t]
+        for i in range(n):
+            for g in range(num_groups):
+                overlap = min((i + 1) * num_groups, (g + 1) * n) - max(i * num_groups, g * n)
+                if overlap > 0:
+                    result[offsets[t] + i, g] = overlap / n
+    return result
+
+def segment_group_weights(offsets, num_groups: int) -> np.ndarray:
+    """
+    Weights of the stocks of each segment(e.g. one industry on one date, sorted by factor exposure) in 'num_groups'
+    equally sized groups, where a stock on the border of two groups is split between them.
+
+    Stock i of n occupies [i / n, (i + 1) / n) of the sorted segment and group g occupies [g / G, (g + 1) / G), so the weight
+    of the stock in the group is the length of their overlap times G, which makes the weights of each group add up to 1.
+    In integer units: max(0, min((i + 1) * G, (g + 1) * n) - max(i * G, g * n)) / n.
+    This is the closed form of the loop in get_group_weight_by_industry of the data processing notebook.
+
+    Returns:
+        np.ndarray: N x num_groups weights
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if USE_NUMBA:
+        return _group_weights_numba(offsets, num_groups)
+    counts = np.diff(offsets)
+    n = np.repeat(counts, counts)[:, np.newaxis]
+    i = (np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts))[:, np.newaxis]
+    g = np.arange(num_groups)[np.newaxis, :]
+    overlap = np.minimum((i + 1) * num_groups, (g + 1) * n) - np.maximum(i * num_groups, g * n)
+    return np.maximum(overlap, 0) / np.maximum(n, 1)
+
+def sort_within_segments(offsets, *keys) -> tuple:
+    """
+    Reorder the rows of each segment by the given keys(the last key is the primary one, like np.lexsort) and split the
+    segments further by the last key, e.g. sort_within_segments(offsets, factor, industry_code) sorts each date by industry
+    then by factor exposure and returns the offsets of the (date, industry) segments.
+
+    Returns:
+        tuple: (permutation of the rows, offsets of the (segment, first key) sub-segments in the permuted order)
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    segment_id = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    order = np.lexsort(keys + (segment_id, ))
+    group_key = keys[-1][order]
+    is_new = np.ones(order.shape[0], dtype=bool)
+    is_new[1:] = (segment_id[order][1:] != segment_id[order][:-1]) | (group_key[1:] != group_key[:-1])
+    return order, np.concatenate([np.flatnonzero(is_new), [order.shape[0]]]).astype(np.int64)
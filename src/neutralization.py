@@ -0,0 +1,231 @@
+"""
+Cross-sectional neutralization: the residuals(and coefficients) of regressing factors or returns on industry dummies and
+a few other exposures such as market value, on each rebalancing date.
+
+Regressing on one-hot industry dummies plus p dense regressors does not need the N x (G + p) design matrix. By the
+Frisch-Waugh-Lovell theorem it is the same as:
+    1. removing the (weighted) industry means from the dependent variable and from the regressors, with sparse group sums,
+    2. regressing the demeaned dependent variable on the p demeaned regressors,
+so each column costs O(N * p^2) instead of O(N * (G + p)^2). IndustryProjector implements this.
+
+For arbitrary neutralizers(e.g. primary and secondary industries together, or several overlapping dummy sets),
+dense_projection and sparse_projection are the generic least squares fallbacks. When the design matrix is rank deficient
+the residuals are still unique, and the coefficients are the minimum norm ones(like statsmodels) for IndustryProjector,
+and for the fallbacks the minimum norm ones after scaling the columns of the design matrix to unit norm.
+
+Rows with a missing value in the column being neutralized, in one of the regressors or in the weights, or without an
+industry, are left out of that column's regression and get NaN residuals, like the missing='drop' option of statsmodels.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import scipy.sparse.linalg
+from src.constants import *
+from src.panel import date_segments
+from src.precision import accumulate
+from src.utils import timer
+
+class IndustryProjector:
+    """
+    Weighted least squares projection onto industry dummies and a few dense regressors, for a single cross-section.
+    The industry dummies span the intercept, so there is no separate intercept.
+    """
+    def __init__(self, groups: np.ndarray, regressors: np.ndarray=None, weights: np.ndarray=None):
+        """
+        Args:
+            groups (np.ndarray): integer industry code of each of the N stocks, -1 for stocks without an industry
+            regressors (np.ndarray, optional): N x p matrix of the other regressors, e.g. market value. Defaults to None.
+            weights (np.ndarray, optional): regression weights of the N stocks. Defaults to None(ordinary least squares).
+        """
+        self.groups = np.asarray(groups)
+        num_stocks = self.groups.shape[0]
+        self.num_groups = int(self.groups.max()) + 1 if num_stocks else 0
+        self.regressors = np.zeros((num_stocks, 0)) if regressors is None else accumulate(regressors).reshape(num_stocks, -1)
+        self.weights = np.ones(num_stocks) if weights is None else accumulate(weights)
+        self.valid = (self.groups >= 0) & ~np.isnan(self.weights) & ~np.isnan(self.regressors).any(axis=1)
+        # sparse N x G industry indicator matrix, rows of invalid stocks are empty
+        rows = np.flatnonzero(self.valid)
+        self.indicator = sp.csr_matrix((np.ones(rows.shape[0]), (rows, self.groups[rows])), shape=(num_stocks, self.num_groups))
+        # group of each stock for gathering the group means, invalid stocks are masked out anyway
+        self.row_groups = np.where(self.valid, self.groups, 0)
+
+    def fit(self, Y: np.ndarray) -> tuple:
+        """
+        Args:
+            Y (np.ndarray): N x m matrix of dependent variables(or a vector), each regressed separately
+
+        Returns:
+            tuple: (residuals, group_coef, coef)
+                   residuals: N x m, NaN on the rows left out of the regression
+                   group_coef: G x m industry coefficients, NaN for industries without any stock in the regression
+                   coef: p x m coefficients of the regressors
+        """
+        Y = accumulate(Y)
+        if Y.ndim == 1:
+            Y = Y[:, np.newaxis]
+        mask = self.valid[:, np.newaxis] & ~np.isnan(Y)
+        W = np.where(mask, self.weights[:, np.newaxis], 0.)
+        group_weight = self.indicator.T @ W
+        safe_group_weight = np.where(group_weight > 0, group_weight, 1.)
+        # a stock alone in its industry is fitted exactly. Its demeaned values are set to exactly 0, otherwise they would be
+        # rounding noise of either sign, which decides how such stocks are ranked in rank correlations
+        is_alone = ((self.indicator.T @ mask.astype(np.float64)) == 1)[self.row_groups]
+
+        def demean(V):
+            # weighted industry means of each column over its own regression rows
+            means = (self.indicator.T @ (W * V)) / safe_group_weight
+            return np.where(is_alone, 0., V - means[self.row_groups]), means
+
+        Y_demeaned, y_means = demean(np.where(mask, Y, 0.))
+        num_regressors = self.regressors.shape[1]
+        coef = np.zeros((num_regressors, Y.shape[1]))
+        residuals = Y_demeaned
+        group_coef = y_means
+        if num_regressors:
+            Z_demeaned, z_means = zip(*[demean(np.where(mask, self.regressors[:, [k]], 0.)) for k in range(num_regressors)])
+            Z_demeaned, z_means = np.stack(Z_demeaned), np.stack(z_means)
+            # normal equations of every column: p x p matrices and p vectors
+            A = np.einsum('kni,lni,ni->ikl', Z_demeaned, Z_demeaned, W)
+            b = np.einsum('kni,ni,ni->ik', Z_demeaned, W, Y_demeaned)
+            coef = (np.linalg.pinv(A) @ b[:, :, np.newaxis])[:, :, 0].T
+            residuals = Y_demeaned - np.einsum('kni,ki->ni', Z_demeaned, coef)
+            group_coef = y_means - np.einsum('kgi,ki->gi', z_means, coef)
+        residuals = np.where(mask, residuals, np.nan)
+        group_coef = np.where(group_weight > 0, group_coef, np.nan)
+        return residuals, group_coef, coef
+
+def column_norms(X) -> np.ndarray:
+    # euclidean norm of each column of a dense or sparse matrix, 1 for empty columns
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).flatten() if sp.issparse(X) else (X ** 2).sum(axis=0))
+    return np.where(norms > 0, norms, 1.)
+
+def dense_projection(Y: np.ndarray, X: np.ndarray, weights: np.ndarray=None) -> tuple:
+    """
+    Generic weighted least squares of each column of Y on the dense N x q design matrix X
+
+    Returns:
+        tuple: (N x m residuals, q x m coefficients)
+    """
+    Y, X = accumulate(Y), accumulate(X)
+    if Y.ndim == 1:
+        Y = Y[:, np.newaxis]
+    weights = np.ones(Y.shape[0]) if weights is None else accumulate(weights)
+    valid = ~np.isnan(X).any(axis=1) & ~np.isnan(weights)
+    residuals = np.full(Y.shape, np.nan)
+    coef = np.full((X.shape[1], Y.shape[1]), np.nan)
+    for j in range(Y.shape[1]):
+        rows = valid & ~np.isnan(Y[:, j])
+        sqrt_w = np.sqrt(weights[rows])
+        X_w = X[rows] * sqrt_w[:, np.newaxis]
+        # scale the columns to unit norm, otherwise e.g. market values in yuan make the singular value cutoff drop the dummies
+        norms = column_norms(X_w)
+        coef[:, j] = np.linalg.lstsq(X_w / norms, Y[rows, j] * sqrt_w, rcond=None)[0] / norms
+        residuals[rows, j] = Y[rows, j] - X[rows] @ coef[:, j]
+    return residuals, coef
+
+def sparse_projection(Y: np.ndarray, X: sp.spmatrix, weights: np.ndarray=None, tol=1e-12) -> tuple:
+    """
+    Generic weighted least squares of each column of Y on the sparse N x q design matrix X, e.g. several sets of dummies.
+    The design matrix must not contain missing values. LSQR started from 0 converges to the minimum norm solution.
+
+    Returns:
+        tuple: (N x m residuals, q x m coefficients)
+    """
+    Y = accumulate(Y)
+    if Y.ndim == 1:
+        Y = Y[:, np.newaxis]
+    X = sp.csr_matrix(X)
+    weights = np.ones(Y.shape[0]) if weights is None else accumulate(weights)
+    valid = ~np.isnan(weights)
+    residuals = np.full(Y.shape, np.nan)
+    coef = np.full((X.shape[1], Y.shape[1]), np.nan)
+    for j in range(Y.shape[1]):
+        rows = np.flatnonzero(valid & ~np.isnan(Y[:, j]))
+        sqrt_w = np.sqrt(weights[rows])
+        X_rows = X[rows]
+        X_w = sp.diags(sqrt_w) @ X_rows
+        norms = column_norms(X_w)
+        coef[:, j] = scipy.sparse.linalg.lsqr(X_w @ sp.diags(1 / norms), Y[rows, j] * sqrt_w, atol=tol, btol=tol)[0] / norms
+        residuals[rows, j] = Y[rows, j] - X_rows @ coef[:, j]
+    return residuals, coef
+
+def industry_codes(df: pd.DataFrame, industry_col=PRIMARY_INDUSTRY_COL, industries=None) -> tuple:
+    """
+    Returns:
+        tuple: (integer code of each row, -1 for a missing industry; the industries the codes refer to)
+    """
+    if industries is None:
+        codes, industries = pd.factorize(df[industry_col], sort=True)
+        return codes, list(industries)
+    return pd.Categorical(df[industry_col], categories=industries).codes.astype(np.int64), list(industries)
+
+def build_design_matrix(df: pd.DataFrame, industry_cols=(PRIMARY_INDUSTRY_COL, ), regressors=('market_value', )) -> tuple:
+    """
+    Sparse design matrix of the generic fallback: one dummy per industry of each column in 'industry_cols', followed by
+    the dense 'regressors'. Rows with a missing regressor are dropped by setting them to NaN in the returned mask.
+
+    Returns:
+        tuple: (N x q sparse design matrix, column names, boolean mask of the rows with all regressors available)
+    """
+    blocks, names = [], []
+    for col in industry_cols:
+        codes, industries = industry_codes(df, col)
+        rows = np.flatnonzero(codes >= 0)
+        blocks.append(sp.csr_matrix((np.ones(rows.shape[0]), (rows, codes[rows])), shape=(df.shape[0], len(industries))))
+        names += industries
+    values = accumulate(df[list(regressors)]) if regressors else np.zeros((df.shape[0], 0))
+    available = ~np.isnan(values).any(axis=1)
+    blocks.append(sp.csr_matrix(np.nan_to_num(values)))
+    return sp.hstack(blocks).tocsr(), names + list(regressors), available
+
+@timer
+def neutralize(df: pd.DataFrame, columns, industry_col=PRIMARY_INDUSTRY_COL, regressors=('market_value', ),
+               weights=None) -> pd.DataFrame:
+    """
+    Residuals of the given columns after regressing them on industry dummies and 'regressors' on each rebalancing date,
+    with the fast IndustryProjector.
+
+    Args:
+        df (pd.DataFrame): the backtesting dataframe, sorted by date
+        columns (Iterable): the columns to neutralize
+        industry_col (str, optional): the industry column. Defaults to PRIMARY_INDUSTRY_COL.
+        regressors (Iterable, optional): the other exposures. Defaults to ('market_value', ).
+        weights (pd.Series or np.ndarray, optional): regression weights, e.g. df['market_value'] ** 0.5. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the residuals, with the same index and columns as df[columns]
+    """
+    columns = list(columns)
+    dates, offsets = date_segments(df)
+    codes, _ = industry_codes(df, industry_col)
+    Y = accumulate(df[columns])
+    Z = accumulate(df[list(regressors)]) if regressors else None
+    w = None if weights is None else accumulate(weights)
+    residuals = np.empty(Y.shape)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        projector = IndustryProjector(codes[start: end], None if Z is None else Z[start: end], None if w is None else w[start: end])
+        residuals[start: end] = projector.fit(Y[start: end])[0]
+    return pd.DataFrame(residuals, index=df.index, columns=columns)
+
+@timer
+def neutralize_generic(df: pd.DataFrame, columns, industry_cols=(PRIMARY_INDUSTRY_COL, ), regressors=('market_value', ),
+                       weights=None, sparse=True) -> pd.DataFrame:
+    """
+    Same as 'neutralize' for arbitrary neutralizers, e.g. industry_cols=INDUSTRY_COLS with regressors=('market_value', 'beta'),
+    with the generic sparse(or dense) least squares. Rows without an industry only get the regressors.
+    """
+    columns = list(columns)
+    dates, offsets = date_segments(df)
+    X, _, available = build_design_matrix(df, industry_cols, regressors)
+    Y = accumulate(df[columns])
+    # rows with a missing regressor are left out of every regression
+    Y[~available] = np.nan
+    w = None if weights is None else accumulate(weights)
+    residuals = np.empty(Y.shape)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        w_t = None if w is None else w[start: end]
+        if sparse:
+            residuals[start: end] = sparse_projection(Y[start: end], X[start: end], w_t)[0]
+        else:
+            residuals[start: end] = dense_projection(Y[start: end], X[start: end].toarray(), w_t)[0]
+    return pd.DataFrame(residuals, index=df.index, columns=columns)
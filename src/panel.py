@@ -0,0 +1,175 @@
+"""
+Helpers for handling the (date, stock) backtesting panel without defensive copies.
+
+pandas stores the columns of a dataframe in blocks. A shallow copy(df.copy(deep=False)) shares these blocks with the
+original dataframe but has its own column list, so adding a column to it, or replacing a column with __setitem__,
+never modifies the original dataframe. Stages therefore take a shallow copy of their input(or work in place when
+the caller hands the dataframe over with inplace=True) and add or replace whole columns, instead of copying the full
+panel with df.copy() or merging new columns onto it.
+
+The only way to modify the shared data of a shallow copy is writing into an existing column in place,
+e.g. df.loc[mask, col] = x or df[col].values[:] = x. Stages must not do that on a dataframe they do not own.
+"""
+import hashlib
+import weakref
+import numpy as np
+import pandas as pd
+
+def lightweight_copy(df: pd.DataFrame, inplace=False) -> pd.DataFrame:
+    """
+    Return the dataframe a stage is allowed to add/replace columns in.
+
+    Args:
+        df (pd.DataFrame): the input of the stage
+        inplace (bool, optional): whether the caller hands over ownership of 'df'. Defaults to False.
+    """
+    return df if inplace else df.copy(deep=False)
+
+def assign_columns(df: pd.DataFrame, columns, values) -> pd.DataFrame:
+    """
+    Add or replace columns one at a time, so that each one gets its own new block and no existing block is written into.
+
+    Args:
+        df (pd.DataFrame): the dataframe to update in place
+        columns (Iterable): column names
+        values: a 2-d array or a dataframe with one column per name in 'columns', aligned with the rows of 'df'
+    """
+    values = values.values if isinstance(values, pd.DataFrame) else np.asarray(values)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    assert(values.shape == (df.shape[0], len(columns)))
+    for j, col in enumerate(columns):
+        df[col] = values[:, j]
+    return df
+
+def join_columns(df: pd.DataFrame, df_new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Left-join the columns of 'df_new' onto 'df' in place. Equivalent to
+    df.merge(df_new, how='left', left_index=True, right_index=True) when the index of 'df_new' has no duplicates,
+    except that existing columns are replaced rather than suffixed, and the other columns of 'df' are not copied.
+    """
+    df_new = df_new.reindex(df.index)
+    return assign_columns(df, list(df_new.columns), df_new)
+
+class SegmentIndex:
+    """
+    Row offsets of the rebalancing dates in a panel sorted by date: the rows of dates[t] are offsets[t]: offsets[t + 1].
+
+    Per-date reductions, transforms and loops run on these contiguous blocks instead of regrouping the panel with
+    groupby(level=0) in every stage. Reductions use ufunc.reduceat on the whole column block at once, and kernels
+    written as loops over the segments(e.g. compiled with numba) can take 'offsets' directly.
+
+    Get it with get_segment_index(df), which caches it per panel index.
+    """
+    def __init__(self, dates: pd.Index, offsets: np.ndarray):
+        self.dates = dates
+        self.offsets = offsets
+        self.counts = np.diff(offsets)
+
+    @classmethod
+    def from_index(cls, index: pd.Index) -> 'SegmentIndex':
+        date_values = index.get_level_values(0)
+        assert(date_values.is_monotonic_increasing), "the panel must be sorted by date"
+        values = date_values.values
+        starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+        offsets = np.concatenate([[0], starts, [len(values)]]).astype(np.int64) if len(values) else np.zeros(1, dtype=np.int64)
+        return cls(date_values[offsets[:-1]], offsets)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        """yields (date, start, end) of each segment"""
+        return zip(self.dates, self.offsets[:-1], self.offsets[1:])
+
+    def frames(self, df):
+        """yields (date, sub-dataframe) like iterating over df.groupby(level=0), without regrouping"""
+        for date, start, end in self:
+            yield date, df.iloc[start: end]
+
+    def apply(self, df, func) -> list:
+        """func applied to the sub-dataframe(or sub-array) of each date"""
+        if isinstance(df, (pd.DataFrame, pd.Series)):
+            return [func(df.iloc[start: end]) for _, start, end in self]
+        return [func(df[start: end]) for _, start, end in self]
+
+    def transform(self, values: np.ndarray, func) -> np.ndarray:
+        """func maps the block of rows of each date to a block of the same shape"""
+        values = np.asarray(values)
+        result = np.empty(values.shape)
+        for _, start, end in self:
+            result[start: end] = func(values[start: end])
+        return result
+
+    def broadcast(self, per_date_values) -> np.ndarray:
+        """repeat the value(or row) of each date on the rows of that date"""
+        return np.repeat(np.asarray(per_date_values), self.counts, axis=0)
+
+    def reduce(self, values: np.ndarray, ufunc=np.add) -> np.ndarray:
+        """ufunc.reduceat over the rows of each date, NaN values propagate"""
+        values = np.asarray(values)
+        if len(self) == 0:
+            return np.empty((0, ) + values.shape[1:])
+        return ufunc.reduceat(values, self.offsets[:-1], axis=0)
+
+    def count(self, values: np.ndarray) -> np.ndarray:
+        """number of non-missing values on each date"""
+        return self.reduce(~np.isnan(np.asarray(values, dtype=np.float64)), np.add)
+
+    def sum(self, values: np.ndarray, skipna=True) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        return self.reduce(np.nan_to_num(values, nan=0., posinf=np.inf, neginf=-np.inf) if skipna else values, np.add)
+
+    def mean(self, values: np.ndarray) -> np.ndarray:
+        """NaN-skipping mean of each date, like df.groupby(level=0).mean()"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum(values) / self.count(values)
+
+    def std(self, values: np.ndarray, ddof=1) -> np.ndarray:
+        """NaN-skipping standard deviation of each date, like df.groupby(level=0).std()"""
+        values = np.asarray(values, dtype=np.float64)
+        count = self.count(values)
+        # two passes for accuracy: the squared deviations from the mean of each date
+        squared_deviations = self.sum((values - self.broadcast(self.mean(values))) ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.where(count > ddof, squared_deviations / (count - ddof), np.nan))
+
+# segment indices of the panels in use, keyed by the id of their index. Shallow copies and column selections of a
+# panel share its index object, so they all hit the same entry. The cache only holds weak references to the index
+# objects: an entry is removed as soon as its index is garbage collected, so the cache never keeps a dropped panel
+# alive, and the id of a collected index cannot be mistaken for a new one.
+_SEGMENT_INDICES = {}
+
+def get_segment_index(df) -> SegmentIndex:
+    """
+    Return the cached SegmentIndex of a panel(or of its index), building it on first use.
+    TimeAndStockFilter builds it right after the panel is created, so later stages only look it up.
+    """
+    index = df if isinstance(df, pd.Index) else df.index
+    key = id(index)
+    cached = _SEGMENT_INDICES.get(key)
+    if cached is not None and cached[0]() is index:
+        return cached[1]
+    segment_index = SegmentIndex.from_index(index)
+    _SEGMENT_INDICES[key] = (weakref.ref(index, lambda _, key=key: _SEGMENT_INDICES.pop(key, None)), segment_index)
+    return segment_index
+
+def date_segments(df) -> tuple:
+    """
+    The backtesting panel is sorted by date, so the rows of each rebalancing date form a contiguous block.
+
+    Returns:
+        tuple: (dates, offsets) where the rows of dates[t] are df.iloc[offsets[t]: offsets[t + 1]]
+    """
+    segment_index = get_segment_index(df)
+    return segment_index.dates, segment_index.offsets
+
+def panel_fingerprint(df: pd.DataFrame, columns) -> str:
+    """
+    A version stamp of the given columns of the panel: it changes whenever their values or the rows of the panel change.
+    Used as the key of results cached across runs, e.g. the factor correlation matrices in src/factor_combinator.py.
+    """
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(df[list(columns)], index=True).values.tobytes())
+    digest.update('|'.join(map(str, columns)).encode())
+    return digest.hexdigest()
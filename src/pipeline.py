@@ -0,0 +1,349 @@
+"""
+Memoized pipeline of stages, cached on disk.
+
+Each stage declares the stages it takes as inputs, its parameters and the data files it reads. The cache key of a
+stage is a hash of
+    - its name, the source code of its function and the source code of the src package, so editing e.g.
+      src/single_factor.py re-runs the stages(conservatively, all of them) instead of reading back stale results
+    - its parameters
+    - the size and modification time of its data files
+    - the versions of its input stages, where the version of a stage is a hash of the content of its output
+Outputs are pickled under 'cache_dir' with their version. A stage only re-runs when its key changes, and since keys
+depend on the content of the inputs rather than on their keys, a stage that re-runs but produces the same output does
+not invalidate the stages after it.
+
+build_pipeline sets up the usual research flow:
+    basic_info -> panel -> factor:<name>(one per factor) -> factor_panel -> risk_model -> opt_weights -> backtest
+                                        \\-> ic:<name>, t:<name>, hier:<name>
+so changing gamma only re-runs opt_weights and backtest, and changing one factor only loads that factor again.
+The ic and t stages keep their per-date statistics in a StatStore under 'cache_dir', so when a new rebalancing date is
+added they only test its cross-section.
+
+Usage:
+    pipeline = build_pipeline({'value': ['pe_ratio_ttm', 'pb_ratio_ttm']}, gamma=2.5)
+    result = pipeline.get('backtest')
+    pipeline.set_params('opt_weights', gamma=5.)
+    result = pipeline.get('backtest')   # only the optimization and the backtest are re-run
+"""
+import os
+import copy
+import glob
+import json
+import pickle
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+from src.profiler import PROFILER
+
+def content_hash(obj) -> str:
+    """hash of the values of a dataframe/series/array(without pickling it), or of the pickled object otherwise"""
+    digest = hashlib.sha1()
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        digest.update(repr(list(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name).encode())
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        digest.update(str((obj.shape, obj.dtype)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        digest.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+def stable_repr(value) -> str:
+    """repr of parameters that does not depend on the order of dict items"""
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{stable_repr(k)}: {stable_repr(v)}' for k, v in sorted(value.items(), key=lambda item: repr(item[0]))) + '}'
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__ + '(' + ', '.join(stable_repr(v) for v in value) + ')'
+    return repr(value)
+
+def file_version(path: str) -> str:
+    try:
+        stat = os.stat(path)
+        return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+    except OSError:
+        return f'{path}:missing'
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# (versions of the source files, hash of their content) of the last call of source_version
+_SOURCE_VERSION = (None, None)
+
+def source_version(src_dir=SRC_DIR) -> str:
+    """hash of the content of the python files of the src package, only re-read when their size or mtime changes"""
+    global _SOURCE_VERSION
+    paths = sorted(glob.glob(os.path.join(src_dir, '*.py')))
+    file_versions = [file_version(path) for path in paths]
+    if _SOURCE_VERSION[0] != file_versions:
+        digest = hashlib.sha1()
+        for path in paths:
+            digest.update(os.path.basename(path).encode())
+            with open(path, 'rb') as file:
+                digest.update(file.read())
+        _SOURCE_VERSION = (file_versions, digest.hexdigest())
+    return _SOURCE_VERSION[1]
+
+class Stage:
+    def __init__(self, name: str, func, inputs=(), params=None, sources=()):
+        """
+        Args:
+            name (str): name of the stage
+            func (callable): called as func(*outputs of the input stages, **params)
+            inputs (Iterable, optional): names of the input stages. Defaults to ().
+            params (dict, optional): keyword arguments of 'func'. Defaults to None.
+            sources (Iterable, optional): data files read by 'func', e.g. factor files. Defaults to ().
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = dict(params or {})
+        self.sources = list(sources)
+
+    def code_version(self) -> str:
+        # the source of the stage function itself, and of the src package for the functions it calls
+        try:
+            code = inspect.getsource(self.func)
+        except (OSError, TypeError):
+            code = getattr(self.func, '__qualname__', repr(self.func))
+        return hashlib.sha1((code + source_version()).encode()).hexdigest()
+
+class Pipeline:
+    def __init__(self, cache_dir=os.path.join('.', 'data', 'pipeline_cache'), verbose=True):
+        """
+        Args:
+            cache_dir (str, optional): where the outputs are pickled. None keeps them in memory only.
+                Defaults to ./data/pipeline_cache.
+            verbose (bool, optional): whether to print which stages are re-run. Defaults to True.
+        """
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.stages = {}
+        # name -> (key, version, output) of the outputs used in this session
+        self._memory = {}
+
+    def add_stage(self, name: str, func, inputs=(), sources=(), **params) -> 'Pipeline':
+        for input_name in inputs:
+            if input_name not in self.stages:
+                raise Exception(f"The input stage '{input_name}' of '{name}' has not been added yet!")
+        self.stages[name] = Stage(name, func, inputs, params, sources)
+        return self
+
+    def set_params(self, name: str, **params) -> 'Pipeline':
+        """update some parameters of a stage, the stages that depend on it are invalidated through its version"""
+        self.stages[name].params.update(params)
+        return self
+
+    def key(self, name: str) -> str:
+        stage = self.stages[name]
+        digest = hashlib.sha1()
+        digest.update(name.encode())
+        digest.update(stage.code_version().encode())
+        digest.update(stable_repr(stage.params).encode())
+        for path in stage.sources:
+            digest.update(file_version(path).encode())
+        for input_name in stage.inputs:
+            digest.update(self.version(input_name).encode())
+        return digest.hexdigest()[:16]
+
+    def version(self, name: str) -> str:
+        """content hash of the output of a stage, without loading it if it is cached on disk"""
+        key = self.key(name)
+        if name in self._memory and self._memory[name][0] == key:
+            return self._memory[name][1]
+        meta_path = self._path(name, key, '.json')
+        if meta_path is not None and os.path.exists(meta_path):
+            with open(meta_path) as file:
+                return json.load(file)['version']
+        return self._run(name, key)[1]
+
+    def get(self, name: str):
+        """the output of a stage, re-running it and the stages before it only if they are invalidated"""
+        key = self.key(name)
+        if name in self._memory and self._memory[name][0] == key:
+            return self._memory[name][2]
+        output_path, meta_path = self._path(name, key, '.pkl'), self._path(name, key, '.json')
+        if output_path is not None and os.path.exists(output_path) and os.path.exists(meta_path):
+            if self.verbose:
+                print(f'[pipeline] {name}: loaded from cache')
+            with open(output_path, 'rb') as file:
+                output = pickle.load(file)
+            with open(meta_path) as file:
+                self._memory[name] = (key, json.load(file)['version'], output)
+            return output
+        return self._run(name, key)[2]
+
+    def run(self, *names) -> dict:
+        """outputs of the given stages, all of them by default"""
+        names = names or list(self.stages)
+        return {name: self.get(name) for name in names}
+
+    def clear(self, name=None):
+        """delete the cached outputs of a stage, or of all stages"""
+        names = [name] if name is not None else list(self.stages)
+        for stage_name in names:
+            self._memory.pop(stage_name, None)
+            if self.cache_dir is None or not os.path.exists(self.cache_dir):
+                continue
+            prefix = self._file_prefix(stage_name)
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.startswith(prefix):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+    def _file_prefix(self, name: str) -> str:
+        return ''.join(c if c.isalnum() or c in '-_' else '_' for c in name) + '__'
+
+    def _path(self, name: str, key: str, extension: str):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'{self._file_prefix(name)}{key}{extension}')
+
+    def _run(self, name: str, key: str) -> tuple:
+        stage = self.stages[name]
+        inputs = [self.get(input_name) for input_name in stage.inputs]
+        if self.verbose:
+            print(f'[pipeline] {name}: running')
+        with PROFILER.stage(f'pipeline:{name}'):
+            output = stage.func(*inputs, **stage.params)
+        version = content_hash(output)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # older outputs of the stage are replaced
+            self.clear(name)
+            with open(self._path(name, key, '.pkl'), 'wb') as file:
+                pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+            # the version is written last, so an interrupted write is never mistaken for a cached output
+            with open(self._path(name, key, '.json'), 'w') as file:
+                json.dump({'version': version}, file)
+        self._memory[name] = (key, version, output)
+        return self._memory[name]
+
+# stage functions of build_pipeline. src modules are imported inside them, since src.constants reads the data
+# folder on import
+
+def load_basic_info_stage():
+    import src.dataloader as dl
+    return dl.load_basic_info()
+
+def filter_stage(df_basic_info, universe_definition=None, start_date=None, end_date=None):
+    """the backtesting panel, optionally restricted to the rebalancing dates between start_date and end_date"""
+    from src import preprocess
+    import src.universe as universe
+    universe_definition = universe.DEFAULT_UNIVERSE if universe_definition is None else universe_definition
+    df_backtest = preprocess.TimeAndStockFilter(df_basic_info, universe_definition=universe_definition).run()
+    if start_date is not None or end_date is not None:
+        dates = df_backtest.index.get_level_values(0)
+        in_calendar = np.ones(len(dates), dtype=bool)
+        if start_date is not None:
+            in_calendar &= dates >= pd.Timestamp(start_date)
+        if end_date is not None:
+            in_calendar &= dates <= pd.Timestamp(end_date)
+        df_backtest = df_backtest[in_calendar]
+    return df_backtest
+
+def factor_stage(df_backtest, factor_type: str, factor: str) -> pd.Series:
+    """
+    One standardized factor, aligned with the rows of the panel. The rows with missing returns or market values are
+    only filtered out in factor_panel_stage, which gives the same values as standardize_factors on all factors at once.
+    """
+    from src import preprocess
+    df_factor = preprocess.add_factors(df_backtest[['next_period_return', 'market_value']], {factor_type: [factor]})
+    df_factor = preprocess.standardize_factors(df_factor, [factor], filter_out_missing_values_or_not=False, inplace=True)
+    return df_factor[factor]
+
+def factor_panel_stage(df_backtest, *factor_columns) -> pd.DataFrame:
+    """the panel with the standardized factors, like the output of add_factors + standardize_factors"""
+    from src.panel import lightweight_copy, assign_columns
+    df = lightweight_copy(df_backtest)
+    for column in factor_columns:
+        assign_columns(df, [column.name], column.values)
+    return df[df['next_period_return'].notnull() & df['market_value'].notnull()]
+
+def get_stat_store(stat_cache_dir):
+    from src.stat_store import StatStore
+    return StatStore(stat_cache_dir) if stat_cache_dir is not None else None
+
+def ic_stage(df_backtest, factor_column: pd.Series, stat_cache_dir=None) -> pd.Series:
+    from src.single_factor import ICTester
+    return ICTester(stat_store=get_stat_store(stat_cache_dir)).run(factor_panel_stage(df_backtest, factor_column), factor_column.name)
+
+def t_stage(df_backtest, factor_column: pd.Series, stat_cache_dir=None) -> pd.DataFrame:
+    from src.single_factor import TTester
+    tester = TTester(stat_store=get_stat_store(stat_cache_dir))
+    tester.run(factor_panel_stage(df_backtest, factor_column), factor_column.name)
+    return tester.tval_coef
+
+def hier_stage(df_backtest, factor_column: pd.Series, num_groups=5) -> pd.DataFrame:
+    from src.single_factor import HierBackTester
+    return HierBackTester(num_groups=num_groups).run(factor_panel_stage(df_backtest, factor_column), factor_column.name)
+
+def risk_model_stage(df_factor_panel, style_factor_dict: dict, hist_periods=12, benchmark_weight_col=None):
+    """steps 1-3 of the portfolio optimizer, which do not depend on the risk aversion or the constraints"""
+    from src.portfolio_optimizer import PortfolioOptimizer
+    optimizer = PortfolioOptimizer(df_factor_panel, style_factor_dict=style_factor_dict, hist_periods=hist_periods,
+                                   benchmark_weight_col=benchmark_weight_col)
+    optimizer.preprocess(add_factors=False)
+    optimizer.get_regression_results()
+    optimizer.predict()
+    return optimizer
+
+def opt_weights_stage(optimizer, **optimizer_params) -> dict:
+    """step 4 of the portfolio optimizer on a copy of the cached risk model"""
+    from src.panel import lightweight_copy
+    optimizer = copy.copy(optimizer)
+    optimizer.df_backtest = lightweight_copy(optimizer.df_backtest)
+    for param, value in optimizer_params.items():
+        if not hasattr(optimizer, param):
+            raise Exception(f"'{param}' is not a parameter of PortfolioOptimizer!")
+        setattr(optimizer, param, value)
+    optimizer.solve_opt_weights()
+    return {'opt_weights': optimizer.opt_weights, 'turnover': optimizer.turnover}
+
+def backtest_stage(optimizer, opt_weights: dict, cost_rate=0.):
+    from src.backtest_result import BacktestResult
+    df = optimizer.df_backtest[['next_period_return', optimizer.benchmark_weight_col]].copy(deep=False)
+    df['opt_weight'] = opt_weights['opt_weights'].values
+    return BacktestResult.from_panel(df, 'opt_weight', benchmark_weight_col=optimizer.benchmark_weight_col, cost_rate=cost_rate)
+
+def build_pipeline(style_factor_dict: dict, hist_periods=12, gamma=1., cost_rate=0., universe_definition=None,
+                   start_date=None, end_date=None, num_groups=5, benchmark_weight_col=None,
+                   cache_dir=os.path.join('.', 'data', 'pipeline_cache'), **optimizer_params) -> Pipeline:
+    """
+    The research flow of the scripted notebooks as a Pipeline, see the module docstring for the stages.
+
+    Args:
+        style_factor_dict (dict): a dictionary mapping factor types to factor lists
+        hist_periods (int, optional): number of months of historical data used for forecasting. Defaults to 12.
+        gamma (float, optional): risk aversion of the portfolio optimizer. Defaults to 1.
+        cost_rate (float, optional): transaction cost per unit of traded value. Defaults to 0.
+        universe_definition (tuple, optional): see src/universe.py. Defaults to None, the default universe.
+        start_date, end_date (str, optional): restrict the backtest to the rebalancing dates in between. Defaults to None.
+        num_groups (int, optional): number of groups of the hierarchical backtests. Defaults to 5.
+        benchmark_weight_col (str, optional): see PortfolioOptimizer. Defaults to None.
+        **optimizer_params: other arguments of PortfolioOptimizer used in step 4, e.g. max_turnover, industry_neutral
+    """
+    raw_data_path = os.path.join('.', 'Data', 'raw_data')
+    pipeline = Pipeline(cache_dir=cache_dir)
+    # a new rebalancing date changes the panel and re-runs the single factor tests, which then only test the new
+    # cross-section and read the other dates back from the stat store, see src/stat_store.py
+    stat_cache_dir = os.path.join(cache_dir, 'stats') if cache_dir is not None else None
+    pipeline.add_stage('basic_info', load_basic_info_stage, sources=[os.path.join(raw_data_path, 'df_basic_info.h5')])
+    pipeline.add_stage('panel', filter_stage, inputs=['basic_info'],
+                       sources=[os.path.join(raw_data_path, name) for name in ['is_st.h5', 'is_suspended.h5', 'listed_dates.h5', 'industry_mapping.h5']]
+                       + [os.path.join('.', 'data', 'raw_data', 'rebalancing_dates.h5')],
+                       universe_definition=universe_definition, start_date=start_date, end_date=end_date)
+    factor_stages = []
+    for factor_type, factors in style_factor_dict.items():
+        for factor in factors:
+            name = f'factor:{factor}'
+            pipeline.add_stage(name, factor_stage, inputs=['panel'],
+                               sources=[os.path.join('.', 'data', 'factor', factor_type, factor + '.h5')],
+                               factor_type=factor_type, factor=factor)
+            pipeline.add_stage(f'ic:{factor}', ic_stage, inputs=['panel', name], stat_cache_dir=stat_cache_dir)
+            pipeline.add_stage(f't:{factor}', t_stage, inputs=['panel', name], stat_cache_dir=stat_cache_dir)
+            pipeline.add_stage(f'hier:{factor}', hier_stage, inputs=['panel', name], num_groups=num_groups)
+            factor_stages.append(name)
+    pipeline.add_stage('factor_panel', factor_panel_stage, inputs=['panel'] + factor_stages)
+    pipeline.add_stage('risk_model', risk_model_stage, inputs=['factor_panel'], style_factor_dict=style_factor_dict,
+                       hist_periods=hist_periods, benchmark_weight_col=benchmark_weight_col)
+    pipeline.add_stage('opt_weights', opt_weights_stage, inputs=['risk_model'], gamma=gamma, cost_rate=cost_rate, **optimizer_params)
+    pipeline.add_stage('backtest', backtest_stage, inputs=['risk_model', 'opt_weights'], cost_rate=cost_rate)
+    return pipeline
@@ -2,15 +2,13 @@ from datetime import datetime, timedelta
 import src.dataloader as dl
 import pandas as pd
 import rqdatac as rq
-import scipy
 import statsmodels as sm
 import numpy as np
-import seaborn as sns
 import pathos
 from tqdm import tqdm
 import multiprocessing
 import pickle
-import matplotlib.pyplot as plt
+import warnings
 from src import preprocess
 from src.utils import *
 from collections import Iterable
@@ -18,13 +16,20 @@ import src.factor_combinator as comb
 import scipy.sparse as sp
 import cvxpy as cp
 from src.constants import *
+from src.panel import date_segments, get_segment_index, lightweight_copy
+from src.neutralization import IndustryProjector, industry_codes
+from src.precision import accumulate
+from src.backtest_result import BacktestResult
+from src.specific_risk import SpecificRiskModel
 
 class PortfolioOptimizer:
     """
     A class created specifically for the portfolio optimization process
     For a complete math derivation process, see Huatai MultiFactor Report1 华泰多因子系列1
     """
-    def __init__(self, df_backtest: pd.DataFrame, style_factor_dict: dict, hist_periods=12, gamma=1.):
+    def __init__(self, df_backtest: pd.DataFrame, style_factor_dict: dict, hist_periods=12, gamma=1., cost_rate=0.,
+                 impact_cost=0., max_turnover=None, benchmark_weight_col=None, industry_neutral=False, style_bounds=None,
+                 max_tracking_error=None, max_weight=0.01, industry_col=PRIMARY_INDUSTRY_COL, specific_risk_model=None):
         """       
         Args:
             df_backtest (pd.DataFrame): a pandas dataframe used for backtesting. It has multi-index (date, stock)
@@ -34,6 +39,26 @@ class PortfolioOptimizer:
                 in order for factor data to be correctly read in,
                 pe_ratio_ttm.h5 and pb_ratio_ttm.h5 should exist under ./Data/factor/value/
             hist_periods (int, optional): number of months of historica data used for forecasting. Defaults to 12.
+            cost_rate (float, optional): transaction cost per unit of traded value, charged in the optimization objective
+                and in the backtest. Defaults to 0.
+            impact_cost (float, optional): coefficient of the quadratic trading cost |w - w0|^2 in the objective, a simple
+                model of market impact. Defaults to 0.
+            max_turnover (float, optional): upper bound on sum(|w - w0|) on each rebalancing date. Defaults to None.
+            benchmark_weight_col (str, optional): column of the benchmark weights, e.g. index weights. The weights are
+                scaled to add up to 1 on each date. Defaults to None, which uses a uniform benchmark over all stocks.
+            industry_neutral (bool, optional): whether the portfolio must have the same industry weights as the benchmark.
+                Defaults to False.
+            style_bounds (dict or float, optional): bounds on the style factor exposures relative to the benchmark, as a
+                dict mapping style factors to (lower, upper) tuples, or a float b for -b <= exposure <= b on every style
+                factor. Defaults to None.
+            max_tracking_error (float, optional): upper bound on the predicted tracking error(standard deviation of the
+                return relative to the benchmark) over the next period. Defaults to None.
+            max_weight (float, optional): upper bound on the weight of any stock. Defaults to 0.01.
+            industry_col (str, optional): the industry classification of the industry factors, e.g. SECONDARY_INDUSTRY_COL.
+                Defaults to PRIMARY_INDUSTRY_COL.
+            specific_risk_model (SpecificRiskModel, optional): forecasts the specific risk of each stock, see
+                src/specific_risk.py. Defaults to None, which uses SpecificRiskModel with the style factors and industries
+                of the optimizer and 'hist_periods' as the full history.
         """
         self.df_backtest = df_backtest
         self.hist_periods = hist_periods
@@ -42,41 +67,73 @@ class PortfolioOptimizer:
         self.style_factors = sum(style_factor_dict.values(), []) 
         self.country_factor = 'country'
         self.gamma = gamma
+        self.cost_rate = cost_rate
+        self.impact_cost = impact_cost
+        self.max_turnover = max_turnover
+        self.benchmark_weight_col = benchmark_weight_col
+        self.uniform_benchmark = benchmark_weight_col is None
+        self.industry_neutral = industry_neutral
+        self.style_bounds = style_bounds
+        self.max_tracking_error = max_tracking_error
+        self.max_weight = max_weight
+        self.industry_col = industry_col
+        self.industry_factors = None
+        if specific_risk_model is None:
+            specific_risk_model = SpecificRiskModel(self.style_factors, industry_col=industry_col, full_periods=hist_periods)
+        self.specific_risk_model = specific_risk_model
+        self.backtest_result = None
+        self.live_state = None
 
-    def run(self, ):
+    def run(self, plot=True):
         """
         The main function in this class
         1. select factors and set up the backtesting framework 
         2. calculate the historical factor returns
         3. forecast next period's factor return and covariance matrix, forecast the return and risk of the overall portfolio
         4. set up objective and constraints to solve for the optimal stock portfolio
-        5. see the backtesting results
+        5. see the backtesting results, plotting them only if 'plot' is True
         """
         self.preprocess() #step 1
         self.get_regression_results() #step 2
         self.predict() #step 3
         self.solve_opt_weights() #step 4
-        self.plot_return() #step 5
+        self.evaluate(plot=plot) #step 5
 
     @timer
-    def preprocess(self, ):
+    def preprocess(self, add_factors=True):
         """ 
             Step 1: 
             Preprocess the dataframe before starting any other steps
+        Args:
+            add_factors (bool, optional): whether to load and standardize the style factors. Pass False if df_backtest
+                already has the standardized factors, e.g. the factor panel of src/pipeline.py. Defaults to True.
         Returns:
             The updated backtesting dataframe
         """
-        self.df_backtest = preprocess.add_factors(self.df_backtest, self.style_factor_dict)
-        self.df_backtest = preprocess.standardize_factors(self.df_backtest, self.style_factors)
+        if add_factors:
+            self.df_backtest = preprocess.add_factors(self.df_backtest, self.style_factor_dict)
+            # the output of add_factors belongs to this object, so the factors can be standardized in place
+            self.df_backtest = preprocess.standardize_factors(self.df_backtest, self.style_factors, inplace=True)
+        else:
+            missing_factors = [factor for factor in self.style_factors if factor not in self.df_backtest.columns]
+            if missing_factors:
+                raise Exception(f"The style factors {missing_factors} are not in the backtesting dataframe!")
+            self.df_backtest = lightweight_copy(self.df_backtest)
         self.df_backtest[self.country_factor] = 1
 
-        # Turn the industry column into one-hot vectors
-        df_industry_dummy = pd.get_dummies(self.df_backtest[PRIMARY_INDUSTRY_COL])
-        # Set all the industry factors
-        self.industry_factors = list(df_industry_dummy.columns)
-        self.df_backtest.loc[:, self.industry_factors] = df_industry_dummy.values  
-        # Set all the factors
+        # The industry exposures are kept as one integer code per row(-1 for no industry) instead of one-hot columns, so
+        # the number of industries does not widen the panel. The regressions and the optimizer use the codes directly.
+        # Live mode keeps the industry factors of the history, a new industry only gets the country factor
+        self.stock_industry_codes, self.industry_factors = industry_codes(self.df_backtest, self.industry_col, self.industry_factors)
+        # Set all the factors, and the dense ones stored as columns of df_backtest
         self.all_factors = [self.country_factor] + self.industry_factors + self.style_factors
+        self.dense_factors = [self.country_factor] + self.style_factors
+
+        if self.uniform_benchmark:
+            # equally weighted benchmark over all stocks of the date
+            segment_index = get_segment_index(self.df_backtest)
+            self.benchmark_weight_col = 'benchmark_weight'
+            self.df_backtest[self.benchmark_weight_col] = 1 / segment_index.broadcast(segment_index.counts)
         return self.df_backtest
 
     @timer
@@ -86,26 +143,70 @@ class PortfolioOptimizer:
             Obtain the regression results on each rebalancing date, which include historical factor returns and historical idiosyncratic returns
             Store them in pandas dataframes
         Returns:
-            A list of statsmodels.wls result objects 
+            pd.DataFrame: the historical factor returns
         """
 
         # Fit a weighted least square regression model on each rebalancing date
         # Regress next period's return with the factor exposures on the current rebalancing date
         # The coefficients are the factor returns in the next period
-        def get_wls_result(df_sub):
-            import statsmodels.formula.api as smf
-            wls_result = smf.wls(formula = f"next_period_return ~ 0 + {self.country_factor} + {' + '.join(self.industry_factors)} + {' + '.join(self.style_factors)}", 
-                            data=df_sub, weights = df_sub['market_value'] ** 0.5, missing='drop').fit()
-            return wls_result
-        # multiprocessing or multithreading is not any faster than for loop here
-        self.wls_results = [get_wls_result(df_sub) for _, df_sub in self.df_backtest.groupby(level=0)] 
-        date_wls_pairs = zip(self.df_backtest.index.get_level_values(0).unique(), self.wls_results)
+        # i.e. smf.wls(f"next_period_return ~ 0 + country + C({self.industry_col}) + {style factors}", weights=market_value ** 0.5, missing='drop')
+        # The regression is solved with the industry projector of src/neutralization.py: the industry dummies are absorbed by
+        # within-industry demeaning, leaving a regression on the style factors only
+        num_industries = len(self.industry_factors)
+        # stocks without an industry only have the country factor, so they form one more group
+        codes = np.where(self.stock_industry_codes >= 0, self.stock_industry_codes, num_industries)
+        y = accumulate(self.df_backtest['next_period_return'])
+        X_style = accumulate(self.df_backtest[self.style_factors])
+        weights = accumulate(self.df_backtest['market_value']) ** 0.5
+        dates, offsets = date_segments(self.df_backtest)
+        factor_returns, residuals = [], np.full(y.shape, np.nan)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            factor_return, residuals[start: end] = self.regress_date(codes[start: end], X_style[start: end], y[start: end], weights[start: end])
+            factor_returns.append(factor_return)
         # obtain the historical factor returns
-        self.df_hist_factor_return = pd.concat({ date: wls_result.params for date, wls_result in date_wls_pairs}).unstack(level=1)
+        self.df_hist_factor_return = pd.DataFrame(factor_returns, index=dates, columns=self.all_factors)
         self.df_hist_factor_return.index.name = 'date'
         # obtain the idiosyncratic returns
-        self.df_hist_idio_return = pd.concat([wls_result.resid for wls_result in self.wls_results])
-        return self.wls_results
+        self.df_hist_idio_return = pd.Series(residuals, index=self.df_backtest.index).dropna()
+        return self.df_hist_factor_return
+
+    def regress_date(self, codes: np.ndarray, X_style: np.ndarray, y: np.ndarray, weights: np.ndarray) -> tuple:
+        """
+        Helper function for self.get_regression_results and self.rebalance
+        The WLS regression of a SINGLE rebalancing date. Rows with a missing return or market value are left out.
+
+        Args:
+            codes (np.ndarray): industry group of each stock, len(self.industry_factors) for the stocks without an industry
+        Returns:
+            tuple: (factor returns in the order of self.all_factors, residuals)
+        """
+        projector = IndustryProjector(codes, X_style, weights)
+        resid, group_coef, coef = projector.fit(y)
+        factor_return = np.concatenate([self.split_country_industry_returns(group_coef[:, 0], len(self.industry_factors)), coef[:, 0]])
+        return factor_return, resid[:, 0]
+
+    @staticmethod
+    def split_country_industry_returns(group_coef: np.ndarray, num_industries: int) -> np.ndarray:
+        """
+        Split the return of each industry group into the country factor return c and the industry factor returns b_g,
+        such that c + b_g equals the group return a_g.
+
+        The country factor is the sum of the industry dummies, so the split is not unique. Like statsmodels' pinv, we take
+        the minimum norm one: minimizing c^2 + sum((a_g - c)^2) gives c = sum(a_g) / (G + 1), where G is the number of
+        industries in the regression. Industries without any stock get 0.
+        If some stocks have no industry(group number 'num_industries'), their return identifies the country factor alone.
+
+        Returns:
+            np.ndarray: the country factor return followed by the industry factor returns
+        """
+        group_coef = np.concatenate([group_coef, np.full(num_industries + 1 - group_coef.shape[0], np.nan)])
+        industry_coef, no_industry_coef = group_coef[:num_industries], group_coef[num_industries]
+        present = ~np.isnan(industry_coef)
+        if not np.isnan(no_industry_coef):
+            country_return = no_industry_coef
+        else:
+            country_return = industry_coef[present].sum() / (present.sum() + 1)
+        return np.concatenate([[country_return], np.where(present, industry_coef - country_return, 0.)])
     
     @timer
     def predict(self, ):
@@ -124,109 +225,459 @@ class PortfolioOptimizer:
         assert( cov_nan_count_by_date == self.hist_periods)
 
         self.df_pred_idio_return = self.predict_idio_return()
+        self.df_pred_specific_risk = self.predict_specific_risk()
         self.df_pred_stock_returns = self.predict_stock_return()
         
         
     @timer
-    def solve_opt_weights(self, ):
+    def solve_opt_weights(self, solver=cp.ECOS, abs_tol=1e-8):
         """
-            Step 4: Maximize risk-adjusted return to solve for the optimal stock portfolio
+            Step 4: Maximize risk-adjusted return net of trading costs to solve for the optimal stock portfolio
+            The portfolio of each date starts from the previous date's portfolio after drifting with the returns of the
+            stocks, so the dates are solved one after another. See build_opt_problem for the problem itself.
         Returns:
-            A list of lists: The optimal weights on each rebalancing date
+            pd.Series: The optimal weights on each rebalancing date
         """
-        gamma = cp.Parameter(nonneg=True)  
-        Lmax = cp.Parameter()
-        def solve_optimal_weight(data, solver=cp.ECOS, abs_tol=1e-8):
-            """
-            Solve for the optimal weights on a SINGLE rebalancing date.
-            """
-            X_t, F_t, Delta, r = data
-            """
-            Let V be the N x N predicted stock return covariance matrix over the next period
-            V is predicted as follows: V = X * F * X.transpose() + Delta, where
-            X is the N x K factor exposure matrix on the current rebalancing date
-            F is the K x K predicted factor covariance matrix over the next period
-            Delta is the N x N predicted idiosyncratic return matrix over the next period
-
-            Objective:
-            Maximize R - gamma * var, where
-            R is the 1 x 1 predicted portfolio return over the next period
-            gamma is the 1 x 1 risk penalty coefficient. larger gamma will make the model more inclined to return and less inclined to risk 
-            var is the 1 x 1 predicted portfolio variance over the next period 
-
-            Mathematically, we have:
-            R = w.transpose * r
-            var = w.transpose * V * w
-            V is the N x N predicted stock covariance matrix
-            w is the N x 1 portfolio weight vector we wish to optimize
-
-            Constraints:
-            1) No short-selling: all weights should be non-negative
-            2) Stock diversification: Investment into any stock should be less than 1%
-            TODO: Add more constraints as outlined in Huatai's report
-            """
-            gamma.value = self.gamma
-            N = X_t.shape[0]
-            w = cp.Variable(N)
-            ret = r.T @ w
-            # Multiplying w and X first gives O(nk^2) time complexity, as opposed to O(n^3) if we calculate V first
-            # This saves tons of time!
-            variance = cp.quad_form(w.T @ X_t, F_t) + cp.sum_squares(np.sqrt(Delta) @ w) #check this out, see if it generalizes to non-diagonal matrices
- 
-            problem = cp.Problem(cp.Maximize(ret - gamma * variance), 
-                        [cp.sum(w) == 1,
-                        0 <= w,
-                        w <= 0.01, 
-                        ]
-                            )
-            """
-            cvxpy will check that the optimization problem is convex before solving it
-            If the optimization problem is not convex, one source of error can be that V is not symmetric semi-positive definite. 
-            You can verify this by checking if F and Delta are symmetric semi-positive definite or not.
-            See footnote below this class about speeding up the convex optimization problem.
-            """
-            problem.solve(verbose=False, solver=solver)
-
-            # check that the solver converges to a valid solution i.e. the obtained weight vector satisfies the above imposed constraints
-            # Use abs_tol to avoid numerical rounding issues
-            solved_weight = w.value
-            assert(abs(solved_weight.sum() - 1) < abs_tol)
-            assert(np.all(solved_weight >= 0 - abs_tol) )
-            assert(np.all(solved_weight <= 0.01 + abs_tol))
-            return w.value
-
-        def get_data_by_date(date):
-            """Given the rebalacing date, return X, F, Delta and r on that SINGLE rebalancing date.
-            """
-            X_t = self.df_backtest.loc[self.df_backtest.index.get_level_values(0) == date, self.all_factors].values
-            F_t = self.df_pred_factor_cov.loc[self.df_pred_factor_cov.index.get_level_values(0) == date, self.all_factors].values
-            u = self.df_pred_idio_return[self.df_pred_idio_return.index.get_level_values(0) == date].values
-            Delta = scipy.sparse.diags( u ** 2 )
-            r = self.df_pred_stock_returns[self.df_pred_stock_returns.index.get_level_values(0) == date].values
-            return [X_t, F_t, Delta, r]
-        
-        # Store all input data by date in a list, then loop through that list and convex-optimize the weight vectors
-        self.input_data = [ get_data_by_date(date) for date in REBALANCING_DATES[self.hist_periods: -1] ] 
-        valid_date_mask = self.df_backtest.index.get_level_values(0).isin(REBALANCING_DATES[self.hist_periods:-1])
-        self.df_backtest.loc[valid_date_mask, 'opt_weight'] = sum( [list(solve_optimal_weight(input)) for input in tqdm(self.input_data)], [])  # this line of code takes 15s ~ 20s on my laptop
+        frontier = self.sweep([self.gamma], [self.max_weight], solver=solver, abs_tol=abs_tol)
+        self.turnover = frontier.turnover.iloc[:, 0].rename('turnover')
+        self.df_backtest['opt_weight'] = frontier.weights.iloc[:, 0].values
         self.opt_weights = self.df_backtest['opt_weight']
         return self.opt_weights
 
+    def build_opt_problem(self, N: int, stock_industry_codes: np.ndarray) -> tuple:
+        """
+        Helper function for self.sweep and self.rebalance: set up the optimization problem of a SINGLE rebalancing date,
+        with the data of the date, the risk aversion and the weight cap as cvxpy Parameters
+
+        Let V be the N x N predicted stock return covariance matrix over the next period
+        V is predicted as follows: V = X * F * X.transpose() + Delta, where
+        X is the N x K factor exposure matrix on the current rebalancing date
+        F is the K x K predicted factor covariance matrix over the next period
+        Delta is the N x N predicted idiosyncratic return covariance matrix over the next period, diagonal with the
+        squared specific risks of the stocks, see src/specific_risk.py
+
+        Objective:
+        Maximize R - gamma * var - cost, where
+        R is the 1 x 1 predicted portfolio return over the next period
+        gamma is the 1 x 1 risk penalty coefficient. larger gamma will make the model more inclined to return and less inclined to risk 
+        var is the 1 x 1 predicted portfolio variance over the next period 
+        cost is the 1 x 1 trading cost of moving from the previous weights w0 to w
+
+        Mathematically, we have:
+        R = w.transpose * r
+        var = w.transpose * V * w = |L.transpose * X.transpose * w|^2 + |sqrt(Delta) * w|^2, where F = L * L.transpose
+        cost = cost_rate * |w - w0|_1 + impact_cost * |w - w0|^2
+        w is the N x 1 portfolio weight vector we wish to optimize
+
+        Constraints:
+        1) No short-selling: all weights should be non-negative
+        2) Stock diversification: Investment into any stock should be less than max_weight(1% by default)
+        3) Turnover: |w - w0|_1 <= max_turnover, if max_turnover is given. The first portfolio is built from cash without this cap.
+        4) Industry neutrality: the industry exposures of w and the benchmark weights wb are the same, if industry_neutral is True
+        5) Style exposure bounds: lower <= X_style.transpose * (w - wb) <= upper, if style_bounds are given
+        6) Tracking error: (w - wb).transpose * V * (w - wb) <= max_tracking_error^2, if max_tracking_error is given
+
+        The benchmark constraints are expressed in factor space, on the K x 1 active exposure X.transpose * (w - wb), where
+        X.transpose * wb is computed outside of the problem. Each of them adds at most K rows to the problem, whatever the
+        number of stocks.
+
+        The problem is set up once over all N stocks that ever appear in the panel: stocks not in the universe of a date
+        get an upper bound of 0, so that their previous weights are sold. cvxpy then compiles the problem only once(it
+        follows the DPP rules, which is why products of parameters such as sqrt(gamma) * L or L.transpose * X.transpose * wb
+        are computed outside of the problem), and each solve only updates the parameter values.
+        All the cost terms are elementwise, so the problem stays as sparse as without them.
+        The industry columns of X are a constant sparse N x G one-hot matrix built from 'stock_industry_codes', only the
+        country and style columns are a dense Parameter, so the problem grows with N and not with N x G.
+
+        Args:
+            N (int): number of stocks
+            stock_industry_codes (np.ndarray): industry code of each of the N stocks, -1 for no industry
+        Returns:
+            tuple: (problem, dict of its parameters and variables)
+        """
+        K, G = len(self.all_factors), len(self.industry_factors)
+        w = cp.Variable(N)
+        factor_exposure = cp.Variable(K)
+        params = {
+            # exposures to self.dense_factors
+            'X': cp.Parameter((N, len(self.dense_factors))),
+            'L': cp.Parameter((K, K)),
+            'sqrt_delta': cp.Parameter(N, nonneg=True),
+            # sqrt(gamma) * L and sqrt(gamma) * sqrt(Delta), so that gamma * var stays DPP
+            'risk_L': cp.Parameter((K, K)),
+            'risk_sqrt_delta': cp.Parameter(N, nonneg=True),
+            'r': cp.Parameter(N),
+            'upper_bound': cp.Parameter(N, nonneg=True),
+            'w0': cp.Parameter(N, nonneg=True),
+            'turnover_cap': cp.Parameter(nonneg=True),
+            'benchmark_exposure': cp.Parameter(K),
+            # sqrt(Delta) * wb
+            'scaled_benchmark_weight': cp.Parameter(N),
+            # L.transpose * X.transpose * wb, so that the tracking error stays DPP
+            'scaled_benchmark_exposure': cp.Parameter(K),
+        }
+        trades = w - params['w0']
+        active_exposure = factor_exposure - params['benchmark_exposure']
+        risk_penalty = cp.sum_squares(params['risk_L'].T @ factor_exposure) + cp.sum_squares(cp.multiply(params['risk_sqrt_delta'], w))
+        cost = self.cost_rate * cp.norm1(trades) + self.impact_cost * cp.sum_squares(trades)
+        industry_exposure = self.get_industry_exposure(stock_industry_codes)
+        constraints = [cp.sum(w) == 1, 0 <= w, w <= params['upper_bound'],
+                       factor_exposure[self.dense_positions()] == params['X'].T @ w]
+        if G > 0:
+            constraints.append(factor_exposure[1: 1 + G] == industry_exposure.T @ w)
+        if self.max_turnover is not None:
+            constraints.append(cp.norm1(trades) <= params['turnover_cap'])
+        constraints += self.get_benchmark_constraints(active_exposure)
+        if self.max_tracking_error is not None:
+            active_variance = cp.sum_squares(params['L'].T @ factor_exposure - params['scaled_benchmark_exposure']) \
+                + cp.sum_squares(cp.multiply(params['sqrt_delta'], w) - params['scaled_benchmark_weight'])
+            constraints.append(active_variance <= self.max_tracking_error ** 2)
+        problem = cp.Problem(cp.Maximize(params['r'] @ w - risk_penalty - cost), constraints)
+        """
+        cvxpy will check that the optimization problem is convex before solving it
+        If the optimization problem is not convex, one source of error can be that V is not symmetric semi-positive definite. 
+        You can verify this by checking if F and Delta are symmetric semi-positive definite or not.
+        See footnote below this class about speeding up the convex optimization problem.
+        """
+        params['w'] = w
+        params['industry_exposure'] = industry_exposure
+        return problem, params
+
+    def dense_positions(self) -> np.ndarray:
+        """positions of self.dense_factors in self.all_factors"""
+        return np.concatenate([[0], np.arange(1 + len(self.industry_factors), len(self.all_factors))])
+
+    def get_industry_exposure(self, stock_industry_codes: np.ndarray) -> sp.csr_matrix:
+        """N x G sparse one-hot industry exposures of the stocks with the given industry codes, -1 for no industry"""
+        rows = np.flatnonzero(stock_industry_codes >= 0)
+        return sp.csr_matrix((np.ones(rows.shape[0]), (rows, stock_industry_codes[rows])),
+                             shape=(stock_industry_codes.shape[0], len(self.industry_factors)))
+
+    def get_factor_exposure(self, X: np.ndarray, industry_exposure: sp.csr_matrix, w: np.ndarray) -> np.ndarray:
+        """
+        K x 1 factor exposures X.transpose * w of a portfolio, in the order of self.all_factors
+        Args:
+            X (np.ndarray): N x D exposures to self.dense_factors
+            industry_exposure (sp.csr_matrix): N x G one-hot industry exposures
+        """
+        factor_exposure = np.empty(len(self.all_factors))
+        factor_exposure[self.dense_positions()] = X.T @ w
+        factor_exposure[1: 1 + len(self.industry_factors)] = industry_exposure.T @ w
+        return factor_exposure
+
     @timer
-    def plot_return(self, ):
+    def sweep(self, gammas, max_weights=None, solver=cp.ECOS, abs_tol=1e-8, solver_options=None) -> 'Frontier':
         """
-        Step 5: Calculate the cumulative return series and visualize the backtesting results
-        TODO: Add more functionalities, such as sharpe ratio, win rate, etc. The best way to achieve this would be to create a 'BacktestingResult' class that takes a cumulative return series as argument, and can plot the relevant figures and print out a table.
+        Solve the optimal portfolios for every combination of risk aversion and weight cap, on every rebalancing date.
+        Steps 1-3 are run once and shared by all combinations; on each date the risk model inputs are set once, then the
+        combinations are solved one after another with the same compiled problem, so the problem is only canonicalized
+        once. The default ECOS is an interior point solver, which cannot warm start: every solve starts from scratch.
+        The combinations are sorted by gamma, so SCS and OSQP do warm start from the neighbouring gamma's solution,
+        but at the accuracy the weight checks need(abs_tol) they are still slower than ECOS.
+        Each combination keeps its own previous portfolio for the trading costs and turnover constraint.
+
+        Args:
+            gammas (Iterable): risk aversion coefficients
+            max_weights (Iterable, optional): caps on the weight of any stock. Defaults to None, which uses self.max_weight.
+            solver_options (dict, optional): passed to the solver, e.g. {'eps_abs': 1e-9, 'eps_rel': 1e-9} for SCS to meet
+                abs_tol. Defaults to None.
+
+        Returns:
+            Frontier: the weights, expected returns and risks by (gamma, max_weight) and date
         """
-        # calculate portfolio return in each period
-        self.df_backtest['weighted_return'] = self.df_backtest['next_period_return'].values * self.df_backtest['opt_weight'].values
+        max_weights = [self.max_weight] if max_weights is None else list(max_weights)
+        configs = [(gamma, max_weight) for max_weight in max_weights for gamma in sorted(gammas)]
+        segment_index = get_segment_index(self.df_backtest)
+        stock_codes, stocks = pd.factorize(self.df_backtest.index.get_level_values(1))
+        N, D = len(stocks), len(self.dense_factors)
+        # the industry exposures are constants of the problem, so each stock must keep its industry over the backtest
+        stock_industry_codes = np.full(N, -1)
+        stock_industry_codes[stock_codes] = self.stock_industry_codes
+        if (stock_industry_codes[stock_codes] != self.stock_industry_codes).any():
+            raise Exception(f"Some stocks change their '{self.industry_col}' over the backtest, which the optimizer does not support!")
+        problem, params = self.build_opt_problem(N, stock_industry_codes)
+        self.opt_problem = problem
+
+        def set_data_by_date(t):
+            """Given the index of the rebalacing date, set X, F, Delta and r on that SINGLE rebalancing date.
+            The solver always gets float64 inputs, even if the panel is stored in float32.
+            """
+            date, start, end = segment_index.dates[t], segment_index.offsets[t], segment_index.offsets[t + 1]
+            rows = stock_codes[start: end]
+            X_full, r_full, sqrt_delta, wb = np.zeros((N, D)), np.zeros(N), np.zeros(N), np.zeros(N)
+            X_full[rows] = accumulate(self.df_backtest[self.dense_factors].iloc[start: end])
+            r_full[rows] = accumulate(self.df_pred_stock_returns.iloc[start: end])
+            sqrt_delta[rows] = np.nan_to_num(accumulate(self.df_pred_specific_risk.iloc[start: end]))
+            wb[rows] = np.nan_to_num(accumulate(self.df_backtest[self.benchmark_weight_col].iloc[start: end]))
+            wb /= wb.sum()
+            F_t = accumulate(self.df_pred_factor_cov.loc[self.df_pred_factor_cov.index.get_level_values(0) == date, self.all_factors])
+            self.set_date_params(params, X_full, F_t, sqrt_delta, r_full, wb)
+            return rows
 
-        # calculate the cumulative portfolio return series
-        self.df_portfolio_returns = self.df_backtest.groupby(level=0)['weighted_return'].apply(lambda df: df.sum(skipna=False))
-        self.df_portfolio_cum_returns = (1 + self.df_portfolio_returns).cumprod()
-        # plot it out
-        # sns.distplot( df_portfolio_returns)
-        self.df_portfolio_cum_returns.plot()
+        # every rebalancing date of the panel with enough history, except the last rebalancing date which has no next period
+        date_positions = np.arange(self.hist_periods, len(segment_index))
+        date_positions = date_positions[segment_index.dates[date_positions] != REBALANCING_DATES[-1]]
+        realized_returns = np.nan_to_num(accumulate(self.df_backtest['next_period_return']))
+        weights = np.full((self.df_backtest.shape[0], len(configs)), np.nan)
+        expected_returns, risks, turnover = [np.full((len(date_positions), len(configs)), np.nan) for _ in range(3)]
+        previous = np.zeros((len(configs), N))
+        for i, t in enumerate(tqdm(date_positions)):
+            rows = set_data_by_date(t)
+            start, end = segment_index.offsets[t], segment_index.offsets[t + 1]
+            in_universe = np.zeros(N)
+            in_universe[rows] = 1.
+            stock_returns = np.zeros(N)
+            stock_returns[rows] = realized_returns[start: end]
+            for j, (gamma, max_weight) in enumerate(configs):
+                # the first portfolio is built from cash, which trades the whole portfolio
+                solved_weight = self.solve_date(problem, params, segment_index.dates[t], gamma, max_weight, in_universe, previous[j],
+                                                cap_turnover=i > 0, solver=solver, abs_tol=abs_tol, solver_options=solver_options)
+                weights[start: end, j] = solved_weight[rows]
+                expected_returns[i, j] = params['r'].value @ solved_weight
+                factor_exposure = self.get_factor_exposure(params['X'].value, params['industry_exposure'], solved_weight)
+                risks[i, j] = np.sqrt(np.sum((params['L'].value.T @ factor_exposure) ** 2)
+                                      + np.sum((params['sqrt_delta'].value * solved_weight) ** 2))
+                turnover[i, j] = np.abs(solved_weight - previous[j]).sum()
+                # drift the weights with the realized returns until the next rebalancing date
+                drifted = np.clip(solved_weight, 0, None) * (1 + stock_returns)
+                previous[j] = drifted / drifted.sum()
+        return Frontier(configs, self.df_backtest.index, segment_index.dates[date_positions], weights, expected_returns, risks, turnover)
+
+    def set_date_params(self, params: dict, X: np.ndarray, F: np.ndarray, sqrt_delta: np.ndarray, r: np.ndarray, wb: np.ndarray):
+        """
+        Helper function for self.sweep and self.rebalance
+        Set the data of a SINGLE rebalancing date on the parameters of build_opt_problem: the N x D exposures X to
+        self.dense_factors, the K x K factor covariance F, the N x 1 idiosyncratic volatilities sqrt(Delta), predicted
+        returns r and benchmark weights wb
+        """
+        # F = L * L.transpose with the eigen-decomposition, which also works for singular covariance matrices
+        eigenvalues, eigenvectors = np.linalg.eigh((F + F.T) / 2)
+        params['X'].value, params['L'].value = X, eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+        params['sqrt_delta'].value, params['r'].value = sqrt_delta, r
+        params['benchmark_exposure'].value = self.get_factor_exposure(X, params['industry_exposure'], wb)
+        params['scaled_benchmark_exposure'].value = params['L'].value.T @ params['benchmark_exposure'].value
+        params['scaled_benchmark_weight'].value = sqrt_delta * wb
+
+    def solve_date(self, problem, params: dict, date, gamma: float, max_weight: float, in_universe: np.ndarray, w0: np.ndarray,
+                   cap_turnover=True, solver=cp.ECOS, abs_tol=1e-8, solver_options=None) -> np.ndarray:
+        """
+        Helper function for self.sweep and self.rebalance
+        Solve the problem of a SINGLE rebalancing date, set by set_date_params, for one risk aversion and weight cap
+
+        Args:
+            in_universe (np.ndarray): N x 1, 1 for the stocks in the universe of the date and 0 for the others
+            w0 (np.ndarray): N x 1 previous portfolio, after drifting with the returns
+            cap_turnover (bool, optional): whether to apply max_turnover. Defaults to True.
+            solver_options (dict, optional): keyword arguments of the solver, see self.sweep. Defaults to None.
+        Returns:
+            np.ndarray: the N x 1 optimal weights
+        """
+        params['risk_L'].value = np.sqrt(gamma) * params['L'].value
+        params['risk_sqrt_delta'].value = np.sqrt(gamma) * params['sqrt_delta'].value
+        params['upper_bound'].value = max_weight * in_universe
+        params['w0'].value = w0
+        params['turnover_cap'].value = self.max_turnover if (self.max_turnover is not None and cap_turnover) else 2.
+        problem.solve(verbose=False, solver=solver, warm_start=True, **(solver_options or {}))
+        if problem.status not in cp.settings.SOLUTION_PRESENT and self.max_turnover is not None:
+            # e.g. when more than 'max_turnover' has to be sold because stocks left the universe
+            warnings.warn(f"The turnover cap is infeasible on {date:%Y-%m-%d}, solving without it")
+            params['turnover_cap'].value = 2.
+            problem.solve(verbose=False, solver=solver, warm_start=True, **(solver_options or {}))
+        if problem.status not in cp.settings.SOLUTION_PRESENT:
+            raise Exception(f"The portfolio optimization problem is {problem.status} on {date:%Y-%m-%d} "
+                            f"with gamma={gamma}, max_weight={max_weight}! Check the constraints.")
+
+        # check that the solver converges to a valid solution i.e. the obtained weight vector satisfies the above imposed constraints
+        # Use abs_tol to avoid numerical rounding issues
+        solved_weight = params['w'].value
+        assert(abs(solved_weight.sum() - 1) < abs_tol)
+        assert(np.all(solved_weight >= 0 - abs_tol) )
+        assert(np.all(solved_weight <= params['upper_bound'].value + abs_tol))
+        return solved_weight
+
+    def get_benchmark_constraints(self, active_exposure) -> list:
+        """
+        Helper function for self.solve_opt_weights
+        Linear constraints on the K x 1 active factor exposure X.transpose * (w - wb): industry neutrality and style bounds
+        """
+        constraints = []
+        if self.industry_neutral:
+            industry_positions = [self.all_factors.index(factor) for factor in self.industry_factors]
+            constraints.append(active_exposure[industry_positions] == 0)
+        if self.style_bounds is not None:
+            style_bounds = self.style_bounds
+            if not isinstance(style_bounds, dict):
+                style_bounds = {factor: (-style_bounds, style_bounds) for factor in self.style_factors}
+            for factor in style_bounds:
+                if factor not in self.style_factors:
+                    raise Exception(f"'{factor}' is not a style factor! Choose from {self.style_factors}")
+            positions = [self.all_factors.index(factor) for factor in style_bounds]
+            lower, upper = np.array(list(style_bounds.values()), dtype=np.float64).reshape(-1, 2).T
+            constraints += [lower <= active_exposure[positions], active_exposure[positions] <= upper]
+        return constraints
+
+    @timer
+    def evaluate(self, plot=True) -> BacktestResult:
+        """
+        Step 5: Calculate the portfolio returns, net asset value, drawdowns and turnover of the optimal portfolios
+        See src/backtest_result.py for the statistics, e.g. self.backtest_result.get_summary()
+        """
+        self.backtest_result = BacktestResult.from_panel(self.df_backtest, 'opt_weight', benchmark_weight_col=self.benchmark_weight_col,
+                                                         cost_rate=self.cost_rate)
+        # the portfolio return in each period, missing on the dates without optimal weights
+        segment_index = get_segment_index(self.df_backtest)
+        self.df_portfolio_returns = self.backtest_result.returns.reindex(segment_index.dates).rename('weighted_return')
+        self.df_portfolio_cum_returns = self.backtest_result.nav
+        if plot:
+            self.backtest_result.get_graph(title='Optimal portfolio')
+        return self.backtest_result
+
+    def get_live_state(self) -> dict:
+        """
+        The rolling state live mode needs to solve the next rebalancing date, see self.rebalance:
+        the parameters of the optimizer, the last 'hist_periods' factor returns, and the cross-section and optimal weights
+        of the last solved date. After self.run it is built from the last optimized date of the backtest.
+        """
+        if self.live_state is not None:
+            return self.live_state
+        if getattr(self, 'opt_weights', None) is None:
+            raise Exception("Run the optimizer or load a live state first!")
+        opt_weights = self.opt_weights.dropna()
+        date = opt_weights.index.get_level_values(0).max()
+        columns = self.style_factors + [self.industry_col, 'market_value', 'close', 'next_period_return']
+        if not self.uniform_benchmark:
+            columns.append(self.benchmark_weight_col)
+        self.live_state = {
+            'params': {'style_factor_dict': self.style_factor_dict, 'hist_periods': self.hist_periods, 'gamma': self.gamma,
+                       'cost_rate': self.cost_rate, 'impact_cost': self.impact_cost, 'max_turnover': self.max_turnover,
+                       'benchmark_weight_col': None if self.uniform_benchmark else self.benchmark_weight_col,
+                       'industry_neutral': self.industry_neutral, 'style_bounds': self.style_bounds,
+                       'max_tracking_error': self.max_tracking_error, 'max_weight': self.max_weight,
+                       'industry_col': self.industry_col},
+            'industry_factors': self.industry_factors,
+            # its state is at the last date with idiosyncratic returns, i.e. 'date'
+            'specific_risk_model': self.specific_risk_model,
+            'factor_returns': self.df_hist_factor_return.loc[:date].iloc[-self.hist_periods:],
+            'date': date,
+            'cross_section': self.df_backtest.loc[date, columns],
+            'weights': opt_weights.loc[date],
+        }
+        return self.live_state
+
+    def save_live_state(self, path: str):
+        """pickle the live state, see self.get_live_state"""
+        with open(path, 'wb') as file:
+            pickle.dump(self.get_live_state(), file)
+
+    @classmethod
+    def from_live_state(cls, path: str) -> 'PortfolioOptimizer':
+        """an optimizer that continues from a pickled live state, with the parameters it was saved with"""
+        with open(path, 'rb') as file:
+            live_state = pickle.load(file)
+        optimizer = cls(None, **live_state['params'])
+        optimizer.specific_risk_model = live_state['specific_risk_model']
+        optimizer.live_state = live_state
+        return optimizer
+
+    @timer
+    def rebalance(self, df_latest: pd.DataFrame, prices: pd.Series = None, add_factors=True, solver=cp.ECOS, abs_tol=1e-8) -> pd.Series:
+        """
+        Live mode: solve the optimal portfolio of the upcoming rebalancing date only, continuing from the live state of
+        the previous one instead of recomputing the history, so the time taken does not grow with the history
+        1. regress the factor returns of the previous date, with the returns its stocks realized since(from their close
+           prices to the open prices of df_latest, like 'next_period_return'), unless they are known already, and fold
+           its idiosyncratic returns into the specific risk model
+        2. forecast the factor returns and covariance matrix from the last 'hist_periods' factor returns, and the
+           specific risks of the new stocks
+        3. drift the previous optimal weights with the realized returns, and solve the problem of the new date
+        The live state is then moved to the new date, save it with self.save_live_state for the next call.
+
+        Args:
+            df_latest (pd.DataFrame): the stocks of the new rebalancing date, with multi-index (date, stock), e.g. from
+                preprocess.get_cross_section
+            prices (pd.Series, optional): the open prices of all stocks on the new date indexed by stock, before the
+                universe filter, e.g. from preprocess.get_open_prices. The previous stocks that left the universe are
+                missing from df_latest, without them their returns are unknown: they are left out of the regression
+                and drifted with a 0 return. Defaults to None.
+            add_factors (bool, optional): whether to load and standardize the style factors, as in self.preprocess.
+                Defaults to True.
+        Returns:
+            pd.Series: the optimal weights of the new date
+        """
+        state = self.get_live_state()
+        dates = df_latest.index.get_level_values(0).unique()
+        if len(dates) != 1:
+            raise Exception(f"df_latest must have a single rebalancing date, not {len(dates)}!")
+        date = dates[0]
+        if date <= state['date']:
+            raise Exception(f"{date:%Y-%m-%d} is not after the last solved date {state['date']:%Y-%m-%d}!")
+        self.industry_factors = state['industry_factors']
+        if add_factors:
+            df_latest = preprocess.add_factors(df_latest, self.style_factor_dict)
+            # keep the stocks without 'next_period_return', which is never known on the new date
+            df_latest = preprocess.standardize_factors(df_latest, self.style_factors, filter_out_missing_values_or_not=False, inplace=True)
+        self.df_backtest = df_latest
+        self.preprocess(add_factors=False)
+
+        # step 1
+        previous = state['cross_section']
+        open_prices = self.df_backtest['open'].droplevel(0).reindex(previous.index)
+        if prices is not None:
+            open_prices = open_prices.fillna(prices.reindex(previous.index))
+        realized_returns = previous['next_period_return'].fillna((open_prices - previous['close']) / previous['close'])
+        factor_returns = state['factor_returns']
+        specific_risk_model = state['specific_risk_model']
+        if state['date'] not in factor_returns.index or specific_risk_model.date != state['date']:
+            codes, _ = industry_codes(previous, self.industry_col, self.industry_factors)
+            codes = np.where(codes >= 0, codes, len(self.industry_factors))
+            factor_return, residuals = self.regress_date(codes, accumulate(previous[self.style_factors]), accumulate(realized_returns),
+                                                         accumulate(previous['market_value']) ** 0.5)
+            if state['date'] not in factor_returns.index:
+                factor_returns = pd.concat([factor_returns, pd.DataFrame([factor_return], index=pd.DatetimeIndex([state['date']], name='date'),
+                                                                         columns=self.all_factors)])
+            if specific_risk_model.date != state['date']:
+                specific_risk_model.update(state['date'], pd.Series(residuals, index=previous.index).dropna())
+        factor_returns = factor_returns.iloc[-self.hist_periods:]
+        if len(factor_returns) < self.hist_periods:
+            raise Exception(f"The live state has {len(factor_returns)} periods of factor returns, {self.hist_periods} are needed!")
+
+        # step 2
+        self.df_hist_factor_return = factor_returns
+        pred_factor_return = accumulate(factor_returns.mean())
+        pred_factor_cov = accumulate(factor_returns.cov())
+        self.specific_risk_model = specific_risk_model
+        self.df_pred_specific_risk = specific_risk_model.predict(self.df_backtest)
+
+        # step 3
+        previous_weights = state['weights'][state['weights'] > 0]
+        drifted = previous_weights * (1 + realized_returns.reindex(previous_weights.index).fillna(0))
+        drifted /= drifted.sum()
+        universe_stocks = self.df_backtest.index.get_level_values(1)
+        # the stocks that left the universe are still held, and must be sold
+        stocks = universe_stocks.append(drifted.index.difference(universe_stocks))
+        N, rows = len(stocks), np.arange(len(universe_stocks))
+        X, sqrt_delta, wb, in_universe = np.zeros((N, len(self.dense_factors))), np.zeros(N), np.zeros(N), np.zeros(N)
+        X[rows] = accumulate(self.df_backtest[self.dense_factors])
+        sqrt_delta[rows] = np.nan_to_num(accumulate(self.df_pred_specific_risk))
+        wb[rows] = np.nan_to_num(accumulate(self.df_backtest[self.benchmark_weight_col]))
+        wb /= wb.sum()
+        in_universe[rows] = 1.
+        stock_industry_codes = np.concatenate([self.stock_industry_codes, np.full(N - len(rows), -1)])
+        problem, params = self.build_opt_problem(N, stock_industry_codes)
+        # idiosyncratic returns are not predicted, see predict_idio_return
+        pred_stock_return = X @ pred_factor_return[self.dense_positions()] + params['industry_exposure'] @ pred_factor_return[1: 1 + len(self.industry_factors)]
+        self.set_date_params(params, X, pred_factor_cov, sqrt_delta, pred_stock_return, wb)
+        solved_weight = self.solve_date(problem, params, date, self.gamma, self.max_weight, in_universe,
+                                        accumulate(drifted.reindex(stocks).fillna(0)), solver=solver, abs_tol=abs_tol)
+        self.turnover = pd.Series([np.abs(solved_weight - params['w0'].value).sum()], index=dates, name='turnover')
+        self.df_backtest['opt_weight'] = solved_weight[rows]
+        self.opt_weights = self.df_backtest['opt_weight']
+
+        columns = list(state['cross_section'].columns)
+        cross_section = self.df_backtest.reindex(columns=columns).loc[date]
+        self.live_state = dict(state, factor_returns=factor_returns, date=date, cross_section=cross_section,
+                               weights=self.opt_weights.loc[date])
+        return self.opt_weights
 
     def predict_factor_return(self, method=None):
         #helper function for self.predict
@@ -244,8 +695,15 @@ class PortfolioOptimizer:
             #TODO: Implement other advanced methods for forecasting factor covariance
             pass
         else:
-            #Naive covariance matrix estimation
-            df_pred_factor_cov = self.df_hist_factor_return.rolling(self.hist_periods).cov().groupby(level=1).shift(1)
+            #Naive covariance matrix estimation, same as
+            #self.df_hist_factor_return.rolling(self.hist_periods).cov().groupby(level=1).shift(1)
+            #but from running sums, whose cost does not grow with the number of pairs of factors, see comb.rolling_mean_cov
+            _, cov = comb.rolling_mean_cov(accumulate(self.df_hist_factor_return), self.hist_periods, min_periods=self.hist_periods)
+            # the covariance predicted on each date is the one of the previous periods
+            cov = np.concatenate([np.full((1, ) + cov.shape[1:], np.nan), cov[:-1]])
+            dates = self.df_hist_factor_return.index
+            df_pred_factor_cov = pd.DataFrame(cov.reshape(-1, cov.shape[2]), columns=self.df_hist_factor_return.columns,
+                                              index=pd.MultiIndex.from_product([dates, self.df_hist_factor_return.columns], names=[dates.name, None]))
         return df_pred_factor_cov
     
     def predict_idio_return(self, method=None):
@@ -256,6 +714,14 @@ class PortfolioOptimizer:
         else:
             #No prediction at all, based on the assumption that idiosyncratic return represents the unpredictable portion of stock return
             return pd.Series(0, index=self.df_backtest.index)
+
+    def predict_specific_risk(self) -> pd.Series:
+        """
+        Helper function for self.predict
+        Forecast the specific risk(volatility of the idiosyncratic return, sqrt(Delta)) of every stock on every
+        rebalancing date from the idiosyncratic returns of the previous dates, see src/specific_risk.py
+        """
+        return self.specific_risk_model.fit(self.df_hist_idio_return, self.df_backtest)
     
     def predict_stock_return(self, ) -> pd.Series:
         """
@@ -265,20 +731,84 @@ class PortfolioOptimizer:
             K is the # of factors on the current rebalancing date
             r is the predicted N x 1 stock return vector over the next period
             We predict r as follows:
-            r = X x f + u
+            r = X x f + u, where the industry part of X x f is the predicted return of the industry of each stock
             X is a N x K factor exposure matrix on the current rebalancing date
             f is the predicted K x 1 factor return vector over the next period
             u is the predicted N x 1 idiosyncratic return vector over the next period
         Returns:
             pd.Series: the predicted N x 1 stock return vector over the next period
         """
-        X = self.df_backtest[self.all_factors]
-        f = pd.merge(self.df_pred_factor_return, X[[]], how='right', left_on='date', right_on='date', )
+        segment_index = get_segment_index(self.df_backtest)
+        # row of each stock in the T x K predicted factor returns
+        date_codes = segment_index.broadcast(np.arange(len(segment_index)))
+        f = accumulate(self.df_pred_factor_return.reindex(segment_index.dates)[self.all_factors])
+        X = accumulate(self.df_backtest[self.dense_factors])
         u = self.df_pred_idio_return
         # u = pd.merge(X[[]], self.df_pred_idio_return.rename('idio_return'), how='left', left_index=True, right_index=True)['idio_return']
-        self.df_pred_stock_returns = pd.Series((X.values * f.values).sum(axis=1) + u.values, index=X.index, name='predicted_stock_return')
+        industry_return = f[date_codes, 1 + np.where(self.stock_industry_codes >= 0, self.stock_industry_codes, 0)]
+        industry_return = np.where(self.stock_industry_codes >= 0, industry_return, 0.)
+        dense_return = np.einsum('nk,nk->n', X, f[:, self.dense_positions()][date_codes])
+        self.df_pred_stock_returns = pd.Series(dense_return + industry_return + u.values, index=self.df_backtest.index, name='predicted_stock_return')
         return self.df_pred_stock_returns
 
+class Frontier:
+    """
+    Optimal portfolios of PortfolioOptimizer.sweep, by (gamma, max_weight) combination and rebalancing date.
+    The combinations are the columns of every dataframe: 'weights' has the stocks of the panel as rows(missing on the
+    dates that are not optimized), 'expected_returns', 'risks'(predicted standard deviations of the portfolio returns)
+    and 'turnover' have the optimized rebalancing dates as rows.
+    """
+    def __init__(self, configs, panel_index, dates, weights, expected_returns, risks, turnover):
+        self.configs = pd.MultiIndex.from_tuples(configs, names=['gamma', 'max_weight'])
+        self.weights = pd.DataFrame(weights, index=panel_index, columns=self.configs)
+        self.expected_returns = pd.DataFrame(expected_returns, index=dates, columns=self.configs)
+        self.risks = pd.DataFrame(risks, index=dates, columns=self.configs)
+        self.turnover = pd.DataFrame(turnover, index=dates, columns=self.configs)
+
+    def get_weights(self, gamma: float, max_weight=None) -> pd.Series:
+        """the optimal weights of one combination, the only max_weight if not given"""
+        if max_weight is None:
+            max_weights = self.configs.get_level_values('max_weight').unique()
+            if len(max_weights) > 1:
+                raise Exception(f"The sweep has several max_weights {list(max_weights)}, choose one!")
+            max_weight = max_weights[0]
+        if (gamma, max_weight) not in self.configs:
+            raise Exception(f"(gamma={gamma}, max_weight={max_weight}) is not in the sweep!")
+        return self.weights[(gamma, max_weight)].rename('opt_weight')
+
+    def get_summary(self) -> pd.DataFrame:
+        """average expected return, risk and turnover over the rebalancing dates, for each combination"""
+        summary = pd.DataFrame({'expected_return': self.expected_returns.mean(), 'risk': self.risks.mean(),
+                                'turnover': self.turnover.mean()})
+        summary['return_to_risk'] = summary['expected_return'] / summary['risk']
+        return summary
+
+    def get_backtest_results(self, df_backtest: pd.DataFrame, benchmark_weight_col=None, cost_rate=0.) -> dict:
+        """
+        Backtest every combination on the panel the sweep was run on.
+
+        Returns:
+            dict: (gamma, max_weight) -> BacktestResult
+        """
+        df = df_backtest[['next_period_return'] + ([benchmark_weight_col] if benchmark_weight_col else [])].copy(deep=False)
+        results = {}
+        for config in self.configs:
+            df['opt_weight'] = self.weights[config].values
+            results[config] = BacktestResult.from_panel(df, 'opt_weight', benchmark_weight_col=benchmark_weight_col, cost_rate=cost_rate)
+        return results
+
+    def get_graph(self):
+        """the frontier of average risk vs average expected return, one line per max_weight"""
+        import matplotlib.pyplot as plt
+        summary = self.get_summary()
+        fig, ax = plt.subplots()
+        for max_weight, df in summary.groupby(level='max_weight'):
+            ax.plot(df['risk'], df['expected_return'], marker='o', label=f'max_weight={max_weight}')
+        ax.set_xlabel('predicted risk')
+        ax.set_ylabel('expected return')
+        ax.set_title('Efficient frontier')
+        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        return fig
 
 
 """
@@ -294,6 +824,7 @@ Following https://colab.research.google.com/github/cvxgrp/cvx_short_course/blob/
 
 3. Set up the problem at the beginning and change values in each iteration (Failed)
 Because the dimension of matrices are changing in each iteration, it seems like we cannot save the setup time by setting up variables at the beginning and changing the variable values during each iteration.
+Update: this works once the problem is set up over all stocks that ever appear in the panel, with an upper bound of 0 on the stocks outside the universe of the date. The dimensions then stay fixed, cvxpy compiles the problem only once, and the previous date's portfolio can be passed in for the trading costs and turnover constraint. See solve_opt_weights.
 
 4. Use a more efficient version of BLAS (Ongoing)
 As introduced in https://markus-beuckelmann.de/blog/boosting-numpy-blas.html , there are four versions of BLAS & LAPACK, 
@@ -0,0 +1,58 @@
+"""
+Precision policy of the backtesting panel.
+
+By default everything is stored and computed in float64. With set_precision('float32'), factor exposures, returns,
+prices and market values are stored as float32 in the panel, which halves its memory and lets numpy/pandas process
+twice as many values per SIMD instruction. Numerically sensitive steps(regressions, covariance matrices, the
+standardization statistics and the optimizer inputs) still upcast their inputs to float64 through 'accumulate', so
+only the storage loses precision.
+
+Use benchmarks/precision_check.py to check that the float32 results stay within tolerance of the float64 ones.
+The policy can also be set with the environment variable MULTIFACTOR_PRECISION=float32 before importing src.
+"""
+import os
+from contextlib import contextmanager
+import numpy as np
+
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+# tolerance of the sanity checks on stored values, e.g. that standardized factors have mean 0 and std 1
+TOLERANCES = {'float64': 1e-10, 'float32': 1e-5}
+
+_policy = {'precision': os.environ.get('MULTIFACTOR_PRECISION', 'float64')}
+assert(_policy['precision'] in PRECISIONS), f"MULTIFACTOR_PRECISION must be one of {list(PRECISIONS)}"
+
+def set_precision(precision: str):
+    if precision not in PRECISIONS:
+        raise Exception(f"'{precision}' is not a valid precision! Choose from {list(PRECISIONS)}")
+    _policy['precision'] = precision
+
+def get_precision() -> str:
+    return _policy['precision']
+
+@contextmanager
+def precision_policy(precision: str):
+    """temporarily switch the precision policy, e.g. with precision_policy('float32'): ..."""
+    previous = get_precision()
+    set_precision(precision)
+    try:
+        yield
+    finally:
+        set_precision(previous)
+
+def storage_dtype():
+    return PRECISIONS[get_precision()]
+
+def tolerance() -> float:
+    return TOLERANCES[get_precision()]
+
+def to_storage(values):
+    """Cast the floating point values of an array/series/dataframe to the storage dtype, without copying if it already is"""
+    if isinstance(values, np.ndarray):
+        return values.astype(storage_dtype(), copy=False) if values.dtype.kind == 'f' else values
+    return values.astype(storage_dtype(), copy=False)
+
+def accumulate(values) -> np.ndarray:
+    """float64 version of an array/series/dataframe, for regressions, covariances and other accumulations"""
+    if hasattr(values, 'values'):
+        values = values.values
+    return np.asarray(values, dtype=np.float64)
@@ -2,7 +2,10 @@ from src.constants import *
 from src.utils import *
 import pandas as pd
 import src.dataloader as dl
-import matplotlib.pyplot as plt
+import src.universe as universe
+from src.panel import lightweight_copy, assign_columns, join_columns, get_segment_index
+import src.precision as precision
+import src.kernels as kernels
 import numpy as np
 
 class TimeAndStockFilter:
@@ -20,8 +23,17 @@ class TimeAndStockFilter:
     - 剔除ST，停牌和次新股（上市未满一年的股票）
     """
     @timer
-    def __init__(self, df_basic_info, ):
-        self.df_backtest = df_basic_info.copy()
+    def __init__(self, df_basic_info, universe_definition=universe.DEFAULT_UNIVERSE):
+        """
+        Args:
+            df_basic_info (pd.DataFrame): the daily information of all stocks on all trading days
+            universe_definition (tuple, optional): the conditions a stock must satisfy on a rebalancing date to be kept,
+                                                   see src/universe.py. Defaults to no ST, no suspension and listed for one year.
+        """
+        # the columns replaced in 'preprocess' never write into df_basic_info, so a shallow copy is enough
+        self.df_backtest = lightweight_copy(df_basic_info)
+        self.universe_definition = universe_definition
+        self.universe = None
 
     @timer
     def preprocess(self, ):
@@ -55,32 +67,23 @@ class TimeAndStockFilter:
         stock_names = self.df_backtest['stock'].unique()
         dates = self.df_backtest['date'].unique()
 
-        # load st/suspend/listed date data from local computer
-        df_is_st = dl.load_st_data(stock_names, dates)
-        df_is_suspended = dl.load_suspended_data(stock_names, dates)
-        df_listed_dates = dl.load_listed_dates(stock_names)
-
-        # create is_st, is_suspended and listed date columns
-        self.df_backtest = self.df_backtest.merge(df_is_st, how='left', left_on=INDEX_COLS, right_index=True)
-        self.df_backtest = self.df_backtest.merge(df_is_suspended, how='left', left_on=INDEX_COLS, right_index=True)
-        self.df_backtest = self.df_backtest.merge(df_listed_dates, how='left', left_on = 'stock', right_index=True)
-        # create a new variable called 'is_listed_for_one_year' to check if a certain stock is listed for at least one year at that given date
-        self.df_backtest['is_listed_for_one_year'] = (self.df_backtest['date'].values - self.df_backtest['listed_date'].values >= pd.Timedelta('1y'))
+        # the eligibility conditions are packed (dates x stocks) bit matrices built from the st/suspend/listed date data,
+        # and their intersection is applied to the dataframe as a single boolean mask, without merging anything onto it
+        engine = universe.get_universe_engine(dates, stock_names)
+        self.universe = engine.universe(*self.universe_definition)
+        self.df_backtest = self.df_backtest.loc[self.universe.lookup(self.df_backtest['date'].values, self.df_backtest['stock'].values), :]
 
-        # filter out stocks that are listed within a year, ST, and suspended stocks, filter data by the stock's listed date
-        self.df_backtest = self.df_backtest.loc[ (~self.df_backtest['is_st']) & (~self.df_backtest['is_suspended']) & (self.df_backtest['is_listed_for_one_year']), :]
-
-        # number of non-listed stocks along the time
+        # number of eligible stocks along the time
         if visualize:
-            non_listed = self.df_backtest[~self.df_backtest['is_listed_for_one_year']]
-            num_nonlisted_stock = non_listed.groupby(level=0).count()['is_listed_for_one_year']
-            num_nonlisted_stock.plot.line()
-            plt.show()
+            universe.plot_universe_size(self.universe)
     
     @timer
-    def postprocess(self):
+    def postprocess(self, drop_last_period=True):
         """
         step 3: postprocess the dataframe into desired format
+        Args:
+            drop_last_period (bool, optional): whether to drop the last rebalancing date, whose 'next_period_return' cannot
+                be calculated yet. Keep it for live trading, see get_cross_section. Defaults to True.
         """
         # the rebalancing date is the last trading day of the period
         # 'next_period_return' is the generated return by holding a stock from end of current rebalancing date to the start of the next rebalancing date
@@ -88,15 +91,22 @@ class TimeAndStockFilter:
         #      Fix this later. 
         self.df_backtest['next_period_return'] = (self.df_backtest.groupby('stock')['open'].shift(-1).values - self.df_backtest['close'].values) / self.df_backtest['close'].values
         # drop the last period since its 'next_period_return' cannot be calculated
-        self.df_backtest = self.df_backtest[self.df_backtest['date'] != self.df_backtest['date'].max()]
+        if drop_last_period:
+            self.df_backtest = self.df_backtest[self.df_backtest['date'] != self.df_backtest['date'].max()]
         # sort the dataframe by date and stocks
         self.df_backtest = self.df_backtest.sort_values(by=INDEX_COLS, ascending=True)
         # have a (date, stock) multi-index dataframe
         self.df_backtest = self.df_backtest.set_index(INDEX_COLS)
         # filter out unnecessary columns
         self.df_backtest = self.df_backtest.loc[:, self.df_backtest.columns.isin(NECESSARY_COLS)]
+        # store prices, market values and returns in the precision of the current policy, see src/precision.py
+        numeric_cols = list(self.df_backtest.select_dtypes('floating').columns)
+        assign_columns(self.df_backtest, numeric_cols, precision.to_storage(self.df_backtest[numeric_cols]))
         # add primary and secondary industry codes to the dataframe
-        self.df_backtest = self.df_backtest.merge(dl.load_industry_mapping()[INDUSTRY_COLS], how='left', left_on='stock', right_index=True, )
+        df_industry = dl.load_industry_mapping()[INDUSTRY_COLS].reindex(self.df_backtest.index.get_level_values('stock'))
+        assign_columns(self.df_backtest, INDUSTRY_COLS, df_industry)
+        # build the date segment index once; later stages work on shallow copies sharing this index and only look it up
+        get_segment_index(self.df_backtest)
 
     def run(self):
         self.preprocess()
@@ -107,7 +117,30 @@ class TimeAndStockFilter:
         return self.df_backtest
 
 @timer
-def add_factors(df_backtest: pd.DataFrame, style_factor_dict: dict):
+def get_cross_section(df_basic_info, date, universe_definition=universe.DEFAULT_UNIVERSE) -> pd.DataFrame:
+    """
+    The stocks of a single rebalancing date, filtered and formatted like TimeAndStockFilter.run, e.g. the upcoming date
+    in live trading(see PortfolioOptimizer.rebalance). Its 'next_period_return' is missing.
+    """
+    stock_filter = TimeAndStockFilter(df_basic_info, universe_definition)
+    stock_filter.preprocess()
+    stock_filter.filter_dates(rebalancing_dates=pd.DatetimeIndex([date]))
+    if stock_filter.df_backtest.shape[0] == 0:
+        raise Exception(f"There is no data on {date}, or it is not a rebalancing date!")
+    stock_filter.filter_stocks()
+    stock_filter.postprocess(drop_last_period=False)
+    return stock_filter.df_backtest
+
+def get_open_prices(df_basic_info, date) -> pd.Series:
+    """
+    The open prices of all stocks on a date indexed by stock, before the universe filter, e.g. for the stocks that left
+    the universe in PortfolioOptimizer.rebalance.
+    """
+    df = df_basic_info[pd.to_datetime(df_basic_info['date']) == pd.Timestamp(date)]
+    return pd.Series(df['open'].values, index=df['stock'].apply(dl.normalize_code).values, name='open')
+
+@timer
+def add_factors(df_backtest: pd.DataFrame, style_factor_dict: dict, inplace=False):
     """get factor data and merge it onto the original backtesting framework
     Args:
         df_backtest (pd.DataFrame): a pandas dataframe used for backtesting. It has multi-index (date, stock)
@@ -116,10 +149,12 @@ def add_factors(df_backtest: pd.DataFrame, style_factor_dict: dict):
                                 }
                         in order for factor data to be correctly read in,
                         pe_ratio_ttm.h5 and pb_ratio_ttm.h5 should exist under ./Data/factor/value/
+        inplace (bool, optional): whether to add the factor columns to df_backtest itself. Otherwise they are added to a
+                                  shallow copy, which leaves df_backtest untouched without copying its data. Defaults to False.
     Returns:
         df_backtest: the updated backtesting dataframe
     """
-    df_backtest = df_backtest.copy()
+    df_backtest = lightweight_copy(df_backtest, inplace)
     def get_factor_path(type, factor):
         return os.path.join(DATAPATH, 'factor', type, factor + ".h5")
     all_factor_paths = [[get_factor_path(type, factor) for factor in factor_list] for type, factor_list in style_factor_dict.items()]
@@ -133,16 +168,20 @@ def add_factors(df_backtest: pd.DataFrame, style_factor_dict: dict):
         df_factor = df_factor[df_factor['date'].isin(REBALANCING_DATES)].set_index(INDEX_COLS).sort_index()
         return df_factor
 
-    with pathos.multiprocessing.ProcessPool(pathos.helpers.cpu_count()) as pool:
-    # with ThreadPoolExecutor() as pool:
-        factor_results = pool.map(get_factor_data, all_factor_paths)
+    if len(all_factor_paths) == 1:
+        # no pool for a single file, e.g. in the tasks of src/batch.py which already run in worker processes
+        factor_results = [get_factor_data(all_factor_paths[0])]
+    else:
+        with pathos.multiprocessing.ProcessPool(pathos.helpers.cpu_count()) as pool:
+        # with ThreadPoolExecutor() as pool:
+            factor_results = PROFILER.collect(pool.map(PROFILER.task(get_factor_data), all_factor_paths))
     df_factor = pd.concat(factor_results, axis=1)
-    df_factor = df_factor.replace([np.inf, -np.inf], np.nan)  
-    df_backtest = df_backtest.merge(df_factor, how='left', left_index=True, right_index=True)
+    df_factor = precision.to_storage(df_factor.replace([np.inf, -np.inf], np.nan))
+    join_columns(df_backtest, df_factor)
     return df_backtest
 
 @timer
-def standardize_factors(df: pd.DataFrame, factors: list, remove_outlier_or_not=True, standardize_or_not=True, fill_na_or_not=True, filter_out_missing_values_or_not=True):
+def standardize_factors(df: pd.DataFrame, factors: list, remove_outlier_or_not=True, standardize_or_not=True, fill_na_or_not=True, filter_out_missing_values_or_not=True, inplace=False):
     """
     This function preprocesses dataframe with the following steps
     step 1: Replace Outliers with the corresponding threshold
@@ -157,6 +196,8 @@ def standardize_factors(df: pd.DataFrame, factors: list, remove_outlier_or_not=T
         standardize_or_not (bool, optional): Defaults to True.
         fill_na_or_not (bool, optional): Defaults to True.
         filter_out_missing_values_or_not (bool, optional): Defaults to True.
+        inplace (bool, optional): whether to replace the factor columns of df itself rather than those of a shallow copy.
+                                  Only use it on dataframes no one else holds, e.g. the output of add_factors. Defaults to False.
 
     Returns:
         _type_: _description_
@@ -165,30 +206,37 @@ def standardize_factors(df: pd.DataFrame, factors: list, remove_outlier_or_not=T
     assert(factors is not None)
     assert(set(factors).issubset(set(df.columns)))
 
-    df = df.copy()  
+    df = lightweight_copy(df, inplace)
 
+    # the medians, means and standard deviations are computed in float64 whatever the storage precision
+    # all steps work on the date segments of the panel rather than on groupby(level=0), see src/panel.py
+    segment_index = get_segment_index(df)
     # step 1     
     if remove_outlier_or_not == True:
-        df[factors] = applyParallel(df[factors].groupby(level=0), remove_outlier).values
+        df_removed = kernels.segment_mad_clip(precision.accumulate(df[factors]), segment_index.offsets)
+        assign_columns(df, factors, precision.to_storage(df_removed))
 
     # step 2
     if standardize_or_not == True:
-        df[factors] = applyParallel(df[factors].groupby(level=0), standardize).values
+        # on each rebalancing date, each standardized factor has mean 0 and std 1
+        values = precision.accumulate(df[factors])
+        df_standardized = (values - segment_index.broadcast(segment_index.mean(values))) / segment_index.broadcast(segment_index.std(values))
+        assign_columns(df, factors, precision.to_storage(df_standardized))
         
         #is_mean_close_to_zero is a T x N matrix where T is the # of rebalancing dates and N is the # of factors
         #each entry checks whether the mean of a given factor on a given rebalancing date is close to 0
-        is_mean_close_to_zero = (df.groupby(level=0)[factors].mean() - 0).abs() < 1e-10
+        is_mean_close_to_zero = np.abs(segment_index.mean(precision.accumulate(df[factors])) - 0) < precision.tolerance()
         # after standadrization, all factor exposures on any rebalancing date should have mean 0 
-        assert( is_mean_close_to_zero.all().all() )
+        assert( is_mean_close_to_zero.all() )
         #is_std_close_to_one is a T x N matrix where T is the # of rebalancing dates and N is the # of factors
         #each entry checks whether the standard deivation of a given factor on a given rebalancing date is close to 1
-        is_std_close_to_one = (df.groupby(level=0)[factors].std() - 1).abs() < 1e-10
+        is_std_close_to_one = np.abs(segment_index.std(precision.accumulate(df[factors])) - 1) < precision.tolerance()
         # after standadrization, all factor exposures on any rebalancing date should have std 1 
-        assert( is_std_close_to_one.all().all() )
+        assert( is_std_close_to_one.all() )
 
     # step 3
     if fill_na_or_not == True:
-        df[factors] = df[factors].fillna(0).values
+        assign_columns(df, factors, df[factors].fillna(0))
         #there should be no nan factor values after filling them with 0
         assert(df[factors].isnull().sum().sum() == 0)
 
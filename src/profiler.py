@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # the resource module does not exist on Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def _cpu_times() -> tuple:
+    """(self cpu seconds, reaped child processes' cpu seconds)"""
+    if resource is not None:
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage_self.ru_utime + usage_self.ru_stime, usage_children.ru_utime + usage_children.ru_stime
+    times = os.times()
+    return times.user + times.system, times.children_user + times.children_system
+
+def _peak_rss() -> int:
+    """high-water mark of the resident set size of this process, in bytes"""
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux and in bytes on mac
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss)
+    return 0
+
+def _current_rss() -> int:
+    """current resident set size of this process, in bytes"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def shape_of(obj) -> dict:
+    """row/column counts and memory size of dataframes, series and arrays, to be attached to a stage record"""
+    shape = getattr(obj, 'shape', None)
+    if shape is None or not isinstance(shape, tuple):
+        return {}
+    result = {'rows': int(shape[0]) if len(shape) > 0 else 1, 'cols': int(shape[1]) if len(shape) > 1 else 1}
+    if hasattr(obj, 'memory_usage'):
+        # shallow memory usage, so that object columns don't make it expensive
+        usage = obj.memory_usage(index=True, deep=False)
+        result['nbytes'] = int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    elif hasattr(obj, 'nbytes'):
+        result['nbytes'] = int(obj.nbytes)
+    return result
+
+class ProfiledTask:
+    """
+    A function mapped over a process pool, returning its timing record along with its result.
+    It is a module level class, rather than a closure over the profiler, so that the pool can pickle it.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = getattr(func, '__name__', 'task')
+
+    def __call__(self, *args, **kwargs):
+        cpu_start = time.process_time()
+        start = time.time()
+        wall_start = time.perf_counter()
+        result = self.func(*args, **kwargs)
+        record = {'name': self.name, 'kind': 'task', 'start': start, 'wall': time.perf_counter() - wall_start,
+                  'cpu': time.process_time() - cpu_start, 'peak_rss': _peak_rss(),
+                  'pid': os.getpid(), 'tid': threading.get_ident(), **shape_of(result)}
+        return result, record
+
+class Profiler:
+    """
+    Records wall time, cpu time and memory of every pipeline stage and every worker task.
+
+    Each record is a dict with:
+        name, kind ('stage' or 'task'), start (unix time), wall, cpu, children_cpu, task_cpu,
+        rss_start, rss_end, peak_rss, peak_rss_growth (bytes), pid, tid, depth, and any extra metadata such as rows/cols.
+
+    'children_cpu' is the cpu time of child processes that finished during the stage, and 'task_cpu' is the cpu
+    time reported back by the worker tasks of the stage (see 'task'), which also covers pool workers that outlive the stage.
+    'peak_rss' is the process' high-water mark at the end of the stage, and 'peak_rss_growth' is how much the stage raised it.
+
+    Records can be exported to JSON or to a Chrome trace file (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    The global profiler PROFILER is on by default. Set the environment variable MULTIFACTOR_PROFILE=0 before importing
+    src to switch it off with zero overhead: the @timer decorator then returns the undecorated function.
+    """
+    def __init__(self, enabled=True, verbose=True):
+        self.enabled = enabled
+        self.verbose = verbose
+        self.records = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name: str, **meta):
+        """
+        Profile the code inside the 'with' block as one stage. The yielded dict can be updated with extra metadata,
+        e.g. row/column counts that are only known at the end of the stage.
+        """
+        if not self.enabled:
+            yield {}
+            return
+        stack = self._stack()
+        record = {'name': name, 'kind': 'stage', 'depth': len(stack), 'task_cpu': 0., **meta}
+        stack.append(record)
+        cpu_start, children_cpu_start = _cpu_times()
+        peak_rss_start = _peak_rss()
+        record['rss_start'] = _current_rss()
+        record['start'] = time.time()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall_start
+            cpu_end, children_cpu_end = _cpu_times()
+            record['cpu'] = cpu_end - cpu_start
+            record['children_cpu'] = children_cpu_end - children_cpu_start
+            record['peak_rss'] = _peak_rss()
+            record['peak_rss_growth'] = record['peak_rss'] - peak_rss_start
+            record['rss_end'] = _current_rss()
+            record['pid'], record['tid'] = os.getpid(), threading.get_ident()
+            stack.pop()
+            with self._lock:
+                self.records.append(record)
+            if self.verbose:
+                print(f"Function {name!r} executed in {record['wall']:.4f}s "
+                      f"(cpu {record['cpu'] + record['children_cpu'] + record['task_cpu']:.4f}s, "
+                      f"peak rss {record['peak_rss'] / 2 ** 30:.2f}GB)")
+
+    def task(self, func):
+        """
+        Wrap a function that is mapped over a process pool so that each call also returns its own timing record.
+        Use 'collect' in the parent process to unpack the results and attach the records to the current stage.
+        """
+        if not self.enabled:
+            return func
+        return ProfiledTask(func)
+
+    def collect(self, task_results) -> list:
+        """Unpack the (result, record) pairs returned by a 'task' wrapped function, and return the results"""
+        if not self.enabled:
+            return list(task_results)
+        results, task_records = [], []
+        for result, record in task_results:
+            results.append(result)
+            task_records.append(record)
+        stack = self._stack()
+        for record in task_records:
+            record['depth'] = len(stack)
+            record['parent'] = stack[-1]['name'] if stack else None
+        if stack:
+            stack[-1]['task_cpu'] += sum(record['cpu'] for record in task_records)
+            stack[-1]['num_tasks'] = stack[-1].get('num_tasks', 0) + len(task_records)
+        with self._lock:
+            self.records.extend(task_records)
+        return results
+
+    def to_json(self, path: str):
+        with open(path, 'w') as file:
+            json.dump(self.records, file, indent=2, default=str)
+
+    def to_chrome_trace(self, path: str):
+        """Export the records in the Chrome trace event format, one complete ('X') event per record"""
+        events = [{'name': record['name'], 'cat': record['kind'], 'ph': 'X',
+                   'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                   'pid': record['pid'], 'tid': record['tid'],
+                   'args': {key: value for key, value in record.items() if key not in ('name', 'kind', 'start', 'wall', 'pid', 'tid')}}
+                  for record in self.records]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+
+    def summary(self):
+        """A dataframe of all stage records, aggregated by stage name"""
+        import pandas as pd
+        df_records = pd.DataFrame([record for record in self.records if record['kind'] == 'stage'])
+        if df_records.empty:
+            return df_records
+        return df_records.groupby('name').agg(calls=('wall', 'size'), wall=('wall', 'sum'), cpu=('cpu', 'sum'),
+                                              children_cpu=('children_cpu', 'sum'), task_cpu=('task_cpu', 'sum'),
+                                              peak_rss=('peak_rss', 'max'), peak_rss_growth=('peak_rss_growth', 'max'))
+
+PROFILER = Profiler(enabled=os.environ.get('MULTIFACTOR_PROFILE', '1') != '0')
+
+def profile_stage(func):
+    """
+    Decorator profiling every call of 'func' as a pipeline stage of the global PROFILER.
+    Row/column counts of the returned dataframe are attached to the record; methods returning None, such as
+    TimeAndStockFilter.filter_dates, report the shape of their object's 'df_backtest' instead.
+    """
+    if not PROFILER.enabled:
+        return func
+    @functools.wraps(func)
+    def wrap_func(*args, **kwargs):
+        if not PROFILER.enabled:
+            return func(*args, **kwargs)
+        with PROFILER.stage(func.__qualname__) as record:
+            result = func(*args, **kwargs)
+            if result is None and args and hasattr(args[0], 'df_backtest'):
+                record.update(shape_of(args[0].df_backtest))
+            else:
+                record.update(shape_of(result))
+        return result
+    return wrap_func
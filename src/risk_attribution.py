@@ -0,0 +1,133 @@
+"""
+Ex-ante risk decomposition and realized return attribution of portfolios under the risk model of PortfolioOptimizer.
+
+The covariance matrix of the stock returns over the next period is V = X * F * X.transpose() + Delta, which is N x N
+and never formed. Everything goes through the K x 1 factor exposure x = X.transpose() * w of the portfolio instead:
+    factor variance     x.transpose() * F * x
+    specific variance   sum((sqrt(Delta) * w)^2)
+    risk                sqrt(factor variance + specific variance)
+    factor MCR          F * x / risk, the marginal contribution to risk of each factor exposure
+    stock MCR           (X * F * x + Delta * w) / risk, the derivative of risk with respect to each weight
+Contributions to risk are exposures(or weights) times their MCR; the stock contributions add up to the risk and the
+factor contributions to the factor variance over the risk. So a date costs O(N * K + K^2). The exposures of all the
+dates are computed at once with segment sums over the panel rows, the industry ones from the industry codes, and the
+K x K products are batched over the dates.
+
+The realized return of the portfolio over each period splits the same way into the factor exposures times the factor
+returns of the regression(df_hist_factor_return) and the weighted idiosyncratic returns. Only the stocks of the
+regression have an idiosyncratic return, so the stocks left out of it(missing return or market value) are left out of
+both parts, and the total is the return of the weights on the stocks of the regression. Dates without any regression,
+e.g. the last one, have no return attribution.
+
+With active=True, w is replaced by the active weights w - wb relative to the benchmark, which gives the tracking error
+and the active return attribution.
+
+Usage:
+    optimizer.run()
+    attribution = RiskAttribution(optimizer)
+    attribution.risk                  # per date: total, factor and specific risk
+    attribution.factor_contribution   # per date and factor: contribution to risk
+    attribution.return_contribution   # per date and factor: contribution to the realized return
+    attribution.get_summary()
+"""
+import numpy as np
+import pandas as pd
+from src.panel import get_segment_index
+from src.precision import accumulate
+import src.kernels as kernels
+
+class RiskAttribution:
+    def __init__(self, optimizer, weights: pd.Series=None, active=False):
+        """
+        Args:
+            optimizer (PortfolioOptimizer): an optimizer after steps 1-3(preprocess, get_regression_results, predict),
+                whose risk model is used
+            weights (pd.Series, optional): portfolio weights on the rows of optimizer.df_backtest, e.g. from
+                Frontier.get_weights. Dates without any weight are left out. Defaults to None, which uses the optimal
+                weights of the optimizer.
+            active (bool, optional): whether to attribute the weights relative to the benchmark of the optimizer.
+                Defaults to False.
+        """
+        df = optimizer.df_backtest
+        if weights is None:
+            weights = optimizer.opt_weights
+        weights = accumulate(weights)
+        assert(weights.shape[0] == df.shape[0]), "the weights must be on the rows of the backtesting panel"
+        segment_index = get_segment_index(df)
+        T, offsets = len(segment_index), segment_index.offsets
+        date_codes = segment_index.broadcast(np.arange(T))
+        attributed = kernels.segment_sum(~np.isnan(weights), offsets) > 0
+        w = np.nan_to_num(weights)
+        if active:
+            benchmark_weights = np.nan_to_num(accumulate(df[optimizer.benchmark_weight_col]))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                benchmark_weights /= segment_index.broadcast(kernels.segment_sum(benchmark_weights, offsets))
+            w = w - np.nan_to_num(benchmark_weights)
+
+        self.dates = segment_index.dates[attributed]
+        self.factors = list(optimizer.all_factors)
+        self.active = active
+        K, G = len(self.factors), len(optimizer.industry_factors)
+        dense_positions = optimizer.dense_positions()
+        codes = optimizer.stock_industry_codes
+        has_industry = codes >= 0
+
+        # K x 1 factor exposure of each date
+        X = np.nan_to_num(accumulate(df[optimizer.dense_factors]))
+        def get_exposure(w):
+            exposure = np.zeros((T, K))
+            exposure[:, dense_positions] = kernels.segment_sum(X * w[:, np.newaxis], offsets)
+            exposure[:, 1: 1 + G] = np.bincount(date_codes[has_industry] * G + codes[has_industry], w[has_industry],
+                                                minlength=T * G).reshape(T, G)
+            return exposure
+        exposure = get_exposure(w)
+        F = accumulate(optimizer.df_pred_factor_cov.reindex(pd.MultiIndex.from_product([segment_index.dates, self.factors]))[self.factors]).reshape(T, K, K)
+        F_x = np.einsum('tkl,tl->tk', F, exposure)
+        factor_variance = np.einsum('tk,tk->t', exposure, F_x)
+        specific_risk = np.nan_to_num(accumulate(optimizer.df_pred_specific_risk))
+        specific_variance = kernels.segment_sum((specific_risk * w) ** 2, offsets)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            risk = np.sqrt(factor_variance + specific_variance)
+            factor_mcr = F_x / risk[:, np.newaxis]
+            # X * F * x, with the industry part gathered by code
+            stock_factor_covariance = np.einsum('nd,nd->n', X, F_x[:, dense_positions][date_codes]) \
+                + np.where(has_industry, F_x[date_codes, 1 + np.where(has_industry, codes, 0)], 0.)
+            stock_mcr = (stock_factor_covariance + specific_risk ** 2 * w) / risk[date_codes]
+
+        self.risk = pd.DataFrame({'total_risk': risk, 'factor_risk': np.sqrt(factor_variance), 'specific_risk': np.sqrt(specific_variance),
+                                  'factor_share': factor_variance / risk ** 2}, index=segment_index.dates)[attributed]
+        self.factor_exposure = pd.DataFrame(exposure, index=segment_index.dates, columns=self.factors)[attributed]
+        self.factor_mcr = pd.DataFrame(factor_mcr, index=segment_index.dates, columns=self.factors)[attributed]
+        self.factor_contribution = self.factor_exposure * self.factor_mcr
+        # the specific risk contribution, which with the factor ones adds up to the total risk
+        self.factor_contribution['specific'] = self.risk['specific_risk'] ** 2 / self.risk['total_risk']
+        rows = segment_index.broadcast(attributed)
+        self.stock_mcr = pd.Series(stock_mcr, index=df.index, name='mcr')[rows]
+        self.stock_contribution = pd.Series(w * stock_mcr, index=df.index, name='risk_contribution')[rows]
+
+        # realized return attribution over the next period of each date, on the stocks of the regression only
+        factor_returns = accumulate(optimizer.df_hist_factor_return.reindex(segment_index.dates)[self.factors])
+        idio_returns = accumulate(optimizer.df_hist_idio_return.reindex(df.index))
+        regressed = ~np.isnan(idio_returns)
+        regressed_w = np.where(regressed, w, 0.)
+        self.return_contribution = pd.DataFrame(get_exposure(regressed_w) * factor_returns, index=segment_index.dates, columns=self.factors)
+        self.return_contribution['specific'] = np.where(kernels.segment_sum(regressed, offsets) > 0,
+                                                        kernels.segment_sum(regressed_w * np.nan_to_num(idio_returns), offsets), np.nan)
+        self.return_contribution['total'] = self.return_contribution.sum(axis=1, min_count=1)
+        self.return_contribution = self.return_contribution[attributed]
+
+    def get_summary(self, verbose=True) -> pd.DataFrame:
+        """
+        By factor(and 'specific'): the mean exposure, the mean contribution to risk, its mean share of the risk, and the
+        contribution to the realized return summed over the periods
+        """
+        summary = pd.DataFrame({
+            'exposure': self.factor_exposure.mean(),
+            'risk_contribution': self.factor_contribution.mean(),
+            'risk_share': self.factor_contribution.div(self.risk['total_risk'], axis=0).mean(),
+            'return_contribution': self.return_contribution.drop(columns='total').sum(min_count=1),
+        }).reindex(self.factors + ['specific'])
+        if verbose:
+            print(summary.to_string(float_format='{:0.4f}'.format))
+            print()
+        return summary
@@ -1,43 +1,78 @@
 from cProfile import label
-import matplotlib.pyplot as plt
 import pandas as pd
 from src.utils import *
 from src.constants import *
+from src.neutralization import neutralize, industry_codes, IndustryProjector
+from src.panel import get_segment_index
+from src.precision import accumulate
+from src.backtest_result import infer_periods_per_year
+from src.stat_store import StatStore
+import src.kernels as kernels
 import scipy.stats
 import numpy as np
 
 class TTester:
-    def __init__(self):
+    def __init__(self, stat_store: StatStore=None, industry_col=PRIMARY_INDUSTRY_COL):
+        """
+        Args:
+            stat_store (StatStore, optional): if given, the t-values of the dates tested before are read back from it and
+                only new or changed dates are tested, see src/stat_store.py. Defaults to None.
+            industry_col (str, optional): the industries the regressions are neutralized on. Defaults to PRIMARY_INDUSTRY_COL.
+        """
+        self.industry_col = industry_col
         self.tval_coef = None
         self.curr_tested_factor = None
+        # t-values and factor returns of every tested factor, reused by FactorCombinationWeightedByReturn
+        self.tval_coef_by_factor = {}
+        self.stat_store = stat_store
 
     # Get the t-value for all periods
     def run(self, df_backtest: pd.DataFrame, factor_name: str):
-
-        def wls_tval_coef(df):
-            #obtain the t-value in WLS of the tested factor
-            # 函数内需要用包要额外在这里加上
-            import statsmodels.formula.api as smf
-            import pandas as pd
-
-            # Weighted Least Square(WLS) uses the square root of market cap of each stock
-            # 使用加权最小二乘回归，以个股流通市值的平方根作为权重
-            # other than the factor of interest, we also regress on the industry for neutralization
-            # 同时对要测试的因子和行业因子做回归（个股属于该行业为1，否则为0），消除因子收益的行业间差异
-            wls_result = smf.wls(formula = f"next_period_return ~ {PRIMARY_INDUSTRY_COL} + {self.curr_tested_factor}", 
-                            data=df, weights = df['market_value'] ** 0.5).fit()
-            result_tval_coef = pd.Series( {'t_value': wls_result.tvalues.values[0], 'coef': wls_result.params.values[0], 
-                                } )
-            # result_resid = pd.Series( {'resid': wls_result.resid.values} )
-            return result_tval_coef.to_frame().transpose() 
-
         self.curr_tested_factor = factor_name
-        # wls_results_tval_coef = applyParallel(df_backtest.groupby(level=0), wls_tval_coef)
-        wls_results_tval_coef = df_backtest.groupby(level=0).apply(wls_tval_coef)
-        wls_results_tval_coef.index = df_backtest.index.get_level_values(level=0).unique()
+        if self.stat_store is not None:
+            wls_results_tval_coef = self.stat_store.update('t', factor_name, df_backtest,
+                                                           [factor_name, 'next_period_return', 'market_value', self.industry_col],
+                                                           self.get_tval_coef)
+        else:
+            wls_results_tval_coef = self.get_tval_coef(df_backtest)
         self.tval_coef = wls_results_tval_coef
+        self.tval_coef_by_factor[factor_name] = wls_results_tval_coef
+        return wls_results_tval_coef
+
+    def get_tval_coef(self, df_backtest: pd.DataFrame) -> pd.DataFrame:
+        """
+        t-value and coefficient of the tested factor on each date of the panel, the same as those of
+            smf.wls(formula = f"next_period_return ~ {self.industry_col} + {factor}", data=df, weights = df['market_value'] ** 0.5)
+        on each date, but without building the industry dummies: by the Frisch-Waugh-Lovell theorem, the coefficient is
+        that of regressing the return on the factor after removing the weighted industry means of both, see
+        src/neutralization.py. So the cost does not depend on the number of industries, e.g. with SECONDARY_INDUSTRY_COL.
+        """
+        # Weighted Least Square(WLS) uses the square root of market cap of each stock
+        # 使用加权最小二乘回归，以个股流通市值的平方根作为权重
+        # other than the factor of interest, we also regress on the industry for neutralization
+        # 同时对要测试的因子和行业因子做回归（个股属于该行业为1，否则为0），消除因子收益的行业间差异
+        codes, _ = industry_codes(df_backtest, self.industry_col)
+        returns = accumulate(df_backtest['next_period_return'])
+        factor = accumulate(df_backtest[self.curr_tested_factor])
+        weights = accumulate(df_backtest['market_value']) ** 0.5
+        segment_index = get_segment_index(df_backtest)
+        tval_coef = np.full((len(segment_index), 2), np.nan)
+        for t, (_, start, end) in enumerate(segment_index):
+            # the return and the factor are demeaned over the same stocks, those with both of them
+            Y = np.column_stack([returns[start: end], factor[start: end]])
+            Y[np.isnan(Y).any(axis=1)] = np.nan
+            demeaned, group_means, _ = IndustryProjector(codes[start: end], weights=weights[start: end]).fit(Y)
+            rows = ~np.isnan(demeaned[:, 0])
+            y, x, w = demeaned[rows, 0], demeaned[rows, 1], weights[start: end][rows]
+            xwx = w @ (x ** 2)
+            coef = (w @ (x * y)) / xwx
+            resid = y - coef * x
+            # degrees of freedom of the residuals: one parameter per industry in the regression, and the factor
+            df_resid = rows.sum() - (~np.isnan(group_means[:, 0])).sum() - 1
+            tval_coef[t] = [coef / np.sqrt((w @ resid ** 2) / df_resid / xwx), coef]
+        return pd.DataFrame(tval_coef, index=segment_index.dates, columns=['t_value', 'coef'])
 
-    def get_summary(self):
+    def get_summary(self, verbose=True) -> pd.DataFrame:
         # Get a summary result from the t-value series
         # 回归法的因子评价指标
 
@@ -52,13 +87,14 @@ class TTester:
         # 因子收益率均值零假设检验的 t 值
         coef_series_t_val = scipy.stats.ttest_1samp(self.tval_coef['coef'], 0).statistic
 
-        print(self.curr_tested_factor)
-        print('t值序列绝对值平均值：', '{:0.4f}'.format(tval_series_mean))
-        print('t值序列绝对值大于2的占比：', '{percent:.2%}'.format(percent = large_tval_prop))
-        print('t 值序列均值的绝对值除以 t 值序列的标准差：', '{:0.4f}'.format(standardized_tval))
-        print('因子收益率均值：', '{percent:.4%}'.format(percent=coef_series_mean))
-        print('因子收益率均值零假设检验的 t 值：', '{:0.4f}'.format(coef_series_t_val))
-        print()
+        if verbose:
+            print(self.curr_tested_factor)
+            print('t值序列绝对值平均值：', '{:0.4f}'.format(tval_series_mean))
+            print('t值序列绝对值大于2的占比：', '{percent:.2%}'.format(percent = large_tval_prop))
+            print('t 值序列均值的绝对值除以 t 值序列的标准差：', '{:0.4f}'.format(standardized_tval))
+            print('因子收益率均值：', '{percent:.4%}'.format(percent=coef_series_mean))
+            print('因子收益率均值零假设检验的 t 值：', '{:0.4f}'.format(coef_series_t_val))
+            print()
 
         # Creating a summarizing dataframe
         SUMMARY_ENTRY_NAME = ['t值序列绝对值平均值', 
@@ -75,9 +111,19 @@ class TTester:
 
 
 class ICTester():
-    def __init__(self):
+    def __init__(self, stat_store: StatStore=None, industry_col=PRIMARY_INDUSTRY_COL):
+        """
+        Args:
+            stat_store (StatStore, optional): if given, the ICs of the dates tested before are read back from it and only
+                new or changed dates are tested, see src/stat_store.py. Defaults to None.
+            industry_col (str, optional): the industries the factor is neutralized on. Defaults to PRIMARY_INDUSTRY_COL.
+        """
+        self.industry_col = industry_col
         self.curr_tested_factor = None
         self.ic_series = None
+        # IC series of every tested factor, reused by FactorCombinationWeightedByIC
+        self.ic_series_by_factor = {}
+        self.stat_store = stat_store
     
     def cross_sectional_ic(self, df):
         return df[['next_period_return', self.curr_tested_factor + '_resid']].corr(method='spearman').iloc[0, 1] 
@@ -88,59 +134,137 @@ class ICTester():
         # 因子值在去极值、标准化、去空值处理后，在截面期上用其做因变量对市值因子及行业
         # 因子（哑变量）做线性回归，取残差作为因子值的一个替代
 
-        def wls_factor_resid(df):
-            import statsmodels.formula.api as smf
-            wls_result = smf.wls(formula = f"{self.curr_tested_factor} ~ market_value + {PRIMARY_INDUSTRY_COL}", 
-                            data=df).fit()
-            return wls_result.resid
-
         self.curr_tested_factor = factor_name
-        factor_resids = applyParallel(df_test.groupby(level=0), wls_factor_resid)
-        factor_resids = factor_resids.rename(factor_name + '_resid')
-
-        df_test = df_test.merge(factor_resids, how='left', left_index=True, right_index=True)
-
-        ic_series = df_test.groupby(level=0).apply(self.cross_sectional_ic)
+        if self.stat_store is not None:
+            ic_series = self.stat_store.update('ic', factor_name, df_test,
+                                               [factor_name, 'next_period_return', 'market_value', self.industry_col],
+                                               self.get_ic_series)['ic'].rename(None)
+        else:
+            ic_series = self.get_ic_series(df_test)
 
         self.ic_series = ic_series
+        self.ic_series_by_factor[factor_name] = ic_series
 
         return ic_series
 
-    def get_summary(self):
+    def get_ic_series(self, df_test: pd.DataFrame) -> pd.Series:
+        """RankIC of the tested factor on each date of the panel"""
+        # same residuals as smf.ols(f"{factor_name} ~ market_value + {self.industry_col}") on each date, computed by
+        # within-industry demeaning, see src/neutralization.py
+        factor_name = self.curr_tested_factor
+        factor_resids = neutralize(df_test, [factor_name], self.industry_col, regressors=['market_value'])
+
+        # the same RankIC as cross_sectional_ic on each date, computed by the segmented rank kernels
+        segment_index = get_segment_index(df_test)
+        return pd.Series(kernels.segment_rank_corr(factor_resids[factor_name].values, accumulate(df_test['next_period_return']),
+                                                   segment_index.offsets), index=segment_index.dates)
+
+    def get_summary(self, verbose=True) -> pd.Series:
         ic_series_mean = self.ic_series.mean()
         ic_series_std = self.ic_series.std()
         ir = ic_series_mean / ic_series_std
         ic_pos_prop = (self.ic_series > 0).sum() / self.ic_series.shape[0]
 
-        print(self.curr_tested_factor)
-        print('IC 均值:','{:0.4f}'.format(ic_series_mean))
-        print('IC 标准差:','{:0.4f}'.format(ic_series_std))
-        print('IR 比率:','{percent:.2%}'.format(percent=ir))
-        print('IC 值序列大于零的占比:','{percent:.2%}'.format(percent=ic_pos_prop))
-        print()
+        if verbose:
+            print(self.curr_tested_factor)
+            print('IC 均值:','{:0.4f}'.format(ic_series_mean))
+            print('IC 标准差:','{:0.4f}'.format(ic_series_std))
+            print('IR 比率:','{percent:.2%}'.format(percent=ir))
+            print('IC 值序列大于零的占比:','{percent:.2%}'.format(percent=ic_pos_prop))
+            print()
+        return pd.Series({'IC 均值': ic_series_mean, 'IC 标准差': ic_series_std, 'IR 比率': ir,
+                          'IC 值序列大于零的占比': ic_pos_prop}, name=self.curr_tested_factor)
 
     def get_graph(self):
+        import matplotlib.pyplot as plt
         self.ic_series.cumsum().plot(label = self.curr_tested_factor, title = 'IC series by factor')
         plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
 
 class HierBackTester():
-    def __init__(self):
-        pass
+    """
+    Hierarchical backtest 分层回测: on each rebalancing date, the stocks of each industry are sorted by the tested factor and
+    split into 'num_groups' equally sized groups, a stock on the border of two groups being split between them.
+    Each group portfolio is industry neutral with the benchmark: every industry gets its weight in the benchmark, shared
+    equally by the stocks of the group within the industry. group1 holds the stocks with the lowest factor exposures.
 
-    def run(self):
-        pass
+    The benchmark is a uniform portfolio over all stocks of the date, unless 'benchmark_weight_col' is given.
+    Stocks without factor exposure or industry are left out; if an industry has no such stock left on a date, the group
+    weights of that date are scaled back to add up to 1.
+    """
+    def __init__(self, num_groups=5, industry_col=PRIMARY_INDUSTRY_COL, benchmark_weight_col=None):
+        self.num_groups = num_groups
+        self.industry_col = industry_col
+        self.benchmark_weight_col = benchmark_weight_col
+        self.group_names = [f"group{i}" for i in range(1, num_groups + 1)]
+        self.curr_tested_factor = None
+        self.group_weights = None
+        self.group_returns = None
+        self.group_cum_returns = None
 
-    def get_summary(self):
-        pass
+    def run(self, df_backtest: pd.DataFrame, factor_name: str) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: the return of each group portfolio in each period, with rebalancing dates as index
+        """
+        self.curr_tested_factor = factor_name
+        segment_index = get_segment_index(df_backtest)
+        factor = accumulate(df_backtest[factor_name])
+        codes, industries = industry_codes(df_backtest, self.industry_col)
+        if self.benchmark_weight_col is None:
+            benchmark_weight = 1 / segment_index.broadcast(segment_index.counts).astype(np.float64)
+        else:
+            benchmark_weight = accumulate(df_backtest[self.benchmark_weight_col])
+
+        # weight of each (date, industry) in the benchmark
+        date_id = segment_index.broadcast(np.arange(len(segment_index)))
+        date_industry = date_id * (len(industries) + 1) + codes + 1
+        industry_weight = np.bincount(date_industry, weights=np.nan_to_num(benchmark_weight))
+
+        # sort the stocks of each date by industry then factor exposure, and split them into (date, industry) segments
+        rows = np.flatnonzero(~np.isnan(factor) & (codes >= 0))
+        valid_offsets = np.searchsorted(rows, segment_index.offsets)
+        order, industry_offsets = kernels.sort_within_segments(valid_offsets, factor[rows], codes[rows])
+        rows = rows[order]
+        weights = np.zeros((df_backtest.shape[0], self.num_groups))
+        weights[rows] = kernels.segment_group_weights(industry_offsets, self.num_groups) * industry_weight[date_industry[rows], np.newaxis]
+        # each group portfolio is fully invested
+        weights /= segment_index.broadcast(np.where(segment_index.reduce(weights) > 0, segment_index.reduce(weights), 1.))
+
+        self.group_weights = pd.DataFrame(weights, index=df_backtest.index, columns=self.group_names)
+        group_returns = kernels.segment_weighted_sum(accumulate(df_backtest['next_period_return']), weights, segment_index.offsets)
+        self.group_returns = pd.DataFrame(group_returns, index=segment_index.dates, columns=self.group_names)
+        self.group_cum_returns = (1 + self.group_returns).cumprod()
+        return self.group_returns
+
+    def get_summary(self, verbose=True) -> pd.DataFrame:
+        # periods per year, e.g. 12 for monthly rebalancing
+        dates = self.group_returns.index
+        periods_per_year = infer_periods_per_year(dates)
+        group_returns = self.group_returns.copy()
+        # long the highest group, short the lowest group
+        group_returns['long_short'] = group_returns[self.group_names[-1]] - group_returns[self.group_names[0]]
+        annual_return = (1 + group_returns).prod() ** (periods_per_year / len(dates)) - 1
+        annual_volatility = group_returns.std() * periods_per_year ** 0.5
+
+        summary = pd.DataFrame({'年化收益率': annual_return, '年化波动率': annual_volatility,
+                                '收益波动比': annual_return / annual_volatility}).transpose()
+        if verbose:
+            print(self.curr_tested_factor)
+            print(summary.to_string(float_format='{:0.4f}'.format))
+            print()
+        return summary
 
     def get_graph(self):
-        pass
+        import matplotlib.pyplot as plt
+        self.group_cum_returns.plot(title = f'Hierarchical backtest of {self.curr_tested_factor}')
+        plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
 
 class SingleFactorTester():
     def __init__(self, df: pd.DataFrame):
         self.df = df
         self.ttester = TTester()
         self.ICtester = ICTester()
+        self.hiertester = HierBackTester()
 
     def t_value_test(self, factor_name): 
         self.ttester.run(self.df, factor_name)
@@ -152,5 +276,7 @@ class SingleFactorTester():
         self.ICtester.get_graph()
     
     def hierbacktest(self, factor_name):
-        pass
+        self.hiertester.run(self.df, factor_name)
+        self.hiertester.get_graph()
+        return self.hiertester.get_summary()
         
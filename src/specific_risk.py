@@ -0,0 +1,207 @@
+"""
+Specific(idiosyncratic) risk model of the portfolio optimizer: the predicted volatility of each stock's residual return
+over the next period, i.e. sqrt(Delta) in V = X * F * X.transpose() + Delta, from the residuals of the factor
+regressions of the previous rebalancing dates.
+
+On each rebalancing date:
+    1. time series: the EWMA volatility of each stock's residuals, with a half-life of 'half_life' periods
+    2. structural: stocks with fewer than 'full_periods' residuals(new listings, stocks back in the universe) have a noisy
+       or no EWMA volatility. The log EWMA volatility of the stocks with a full history is regressed on the industries
+       and style factors, and the fit is blended in with weight 1 - n / full_periods, where n is the number of residuals
+    3. Bayesian shrinkage: each volatility is shrunk towards the market value weighted mean of its size decile, the more
+       so the farther it is from it, as in Barra USE4: v = q|s - mean| / (std + q|s - mean|), s' = v * mean + (1 - v) * s
+
+The residuals are laid out as a dense (dates x stocks) matrix and the EWMA is a recursion over its rows, so the model
+keeps the state of the last date(decayed sums of squared residuals and of weights, and the number of residuals of each
+stock): fit() runs it over the history once, then on each new date update() folds in the residuals of the previous date
+only and predict() forecasts the new cross-section. Steps 2 and 3 are computed for all the dates at once with group sums.
+
+A residual of exactly 0 is the one of a stock alone in its industry, which the industry factor fits exactly; it carries
+no information on the stock's specific risk, so it is treated as missing.
+
+Usage:
+    model = SpecificRiskModel(style_factors)
+    specific_risk = model.fit(optimizer.df_hist_idio_return, optimizer.df_backtest)
+    # on the next rebalancing date
+    model.update(last_date, idio_returns_of_last_date)
+    specific_risk = model.predict(df_latest)
+"""
+import numpy as np
+import pandas as pd
+from src.constants import *
+from src.neutralization import industry_codes
+from src.panel import get_segment_index
+from src.precision import accumulate
+import src.kernels as kernels
+
+class SpecificRiskModel:
+    def __init__(self, style_factors: list, industry_col=PRIMARY_INDUSTRY_COL, half_life=6., full_periods=12,
+                 num_size_groups=10, shrinkage=0.1):
+        """
+        Args:
+            style_factors (list): the style factors of the structural regression
+            industry_col (str, optional): the industries of the structural regression. Defaults to PRIMARY_INDUSTRY_COL.
+            half_life (float, optional): half-life of the EWMA, in rebalancing periods. Defaults to 6.
+            full_periods (int, optional): number of residuals from which the EWMA volatility is used alone. Defaults to 12.
+            num_size_groups (int, optional): number of market value groups of the Bayesian shrinkage. Defaults to 10.
+            shrinkage (float, optional): the shrinkage intensity q, 0 for no shrinkage. Defaults to 0.1.
+        """
+        self.style_factors = list(style_factors)
+        self.industry_col = industry_col
+        self.half_life = half_life
+        self.full_periods = full_periods
+        self.num_size_groups = num_size_groups
+        self.shrinkage = shrinkage
+        self.reset()
+
+    def reset(self, stocks=None):
+        """forget the residuals folded in so far"""
+        self.date = None
+        self.stocks = pd.Index([] if stocks is None else stocks)
+        self.weighted_squares = np.zeros(len(self.stocks))
+        self.weight_sums = np.zeros(len(self.stocks))
+        self.num_obs = np.zeros(len(self.stocks))
+
+    def fit(self, df_idio_return: pd.Series, df_panel: pd.DataFrame) -> pd.Series:
+        """
+        Forecast the specific risk of every row of a panel, each date from the residuals of the previous dates only.
+        The state is left at the last date with residuals, ready for update/predict.
+
+        Args:
+            df_idio_return (pd.Series): residuals with multi-index (date, stock), on rows of the panel
+            df_panel (pd.DataFrame): the (date, stock) panel with the style factors, the industries and 'market_value'
+
+        Returns:
+            pd.Series: the predicted specific risk of each row of the panel, NaN when it cannot be forecast
+        """
+        segment_index = get_segment_index(df_panel)
+        date_codes = segment_index.broadcast(np.arange(len(segment_index)))
+        stock_codes, stocks = pd.factorize(df_panel.index.get_level_values(1))
+        residuals = np.full((len(segment_index), len(stocks)), np.nan)
+        residuals[date_codes, stock_codes] = accumulate(df_idio_return.reindex(df_panel.index))
+        self.reset(stocks)
+        volatility, num_obs = np.full(residuals.shape, np.nan), np.zeros(residuals.shape)
+        for t, date in enumerate(segment_index.dates):
+            volatility[t], num_obs[t] = self.ewma_volatility()
+            # the dates whose residuals are not known yet, e.g. the last one, are not folded in
+            if (~np.isnan(residuals[t])).any():
+                self.fold(date, residuals[t])
+        specific_risk = self.combine(df_panel, volatility[date_codes, stock_codes], num_obs[date_codes, stock_codes])
+        return pd.Series(specific_risk, index=df_panel.index, name='specific_risk')
+
+    def update(self, date, idio_return: pd.Series):
+        """fold the residuals of one more rebalancing date, indexed by stock, into the state"""
+        if self.date is not None and date <= self.date:
+            raise Exception(f"The specific risk model already has the residuals of {self.date:%Y-%m-%d}!")
+        new_stocks = idio_return.index.difference(self.stocks)
+        if len(new_stocks):
+            self.stocks = self.stocks.append(new_stocks)
+            padding = np.zeros(len(new_stocks))
+            self.weighted_squares, self.weight_sums, self.num_obs = [np.concatenate([values, padding]) for values in
+                                                                     [self.weighted_squares, self.weight_sums, self.num_obs]]
+        residuals = np.full(len(self.stocks), np.nan)
+        residuals[self.stocks.get_indexer(idio_return.index)] = accumulate(idio_return)
+        self.fold(date, residuals)
+
+    def predict(self, df_cross_section: pd.DataFrame) -> pd.Series:
+        """the specific risk of the stocks of a new rebalancing date, from the residuals folded in so far"""
+        positions = self.stocks.get_indexer(df_cross_section.index.get_level_values(-1))
+        known = positions >= 0
+        volatility, num_obs = self.ewma_volatility()
+        specific_risk = self.combine(df_cross_section, np.where(known, volatility[positions], np.nan),
+                                     np.where(known, num_obs[positions], 0.))
+        return pd.Series(specific_risk, index=df_cross_section.index, name='specific_risk')
+
+    def fold(self, date, residuals: np.ndarray):
+        # one step of the EWMA recursion, with one residual(or NaN) per stock of self.stocks
+        observed = ~np.isnan(residuals) & (residuals != 0)
+        decay = 0.5 ** (1 / self.half_life)
+        self.weighted_squares = decay * self.weighted_squares + np.where(observed, residuals, 0.) ** 2
+        self.weight_sums = decay * self.weight_sums + observed
+        self.num_obs = self.num_obs + observed
+        self.date = date
+
+    def ewma_volatility(self) -> tuple:
+        """(EWMA volatility, number of residuals) of each stock of self.stocks, NaN volatility without residuals"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = np.sqrt(self.weighted_squares / np.where(self.weight_sums > 0, self.weight_sums, np.nan))
+        return volatility, self.num_obs.copy()
+
+    def combine(self, df: pd.DataFrame, volatility: np.ndarray, num_obs: np.ndarray) -> np.ndarray:
+        """steps 2 and 3 on every date of a panel, from the EWMA volatility and the number of residuals of each row"""
+        structural = self.structural_volatility(df, volatility, num_obs >= self.full_periods)
+        blend_weight = np.clip(num_obs / self.full_periods, 0, 1)
+        # without a structural forecast(e.g. no stock has a full history yet), the EWMA volatility is used alone
+        blended = np.where(np.isnan(structural), volatility, blend_weight * np.nan_to_num(volatility) + (1 - blend_weight) * structural)
+        return self.shrink(df, blended)
+
+    def structural_volatility(self, df: pd.DataFrame, volatility: np.ndarray, estimation: np.ndarray) -> np.ndarray:
+        """
+        On each date, the WLS regression of log volatility on the industries and style factors over the 'estimation'
+        rows, weighted by the square root of market value, evaluated on all the rows.
+        Like src/neutralization.py, the industries are absorbed by demeaning within (date, industry) groups, and the
+        p x p normal equations of all the dates are solved at once. The exponential of the fitted log volatility is
+        scaled to have the same weighted mean as the volatility of the estimation stocks of the date.
+        """
+        segment_index = get_segment_index(df)
+        T, offsets = len(segment_index), segment_index.offsets
+        date_codes = segment_index.broadcast(np.arange(T))
+        codes, industries = industry_codes(df, self.industry_col)
+        # stocks without an industry form one more group
+        G = len(industries) + 1
+        groups = date_codes * G + np.where(codes >= 0, codes, G - 1)
+        X = accumulate(df[self.style_factors]).reshape(len(df), -1)
+        weights = accumulate(df['market_value']) ** 0.5
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.log(volatility)
+        estimation = estimation & np.isfinite(y) & ~np.isnan(X).any(axis=1) & (weights > 0)
+        W = np.where(estimation, weights, 0.)
+        y_est, X_est = np.where(estimation, y, 0.), np.where(estimation[:, np.newaxis], X, 0.)
+
+        group_weight = np.bincount(groups, W, minlength=T * G)
+        safe_group_weight = np.where(group_weight > 0, group_weight, 1.)
+        y_means = np.bincount(groups, W * y_est, minlength=T * G) / safe_group_weight
+        X_means = np.stack([np.bincount(groups, W * X_est[:, k], minlength=T * G) for k in range(X.shape[1])], axis=1) / safe_group_weight[:, np.newaxis]
+        y_demeaned, X_demeaned = y_est - y_means[groups], X_est - X_means[groups]
+        p = X.shape[1]
+        A = kernels.segment_sum(np.einsum('nk,nl->nkl', X_demeaned, X_demeaned).reshape(len(df), p * p), offsets, W).reshape(T, p, p)
+        b = kernels.segment_sum(X_demeaned * y_demeaned[:, np.newaxis], offsets, W).reshape(T, p)
+        coef = (np.linalg.pinv(A) @ b[:, :, np.newaxis])[:, :, 0] if p else np.zeros((T, 0))
+
+        # intercept of each (date, industry), the date's mean one for industries without any estimation stock
+        with np.errstate(divide='ignore', invalid='ignore'):
+            date_weight = kernels.segment_sum(W, offsets)
+            date_intercept = kernels.segment_sum(y_est - np.einsum('nk,nk->n', X_est, coef[date_codes]), offsets, W) / date_weight
+            intercepts = np.where(group_weight > 0, y_means - np.einsum('gk,gk->g', X_means, np.repeat(coef, G, axis=0)),
+                                  np.repeat(date_intercept, G))
+            fitted = np.exp(intercepts[groups] + np.einsum('nk,nk->n', X, coef[date_codes]))
+            scale = kernels.segment_sum(np.where(estimation, volatility, 0.), offsets, W) / kernels.segment_sum(np.where(estimation, fitted, 0.), offsets, W)
+        return fitted * segment_index.broadcast(scale)
+
+    def shrink(self, df: pd.DataFrame, volatility: np.ndarray) -> np.ndarray:
+        """
+        Step 3 on every date: Bayesian shrinkage towards the market value weighted mean of the size group. Rows still
+        without a volatility get the weighted mean of their date.
+        """
+        segment_index = get_segment_index(df)
+        T, offsets = len(segment_index), segment_index.offsets
+        date_codes = segment_index.broadcast(np.arange(T))
+        market_value = accumulate(df['market_value'])
+        buckets = kernels.segment_quantile_bucket(np.where(np.isnan(volatility), np.nan, market_value), offsets, self.num_size_groups)
+        valid = (buckets >= 0) & (market_value > 0)
+        groups = date_codes * self.num_size_groups + np.where(valid, buckets, 0)
+        W = np.where(valid, market_value, 0.)
+        minlength = T * self.num_size_groups
+        group_weight = np.bincount(groups, W, minlength=minlength)
+        group_mean = np.bincount(groups, W * np.where(valid, volatility, 0.), minlength=minlength) / np.where(group_weight > 0, group_weight, 1.)
+        deviation = np.where(valid, volatility - group_mean[groups], 0.)
+        group_count = np.bincount(groups, valid, minlength=minlength)
+        group_std = np.sqrt(np.bincount(groups, deviation ** 2, minlength=minlength) / np.where(group_count > 0, group_count, 1.))
+        distance = self.shrinkage * np.abs(deviation)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intensity = np.where(distance > 0, distance / (group_std[groups] + distance), 0.)
+        shrunk = np.where(valid, intensity * group_mean[groups] + (1 - intensity) * volatility, volatility)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            date_mean = kernels.segment_sum(np.where(valid, shrunk, 0.), offsets, W) / kernels.segment_sum(W, offsets)
+        return np.where(np.isnan(shrunk), segment_index.broadcast(date_mean), shrunk)
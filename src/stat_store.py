@@ -0,0 +1,129 @@
+"""
+Per-date statistics of the single factor tests, persisted on disk and updated incrementally.
+
+The IC, t-value or factor return of a factor on a rebalancing date only depend on the cross-section of that date.
+StatStore keeps them by (date, hash of the cross-section) for each (test, factor), so when a test is run again on a
+panel, only the dates whose cross-section is new or changed(the dirty dates) are tested, and the other dates are read
+back. A monthly refresh of many factors then tests one cross-section per factor. Statistics of different universes or
+data revisions of the same date are kept side by side, since they have different hashes; clear() resets a store.
+
+Usage:
+    store = StatStore()
+    ic_series = ICTester(stat_store=store).run(df_backtest, 'pe_ratio_ttm')
+    tval_coef = TTester(stat_store=store).run(df_backtest, 'pe_ratio_ttm')
+"""
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from src.panel import get_segment_index
+
+class StatStore:
+    def __init__(self, cache_dir=os.path.join('.', 'data', 'stat_cache'), verbose=False):
+        """
+        Args:
+            cache_dir (str, optional): where the statistics are pickled, one file per (test, factor). None keeps them in
+                memory only. Defaults to ./data/stat_cache.
+            verbose (bool, optional): whether to print how many dates are tested. Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        # (test, factor) -> statistics indexed by (date, hash)
+        self._memory = {}
+
+    @staticmethod
+    def cross_section_hashes(df: pd.DataFrame, columns) -> np.ndarray:
+        """hash of the values of 'columns' on each rebalancing date of the panel"""
+        columns = list(columns)
+        segment_index = get_segment_index(df)
+        row_hashes = pd.util.hash_pandas_object(df[columns], index=False).values
+        hashes = []
+        for start, end in zip(segment_index.offsets[:-1], segment_index.offsets[1:]):
+            digest = hashlib.sha1(repr(columns).encode())
+            digest.update(row_hashes[start: end].tobytes())
+            hashes.append(digest.hexdigest()[:16])
+        return np.array(hashes)
+
+    def load(self, test: str, factor: str) -> pd.DataFrame:
+        """all the stored statistics of a test on a factor, indexed by (date, hash)"""
+        if (test, factor) not in self._memory:
+            path = self._path(test, factor)
+            if path is not None and os.path.exists(path):
+                with open(path, 'rb') as file:
+                    self._memory[(test, factor)] = pickle.load(file)
+            else:
+                self._memory[(test, factor)] = pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=['date', 'hash']))
+        return self._memory[(test, factor)]
+
+    def update(self, test: str, factor: str, df: pd.DataFrame, columns, compute) -> pd.DataFrame:
+        """
+        The statistics of a test on every date of a panel, testing only the dirty dates.
+
+        Args:
+            test (str): name of the test, e.g. 'ic'. Tests computed differently must have different names.
+            factor (str): the tested factor
+            df (pd.DataFrame): the (date, stock) panel
+            columns (Iterable): the columns the statistics depend on, e.g. the factor and 'next_period_return'
+            compute (callable): compute(df_dirty) returns the statistics of the panel df_dirty, which has the rows of the
+                dirty dates only, as a dataframe(or series) indexed by date
+
+        Returns:
+            pd.DataFrame: the statistics indexed by the dates of 'df'
+        """
+        segment_index = get_segment_index(df)
+        return self.update_by_hash(test, factor, segment_index.dates, self.cross_section_hashes(df, columns),
+                                   lambda dirty: compute(df[segment_index.broadcast(dirty)]))
+
+    def update_by_hash(self, test: str, factor: str, dates, hashes, compute) -> pd.DataFrame:
+        """
+        Same as update, for statistics that do not come from the cross-section of a panel, e.g. the factor weights
+        optimized on each date: 'hashes' are the hashes of whatever the statistics of each date depend on, and
+        compute(dirty) returns the statistics of the dates of the boolean mask 'dirty'.
+        """
+        keys = pd.MultiIndex.from_arrays([pd.Index(dates), np.asarray(hashes)], names=['date', 'hash'])
+        stored = self.load(test, factor)
+        dirty = ~keys.isin(stored.index)
+        if self.verbose:
+            print(f'[stat_store] {test}:{factor}: {dirty.sum()} of {len(keys)} dates tested')
+        if dirty.any():
+            computed = compute(dirty)
+            if isinstance(computed, pd.Series):
+                computed = computed.to_frame(test)
+            assert(len(computed) == dirty.sum())
+            computed.index = keys[dirty]
+            stored = pd.concat([stored, computed]) if len(stored) else computed
+            self._memory[(test, factor)] = stored
+            self._save(test, factor, stored)
+        result = stored.reindex(keys)
+        result.index = pd.Index(dates)
+        return result
+
+    def clear(self, test=None, factor=None):
+        """delete the stored statistics of a test and/or a factor, or all of them"""
+        for key in list(self._memory):
+            if test in (None, key[0]) and factor in (None, key[1]):
+                del self._memory[key]
+        if self.cache_dir is None or not os.path.exists(self.cache_dir):
+            return
+        for test_name in os.listdir(self.cache_dir):
+            if test not in (None, test_name):
+                continue
+            for file_name in os.listdir(os.path.join(self.cache_dir, test_name)):
+                if factor is None or file_name == f'{factor}.pkl':
+                    os.remove(os.path.join(self.cache_dir, test_name, file_name))
+
+    def _path(self, test: str, factor: str):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, test, f'{factor}.pkl')
+
+    def _save(self, test: str, factor: str, stored: pd.DataFrame):
+        path = self._path(test, factor)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so an interrupted write never leaves a truncated store behind
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(stored, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,301 @@
+"""
+Alphalens-style tear sheets of factors, computed natively on the project's (date, stock) panel.
+
+al.utils.get_clean_factor_and_forward_returns unstacks and forward fills the whole price table, then computes the
+forward returns of every stock on every day for every horizon, one factor at a time. TearSheet keeps the prices as a
+dense (trading dates x stocks) matrix and only gathers the prices it needs at the rows of the factor panel, so the
+forward returns cost O(rows x horizons) and are shared by all the factors. All the statistics are then computed for
+every factor with segment kernels(src/kernels.py) over the dates of the panel, or on dense (dates x stocks) matrices:
+    - forward returns over each horizon, in trading days of the price matrix. Missing prices are not filled, a stock
+      without a price at either end of a horizon has no forward return over it
+    - mean(demeaned) returns by factor quantile, top minus bottom spread, and the returns of the factor weighted
+      long-short portfolio with their alpha and beta on the equally weighted universe
+    - rank IC, and with a group column the group-neutral IC: the IC against the forward returns demeaned within each
+      (date, group), as factor_information_coefficient(group_adjust=True) of alphalens
+    - quantile turnover and factor rank autocorrelation, at the lag in factor dates that spans each horizon
+
+Usage:
+    tear_sheet = TearSheet(price_matrix(dl.load_basic_info()), periods=(1, 5, 10), group_col=PRIMARY_INDUSTRY_COL)
+    tear_sheet.run(df_backtest, ['pe_ratio_ttm', 'pb_ratio_ttm'])
+    tear_sheet.get_summary()
+    tear_sheet.get_ic_table('pb_ratio_ttm')
+    tear_sheet.get_graph('pb_ratio_ttm')
+
+Plotting is kept in get_graph, which imports matplotlib only when it is called.
+"""
+import numpy as np
+import pandas as pd
+import scipy.stats
+import src.kernels as kernels
+from src.panel import get_segment_index
+from src.precision import accumulate
+from src.backtest_result import infer_periods_per_year
+
+def price_matrix(df: pd.DataFrame, price_col='close') -> pd.DataFrame:
+    """
+    Dense (trading dates x stocks) matrix of a price column, without unstacking.
+
+    Args:
+        df (pd.DataFrame): the daily data of dl.load_basic_info(with 'date' and 'stock' columns, whose stock codes are
+            normalized like the backtesting panel), or a daily panel with multi-index (date, stock)
+        price_col (str, optional): Defaults to 'close'.
+    """
+    if isinstance(df.index, pd.MultiIndex):
+        dates, stocks = df.index.get_level_values(0), df.index.get_level_values(1)
+    else:
+        dates, stocks = pd.to_datetime(df['date']), df['stock']
+    date_codes, calendar = pd.factorize(dates, sort=True)
+    stock_codes, stock_names = pd.factorize(stocks)
+    if not isinstance(df.index, pd.MultiIndex):
+        # dataloader reads the project's data folder on import, so it is only imported when the codes are normalized
+        import src.dataloader as dl
+        stock_names = pd.Index([dl.normalize_code(stock) for stock in stock_names])
+    matrix = np.full((len(calendar), len(stock_names)), np.nan)
+    matrix[date_codes, stock_codes] = accumulate(df[price_col])
+    return pd.DataFrame(matrix, index=pd.DatetimeIndex(calendar, name='date'), columns=pd.Index(stock_names, name='stock'))
+
+def forward_returns(prices: pd.DataFrame, index: pd.MultiIndex, periods) -> np.ndarray:
+    """
+    Returns from each (date, stock) of 'index' over the next h trading days of the price matrix, for each h in
+    'periods'. NaN if the date or the stock is not in the price matrix, or if either price is missing.
+
+    Returns:
+        np.ndarray: rows x len(periods)
+    """
+    P = accumulate(prices.values)
+    date_values = index.get_level_values(0)
+    unique_dates, date_codes = np.unique(date_values.values, return_inverse=True)
+    rows = prices.index.get_indexer(pd.DatetimeIndex(unique_dates))[date_codes]
+    stock_codes, unique_stocks = pd.factorize(index.get_level_values(1))
+    cols = prices.columns.get_indexer(unique_stocks)[stock_codes]
+    result = np.full((len(index), len(periods)), np.nan)
+    for j, period in enumerate(periods):
+        valid = (rows >= 0) & (cols >= 0) & (rows + period < P.shape[0])
+        result[valid, j] = P[rows[valid] + period, cols[valid]] / P[rows[valid], cols[valid]] - 1
+    return result
+
+class TearSheet:
+    def __init__(self, prices: pd.DataFrame, periods=(1, 5, 10), quantiles=5, group_col=None, demeaned=True):
+        """
+        Args:
+            prices (pd.DataFrame): (trading dates x stocks) price matrix, see price_matrix
+            periods (tuple, optional): horizons of the forward returns, in trading days. Defaults to (1, 5, 10).
+            quantiles (int, optional): number of factor quantiles on each date. Defaults to 5.
+            group_col (str, optional): column of the factor panel with the groups of the group-neutral IC, e.g.
+                PRIMARY_INDUSTRY_COL. Defaults to None.
+            demeaned (bool, optional): whether the quantile returns are relative to the mean return of the date.
+                Defaults to True.
+        """
+        self.prices = prices
+        self.periods = list(periods)
+        self.period_labels = [f'{period}D' for period in self.periods]
+        self.quantiles = quantiles
+        self.group_col = group_col
+        self.demeaned = demeaned
+        # trading days per year, to annualize the alphas
+        self.days_per_year = infer_periods_per_year(prices.index)
+
+    def run(self, df_factors: pd.DataFrame, factors: list):
+        """
+        Compute the statistics of all the factors.
+
+        Args:
+            df_factors (pd.DataFrame): panel with multi-index (date, stock) sorted by date, with the factor columns and,
+                if given, group_col. The dates must be trading dates of the price matrix.
+            factors (list): the factors to analyse
+        Returns:
+            pd.DataFrame: the summary of self.get_summary
+        """
+        self.factors = list(factors)
+        segment_index = get_segment_index(df_factors)
+        self.dates = segment_index.dates
+        T, offsets = len(segment_index), segment_index.offsets
+        date_codes = segment_index.broadcast(np.arange(T))
+        stock_codes, stocks = pd.factorize(df_factors.index.get_level_values(1))
+        X = accumulate(df_factors[self.factors]).reshape(len(df_factors), -1)
+        R = forward_returns(self.prices, df_factors.index, self.periods)
+        self.forward_returns = pd.DataFrame(R, index=df_factors.index, columns=self.period_labels)
+        # the factor dates a horizon spans, for the turnover and the autocorrelation
+        date_positions = self.prices.index.get_indexer(self.dates)
+        date_positions = date_positions[date_positions >= 0]
+        spacing = np.median(np.diff(date_positions)) if len(date_positions) > 1 else 1
+        self.lags = [max(1, int(round(period / spacing))) for period in self.periods]
+
+        # rank IC of all the factors at once, and the group-neutral IC: the IC against the returns demeaned within
+        # each (date, group), over the stocks with a group, the factor and the return
+        self.ic, self.group_ic = {}, {}
+        ic = np.stack([kernels.segment_rank_corr(X, R[:, j], offsets) for j in range(len(self.periods))], axis=2)
+        if self.group_col is not None:
+            group_codes, _ = pd.factorize(df_factors[self.group_col])
+            order, group_offsets = kernels.sort_within_segments(offsets, group_codes)
+            grouped = group_codes[order, np.newaxis] >= 0
+            group_ic = np.full((T, len(self.factors), len(self.periods)), np.nan)
+            for j in range(len(self.periods)):
+                Y = np.where(grouped & ~np.isnan(X[order]), R[order, j: j + 1], np.nan)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    group_mean = kernels.segment_sum(Y, group_offsets) / kernels.segment_sum((~np.isnan(Y)).astype(np.float64), group_offsets)
+                demeaned = np.empty_like(Y)
+                demeaned[order] = Y - np.repeat(group_mean, np.diff(group_offsets), axis=0)
+                group_ic[:, :, j] = kernels.segment_rank_corr(X, demeaned, offsets)
+        ranks = kernels.segment_rank(X, offsets)
+
+        self.quantile_returns, self.spread_returns, self.factor_returns, self.turnover, self.autocorrelation = {}, {}, {}, {}, {}
+        self.alpha_beta = {}
+        for m, factor in enumerate(self.factors):
+            self.ic[factor] = pd.DataFrame(ic[:, m], index=self.dates, columns=self.period_labels)
+            if self.group_col is not None:
+                self.group_ic[factor] = pd.DataFrame(group_ic[:, m], index=self.dates, columns=self.period_labels)
+            buckets = kernels.segment_quantile_bucket(X[:, m], offsets, self.quantiles)
+            self.get_return_stats(factor, X[:, m], buckets, R, date_codes, offsets)
+            self.get_turnover_stats(factor, buckets, ranks[:, m], date_codes, stock_codes, len(stocks))
+        return self.get_summary(verbose=False)
+
+    def get_return_stats(self, factor: str, x: np.ndarray, buckets: np.ndarray, R: np.ndarray, date_codes: np.ndarray, offsets: np.ndarray):
+        """
+        Helper function for self.run
+        Mean returns of each quantile on each date, the top minus bottom spread, and the factor weighted portfolio returns
+        """
+        T, Q = len(self.dates), self.quantiles
+        quantile_returns = np.full((T, Q, len(self.periods)), np.nan)
+        factor_returns, universe_returns = np.full((T, len(self.periods)), np.nan), np.full((T, len(self.periods)), np.nan)
+        for j in range(len(self.periods)):
+            valid = (buckets >= 0) & ~np.isnan(R[:, j])
+            r = np.where(valid, R[:, j], 0.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                universe_returns[:, j] = kernels.segment_sum(r, offsets) / kernels.segment_sum(valid.astype(np.float64), offsets)
+                cell = date_codes * Q + np.where(valid, buckets, 0)
+                means = np.bincount(cell, r, minlength=T * Q) / np.bincount(cell, valid, minlength=T * Q)
+                quantile_returns[:, :, j] = means.reshape(T, Q)
+                # weights proportional to the demeaned factor, with a gross exposure of 1
+                demeaned_factor = np.where(valid, x - np.repeat(kernels.segment_sum(np.where(valid, x, 0.), offsets)
+                                                                / kernels.segment_sum(valid.astype(np.float64), offsets), np.diff(offsets)), 0.)
+                weights = demeaned_factor / np.repeat(kernels.segment_sum(np.abs(demeaned_factor), offsets), np.diff(offsets))
+                factor_returns[:, j] = kernels.segment_sum(np.where(valid, weights * r, 0.), offsets)
+        if self.demeaned:
+            quantile_returns -= universe_returns[:, np.newaxis, :]
+        columns = pd.MultiIndex.from_product([self.period_labels, np.arange(1, Q + 1)], names=['period', 'quantile'])
+        self.quantile_returns[factor] = pd.DataFrame(quantile_returns.transpose(0, 2, 1).reshape(T, -1), index=self.dates, columns=columns)
+        self.spread_returns[factor] = pd.DataFrame(quantile_returns[:, -1] - quantile_returns[:, 0], index=self.dates, columns=self.period_labels)
+        self.factor_returns[factor] = pd.DataFrame(factor_returns, index=self.dates, columns=self.period_labels)
+
+        # alpha and beta of the factor weighted portfolio on the universe, the alpha annualized from h-day returns
+        alpha_beta = {}
+        for j, label in enumerate(self.period_labels):
+            both = ~np.isnan(factor_returns[:, j]) & ~np.isnan(universe_returns[:, j])
+            if both.sum() < 2:
+                alpha_beta[label] = [np.nan, np.nan]
+                continue
+            beta, alpha = np.polyfit(universe_returns[both, j], factor_returns[both, j], 1)
+            alpha_beta[label] = [(1 + alpha) ** (self.days_per_year / self.periods[j]) - 1, beta]
+        self.alpha_beta[factor] = pd.DataFrame(alpha_beta, index=['Ann. alpha', 'beta'])
+
+    def get_turnover_stats(self, factor: str, buckets: np.ndarray, ranks: np.ndarray, date_codes: np.ndarray, stock_codes: np.ndarray, N: int):
+        """
+        Helper function for self.run
+        On dense (dates x stocks) matrices: the share of the stocks of each quantile that were not in it 'lag' factor
+        dates before, and the correlation of the factor ranks with those 'lag' dates before
+        """
+        T, Q = len(self.dates), self.quantiles
+        B = np.full((T, N), -1)
+        B[date_codes, stock_codes] = buckets
+        A = np.full((T, N), np.nan)
+        A[date_codes, stock_codes] = ranks
+        turnover, autocorrelation = np.full((T, len(self.periods), Q), np.nan), np.full((T, len(self.periods)), np.nan)
+        for j, lag in enumerate(self.lags):
+            if lag >= T:
+                continue
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for q in range(Q):
+                    now, before = B[lag:] == q, B[:-lag] == q
+                    turnover[lag:, j, q] = 1 - (now & before).sum(axis=1) / now.sum(axis=1)
+                both = ~np.isnan(A[lag:]) & ~np.isnan(A[:-lag])
+                a, b = np.where(both, A[lag:], 0.), np.where(both, A[:-lag], 0.)
+                count = both.sum(axis=1)
+                da = np.where(both, a - (a.sum(axis=1) / count)[:, np.newaxis], 0.)
+                db = np.where(both, b - (b.sum(axis=1) / count)[:, np.newaxis], 0.)
+                autocorrelation[lag:, j] = (da * db).sum(axis=1) / np.sqrt((da ** 2).sum(axis=1) * (db ** 2).sum(axis=1))
+        columns = pd.MultiIndex.from_product([self.period_labels, np.arange(1, Q + 1)], names=['period', 'quantile'])
+        self.turnover[factor] = pd.DataFrame(turnover.reshape(T, -1), index=self.dates, columns=columns)
+        self.autocorrelation[factor] = pd.DataFrame(autocorrelation, index=self.dates, columns=self.period_labels)
+
+    def get_returns_table(self, factor: str) -> pd.DataFrame:
+        """alpha, beta and the mean top, bottom and spread returns per trading day(in bps) over each horizon"""
+        def per_day_bps(returns: pd.DataFrame) -> pd.Series:
+            return ((1 + returns.mean()) ** (1 / np.array(self.periods)) - 1) * 10000
+        quantile_returns = self.quantile_returns[factor]
+        table = pd.concat([self.alpha_beta[factor].T,
+                           per_day_bps(quantile_returns.xs(self.quantiles, axis=1, level='quantile')).rename('Mean Period Wise Return Top Quantile (bps)'),
+                           per_day_bps(quantile_returns.xs(1, axis=1, level='quantile')).rename('Mean Period Wise Return Bottom Quantile (bps)'),
+                           per_day_bps(self.spread_returns[factor]).rename('Mean Period Wise Spread (bps)')], axis=1)
+        return table.T
+
+    def get_mean_quantile_returns(self, factor: str) -> pd.DataFrame:
+        """mean forward return of each quantile(rows) over each horizon(columns)"""
+        return self.quantile_returns[factor].mean().unstack(level='period')[self.period_labels]
+
+    def get_ic_table(self, factor: str) -> pd.DataFrame:
+        """statistics of the IC series over each horizon, and of the group-neutral IC if a group column is given"""
+        def ic_stats(ic: pd.DataFrame, prefix='') -> pd.DataFrame:
+            t_stat, p_value = scipy.stats.ttest_1samp(ic, 0, nan_policy='omit')
+            return pd.DataFrame({
+                f'{prefix}IC Mean': ic.mean(),
+                f'{prefix}IC Std.': ic.std(),
+                f'{prefix}Risk-Adjusted IC': ic.mean() / ic.std(),
+                f'{prefix}t-stat(IC)': np.asarray(t_stat),
+                f'{prefix}p-value(IC)': np.asarray(p_value),
+                f'{prefix}IC Skew': ic.skew(),
+                f'{prefix}IC Kurtosis': ic.kurtosis(),
+            }).T
+        table = ic_stats(self.ic[factor])
+        if self.group_col is not None:
+            table = pd.concat([table, ic_stats(self.group_ic[factor], 'Group-Neutral ')])
+        return table
+
+    def get_turnover_table(self, factor: str) -> pd.DataFrame:
+        """mean turnover of each quantile and mean factor rank autocorrelation, over each horizon"""
+        table = self.turnover[factor].mean().unstack(level='period')[self.period_labels]
+        table.index = [f'Quantile {quantile} Mean Turnover' for quantile in table.index]
+        table.loc['Mean Factor Rank Autocorrelation'] = self.autocorrelation[factor].mean()
+        return table
+
+    def get_summary(self, verbose=True) -> pd.DataFrame:
+        """the main statistics of every factor over each horizon, one row per (factor, horizon)"""
+        rows = {}
+        for factor in self.factors:
+            ic_table, returns_table, turnover_table = self.get_ic_table(factor), self.get_returns_table(factor), self.get_turnover_table(factor)
+            for label in self.period_labels:
+                row = {
+                    'IC Mean': ic_table.loc['IC Mean', label],
+                    'Risk-Adjusted IC': ic_table.loc['Risk-Adjusted IC', label],
+                    't-stat(IC)': ic_table.loc['t-stat(IC)', label],
+                }
+                if self.group_col is not None:
+                    row['Group-Neutral IC Mean'] = ic_table.loc['Group-Neutral IC Mean', label]
+                row.update({
+                    'Mean Period Wise Spread (bps)': returns_table.loc['Mean Period Wise Spread (bps)', label],
+                    'Ann. alpha': returns_table.loc['Ann. alpha', label],
+                    'beta': returns_table.loc['beta', label],
+                    'Top Quantile Turnover': turnover_table.loc[f'Quantile {self.quantiles} Mean Turnover', label],
+                    'Rank Autocorrelation': turnover_table.loc['Mean Factor Rank Autocorrelation', label],
+                })
+                rows[(factor, label)] = row
+        summary = pd.DataFrame.from_dict(rows, orient='index')
+        summary.index.names = ['factor', 'period']
+        if verbose:
+            print(summary.to_string(float_format='{:0.4f}'.format))
+            print()
+        return summary
+
+    def get_graph(self, factor: str):
+        """mean quantile returns, IC series, cumulative factor weighted returns and top quantile turnover of a factor"""
+        import matplotlib.pyplot as plt
+        fig, axes = plt.subplots(2, 2, figsize=(16, 10))
+        (self.get_mean_quantile_returns(factor) * 10000).plot.bar(ax=axes[0, 0], title=f'{factor}: mean return by quantile (bps)')
+        self.ic[factor].plot(ax=axes[0, 1], title=f'{factor}: rank IC', alpha=0.7)
+        axes[0, 1].axhline(0, color='black', linewidth=0.5)
+        # the factor weighted portfolio rebalanced on each factor date and held for the shortest horizon
+        (1 + self.factor_returns[factor].iloc[:, 0].fillna(0)).cumprod().plot(ax=axes[1, 0], title=f'{factor}: factor weighted long-short, {self.period_labels[0]} holding')
+        self.turnover[factor].xs(self.quantiles, axis=1, level='quantile').plot(ax=axes[1, 1], title=f'{factor}: top quantile turnover')
+        fig.tight_layout()
+        plt.show()
+        return fig
@@ -0,0 +1,270 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import src.dataloader as dl
+
+class UniverseMask:
+    """
+    A boolean (dates x stocks) eligibility matrix, stored bit-packed along the stock axis.
+
+    Each eligibility condition (not ST, not suspended, listed for at least a year, ...) is one UniverseMask.
+    Universes are composed with the bitwise operators &, | and ~, which work byte by byte on the packed
+    matrices, so combining conditions costs T * N / 8 operations and no merges onto the backtesting panel.
+
+    Bit j of a row is stock j, using numpy's default big-endian bit order (see np.packbits).
+    """
+    def __init__(self, bits: np.ndarray, dates: pd.DatetimeIndex, stocks: pd.Index):
+        """
+        Args:
+            bits (np.ndarray): uint8 array of shape (len(dates), ceil(len(stocks) / 8))
+            dates (pd.DatetimeIndex): the row axis
+            stocks (pd.Index): the column axis
+        """
+        assert(bits.dtype == np.uint8)
+        assert(bits.shape == (len(dates), (len(stocks) + 7) // 8))
+        self.bits = bits
+        self.dates = dates
+        self.stocks = stocks
+
+    @classmethod
+    def from_bool(cls, mat: np.ndarray, dates, stocks) -> 'UniverseMask':
+        """Pack a dense (dates x stocks) boolean matrix"""
+        return cls(np.packbits(np.asarray(mat, dtype=bool), axis=1), pd.DatetimeIndex(dates), pd.Index(stocks))
+
+    @classmethod
+    def from_series(cls, flags: pd.Series, dates, stocks, fill_value=False) -> 'UniverseMask':
+        """
+        Pack a (date, stock) multi-index boolean series onto the given axes.
+        (date, stock) pairs missing from 'flags' are set to 'fill_value'.
+        """
+        dates, stocks = pd.DatetimeIndex(dates), pd.Index(stocks)
+        mat = np.full((len(dates), len(stocks)), fill_value, dtype=bool)
+        row = dates.get_indexer(pd.to_datetime(flags.index.get_level_values(0)))
+        col = stocks.get_indexer(flags.index.get_level_values(1))
+        found = (row >= 0) & (col >= 0)
+        values = flags.values[found]
+        # NaN flags count as missing data
+        not_nan = pd.notnull(values)
+        mat[row[found][not_nan], col[found][not_nan]] = values[not_nan].astype(bool)
+        return cls.from_bool(mat, dates, stocks)
+
+    def to_bool(self) -> np.ndarray:
+        """Unpack into a dense (dates x stocks) boolean matrix"""
+        return np.unpackbits(self.bits, axis=1, count=len(self.stocks)).astype(bool)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.to_bool(), index=self.dates, columns=self.stocks)
+
+    def _check_aligned(self, other):
+        assert(isinstance(other, UniverseMask))
+        assert(self.dates.equals(other.dates) and self.stocks.equals(other.stocks)), "universe masks must share the same axes"
+
+    def _padding_mask(self) -> np.ndarray:
+        # the last byte of each row may contain padding bits which must stay 0
+        row_mask = np.full(self.bits.shape[1], 0xFF, dtype=np.uint8)
+        num_padding_bits = self.bits.shape[1] * 8 - len(self.stocks)
+        if num_padding_bits:
+            row_mask[-1] = (0xFF << num_padding_bits) & 0xFF
+        return row_mask
+
+    def __and__(self, other):
+        self._check_aligned(other)
+        return UniverseMask(self.bits & other.bits, self.dates, self.stocks)
+
+    def __or__(self, other):
+        self._check_aligned(other)
+        return UniverseMask(self.bits | other.bits, self.dates, self.stocks)
+
+    def __xor__(self, other):
+        self._check_aligned(other)
+        return UniverseMask(self.bits ^ other.bits, self.dates, self.stocks)
+
+    def __invert__(self):
+        return UniverseMask(~self.bits & self._padding_mask(), self.dates, self.stocks)
+
+    def count(self) -> pd.Series:
+        """the number of eligible stocks on each date"""
+        counts = np.unpackbits(self.bits, axis=1).sum(axis=1)
+        return pd.Series(counts, index=self.dates, name='num_stocks')
+
+    def lookup(self, dates, stocks) -> np.ndarray:
+        """
+        Vectorized lookup for a list of (date, stock) pairs, e.g. the rows of the backtesting dataframe.
+        Pairs that are not on the axes of this mask are not eligible.
+
+        Returns:
+            np.ndarray: a boolean array with one entry per (date, stock) pair
+        """
+        row = self.dates.get_indexer(pd.to_datetime(dates))
+        col = self.stocks.get_indexer(stocks)
+        found = (row >= 0) & (col >= 0)
+        row, col = row[found], col[found]
+        result = np.zeros(found.shape[0], dtype=bool)
+        result[found] = (self.bits[row, col >> 3] >> (7 - (col & 7))) & 1
+        return result
+
+class UniverseEngine:
+    """
+    Builds and caches eligibility conditions on a fixed (dates x stocks) grid.
+
+    Conditions are cached by their name and parameters, and universes are cached by their definition, i.e. the tuple of
+    conditions they are made of. Building the ST/suspension conditions requires reading the raw data once; every
+    universe variant afterwards (no ST, different minimum listing age, liquidity screens, ...) only costs a few
+    bitwise operations.
+
+    Example:
+        engine = UniverseEngine(dates, stocks)
+        universe = engine.universe('not_st', 'not_suspended', ('min_listing_days', {'days': 365}))
+        df = df[universe.lookup(df['date'], df['stock'])]
+    """
+    def __init__(self, dates, stocks, cache_dir=None):
+        """
+        Args:
+            dates: the rebalancing dates
+            stocks: the stock codes (normalized, e.g. 000001.XSHE)
+            cache_dir (str, optional): if given, built conditions are also persisted there as packed .npy files
+                                       so that they survive across sessions. Defaults to None.
+        """
+        self.dates = pd.DatetimeIndex(pd.to_datetime(dates)).sort_values()
+        self.stocks = pd.Index(stocks).sort_values()
+        self.cache_dir = cache_dir
+        self._conditions = {}
+        self._universes = {}
+
+    @property
+    def axes_hash(self) -> str:
+        # identifies the (dates x stocks) grid in the on-disk cache
+        digest = hashlib.sha1()
+        digest.update(self.dates.values.astype('datetime64[ns]').tobytes())
+        digest.update('|'.join(map(str, self.stocks)).encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def _condition_key(spec) -> tuple:
+        # a condition is specified either by its name or by a (name, params) tuple
+        if isinstance(spec, str):
+            return (spec, ())
+        name, params = spec
+        return (name, tuple(sorted(params.items())))
+
+    def condition(self, name: str, **params) -> UniverseMask:
+        """
+        Return the mask of the condition 'name'. Built-in conditions are the methods named 'build_<name>'.
+        """
+        key = self._condition_key((name, params))
+        if key not in self._conditions:
+            self._conditions[key] = self._load_or_build(key)
+        return self._conditions[key]
+
+    def add_condition(self, name: str, mask: UniverseMask):
+        """Register a custom condition, e.g. one computed from a panel column with 'from_series'"""
+        assert(mask.dates.equals(self.dates) and mask.stocks.equals(self.stocks))
+        self._conditions[self._condition_key(name)] = mask
+        # universes containing the replaced condition are no longer valid
+        self._universes = {key: universe for key, universe in self._universes.items() if self._condition_key(name) not in key}
+
+    def universe(self, *conditions) -> UniverseMask:
+        """
+        Return the intersection of the given conditions. The result is cached by its definition.
+
+        Args:
+            *conditions: condition names or (name, params) tuples, e.g. 'not_st', ('min_listing_days', {'days': 365})
+        """
+        key = tuple(sorted(self._condition_key(spec) for spec in conditions))
+        if key not in self._universes:
+            universe = UniverseMask.from_bool(np.ones((len(self.dates), len(self.stocks)), dtype=bool), self.dates, self.stocks)
+            for name, params in key:
+                universe = universe & self.condition(name, **dict(params))
+            self._universes[key] = universe
+        return self._universes[key]
+
+    def _cache_path(self, key) -> str:
+        name, params = key
+        param_str = '_'.join(f"{k}={v}" for k, v in params)
+        # the version of the raw file is part of the name, so that masks built from older data are not reused
+        version = raw_data_version(name)
+        return os.path.join(self.cache_dir, f"{self.axes_hash}_{name}{'_' + param_str if param_str else ''}"
+                                            f"{'_' + version if version else ''}.npy")
+
+    def _load_or_build(self, key) -> UniverseMask:
+        name, params = key
+        if self.cache_dir is not None and os.path.exists(self._cache_path(key)):
+            return UniverseMask(np.load(self._cache_path(key)), self.dates, self.stocks)
+        builder = getattr(self, f"build_{name}", None)
+        if builder is None:
+            raise Exception(f"'{name}' is not a valid universe condition!")
+        mask = builder(**dict(params))
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # the path is computed again since the builder writes the raw file when it does not exist yet
+            np.save(self._cache_path(key), mask.bits)
+        return mask
+
+    def build_not_st(self) -> UniverseMask:
+        # stocks without ST data on a given date are treated as non-ST stocks
+        return ~UniverseMask.from_series(dl.load_st_data(self.stocks, self.dates), self.dates, self.stocks)
+
+    def build_not_suspended(self) -> UniverseMask:
+        return ~UniverseMask.from_series(dl.load_suspended_data(self.stocks, self.dates), self.dates, self.stocks)
+
+    def build_min_listing_days(self, days=365) -> UniverseMask:
+        # stocks with unknown listed dates are never eligible since the comparison with NaT is always False
+        listed_dates = dl.load_listed_dates(self.stocks)['listed_date'].reindex(self.stocks).values
+        listing_age = self.dates.values[:, np.newaxis] - listed_dates[np.newaxis, :]
+        return UniverseMask.from_bool(listing_age >= pd.Timedelta(days=days).to_timedelta64(), self.dates, self.stocks)
+
+    def build_from_quantile(self, values: pd.Series, min_quantile=0.1) -> UniverseMask:
+        """
+        Liquidity/size screens: keep stocks whose value (e.g. market_value or turnover) is at or above the
+        'min_quantile' cross-sectional quantile on each date.
+        Use it through 'add_condition', since a pd.Series cannot be part of a cached definition:
+            engine.add_condition('liquid', engine.build_from_quantile(df['market_value'], 0.1))
+        """
+        df_values = values.unstack(level=1).reindex(index=self.dates, columns=self.stocks)
+        rank_pct = df_values.rank(axis=1, pct=True)
+        return UniverseMask.from_bool((rank_pct >= min_quantile).values, self.dates, self.stocks)
+
+# the stock universe used in Huatai's report: no ST stocks, no suspended stocks and no stocks listed within one year
+# (365.2425 days, the length of pd.Timedelta('1y'))
+DEFAULT_UNIVERSE = ('not_st', 'not_suspended', ('min_listing_days', {'days': 365.2425}))
+
+# the raw files the built-in conditions are read from (see the dataloader)
+RAW_DATA_FILES = {
+    'not_st': './Data/raw_data/is_st.h5',
+    'not_suspended': './Data/raw_data/is_suspended.h5',
+    'min_listing_days': './Data/raw_data/listed_dates.h5',
+}
+
+def raw_data_version(name: str) -> str:
+    """
+    Size and modification time of the raw file the condition 'name' is built from, '' for custom conditions.
+    """
+    if name not in RAW_DATA_FILES:
+        return ''
+    try:
+        stat = os.stat(RAW_DATA_FILES[name])
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+    except OSError:
+        return 'missing'
+
+# axes hash -> (key of the engine, engine)
+_ENGINES = {}
+
+def get_universe_engine(dates, stocks, cache_dir=None) -> UniverseEngine:
+    """
+    Return the UniverseEngine of the given (dates x stocks) grid, reusing the cached one when it exists
+    so that its conditions and universes are shared across TimeAndStockFilter runs.
+    The cached engine is replaced when the raw files change(e.g. after a data refresh) or when another cache_dir is given.
+    """
+    engine = UniverseEngine(dates, stocks, cache_dir=cache_dir)
+    key = (cache_dir, tuple(raw_data_version(name) for name in RAW_DATA_FILES))
+    if engine.axes_hash not in _ENGINES or _ENGINES[engine.axes_hash][0] != key:
+        _ENGINES[engine.axes_hash] = (key, engine)
+    return _ENGINES[engine.axes_hash][1]
+
+def plot_universe_size(universe: UniverseMask):
+    import matplotlib.pyplot as plt
+    # number of eligible stocks along the time
+    universe.count().plot.line()
+    plt.show()
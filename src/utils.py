@@ -1,18 +1,13 @@
+import numpy as np
 import pandas as pd
 import pathos
 import multiprocessing
-import time
-
-def timer(func):
-    # This decorator function shows the execution time of 
-    # the function object passed
-    def wrap_func(*args, **kwargs):
-        t1 = time.time()
-        result = func(*args, **kwargs)
-        t2 = time.time()
-        print(f'Function {func.__name__!r} executed in {(t2-t1):.4f}s')
-        return result
-    return wrap_func
+
+from src.profiler import PROFILER, profile_stage
+
+# 'timer' profiles the decorated pipeline stage: wall time, cpu time(including pool workers), peak memory and the
+# row/column counts of its output are recorded in PROFILER, see src/profiler.py
+timer = profile_stage
 
 def sort_index_and_col(df) -> pd.DataFrame:
     # sort the dataframe by index and column
@@ -24,7 +19,7 @@ def applyParallel(dfGrouped, func):
     # parrallel computing version of pd.groupby.apply, works most of the time but not always
     # I mainly use it for cases where func takes in a dataframe and outputs a dataframe or a series
     with pathos.multiprocessing.ProcessPool(pathos.helpers.cpu_count()) as pool:
-        ret_list = pool.map(func, [group for name, group in dfGrouped])
+        ret_list = PROFILER.collect(pool.map(PROFILER.task(func), [group for name, group in dfGrouped]))
     return pd.concat(ret_list)
 
 def remove_outlier(df, n=3):
@@ -48,3 +43,29 @@ def remove_outlier(df, n=3):
 def standardize(df):
     # on each rebalancing date, each standardized factor has mean 0 and std 1
     return (df - df.mean()) / df.std()
+
+def ewma(df, halflife: float):
+    """
+    Half-life exponentially weighted moving average along the rows(dates) of a (dates x factors) matrix,
+    computed with the recursive filter
+        num_t = decay * num_{t-1} + x_t,  den_t = decay * den_{t-1} + 1,  ewma_t = num_t / den_t
+    where decay = 0.5 ** (1 / halflife), so the whole matrix costs O(T * K).
+    Missing values are skipped and do not decay the past values, same as df.ewm(halflife=halflife, ignore_na=True).mean()
+
+    Args:
+        df (pd.DataFrame or np.ndarray): the (dates x factors) matrix, e.g. IC values or factor returns
+        halflife (float): number of periods for an observation's weight to halve
+
+    Returns:
+        the moving averages, of the same type and shape as 'df'
+    """
+    values = np.asarray(df, dtype=np.float64)
+    decay = 0.5 ** (1 / halflife)
+    num, den = np.zeros(values.shape[1:]), np.zeros(values.shape[1:])
+    result = np.full(values.shape, np.nan)
+    for t in range(values.shape[0]):
+        observed = ~np.isnan(values[t])
+        num = np.where(observed, decay * num + np.nan_to_num(values[t]), num)
+        den = np.where(observed, decay * den + 1., den)
+        np.divide(num, den, out=result[t], where=den > 0)
+    return pd.DataFrame(result, index=df.index, columns=df.columns) if isinstance(df, pd.DataFrame) else result